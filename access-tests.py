@@ -0,0 +1,663 @@
+# Tests of the access part, run by .github/workflows/access-tests.yml
+
+"""The access functions run against embedded SQLite (and DuckDB when it is installed) databases, and the
+Land Registry and postcode downloads are served from a temporary directory by a local http server, so
+the tests need neither a database server nor the network."""
+
+import os
+import io
+import json
+import math
+import random
+import sys
+import shutil
+import subprocess
+import collections
+import zipfile
+import tempfile
+import warnings
+import threading
+import functools
+import unittest
+from unittest import mock
+import importlib.util
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+from fynesse import access, cache
+from fynesse.backends import SCHEMA
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def setUpModule():
+    global server, served, base_url
+    served = tempfile.mkdtemp()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=served))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+def tearDownModule():
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(served, ignore_errors=True)
+
+def serve(name, content, stamp = 1e9):
+    """
+    Put a file on the local server, with a fixed modification time (the server's ETag)
+    """
+    path = os.path.join(served, name)
+    with open(path, 'wb' if isinstance(content, bytes) else 'w') as handle:
+        handle.write(content)
+    os.utime(path, (stamp, stamp))
+
+def transaction(i, date, price = None, status = 'A', postcode = None):
+    """
+    Fields of a price paid transaction, as read_transaction_delta returns them
+    """
+    return [f"{{T{i}}}", price or 50000 + 997*i % 850000, date, postcode or f"AB1 {i % 20}XY", 'DSTFO'[i % 5], 'N', 'F',
+            str(i), '', 'HIGH ST', 'LOC', 'TOWN', 'DIST', 'COUNTY', 'A', status]
+
+def transaction_csv(records):
+    """
+    Price paid csv, quoted as the Land Registry files are
+    """
+    return ''.join('"' + '","'.join(str(field) if j != 2 else field + ' 00:00' for (j, field) in enumerate(fields)) + '"\n' for fields in records)
+
+def count_lines(conn, table, file):
+    """
+    Loader counting the lines of a file instead of loading it
+    """
+    with open(file) as handle:
+        return sum(1 for _ in handle)
+
+def postcode(code, lattitude, longitude):
+    """
+    Fields of a postcode, in POSTCODE_COLUMNS order
+    """
+    fields = dict.fromkeys(access.POSTCODE_COLUMNS, '')
+    fields.update(postcode=code, status='live', usertype='small', easting='1', northing='1', positional_quality_indicator='1',
+                  country='England', lattitude=repr(lattitude), longitude=repr(longitude), postcode_district=code.split()[0])
+    return [fields[column] for column in access.POSTCODE_COLUMNS]
+
+
+class AccessTests:
+    """
+    Tests run once per backend, by the TestCase subclasses below
+    """
+    backend = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.' + self.backend)
+        self.manifest = os.path.join(self.directory, 'manifest.json')
+        self.conn = self.connect()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        for name in os.listdir(served):
+            os.remove(os.path.join(served, name))
+
+    def connect(self):
+        return access.create_connection(backend=self.backend, path=self.path)
+
+    def query(self, sql, params = ()):
+        cur = self.conn.cursor()
+        cur.execute(access.bind(self.conn, sql), params)
+        return cur.fetchall()
+
+    def count(self, table):
+        return self.query(f"SELECT COUNT(*) FROM {table}")[0][0]
+
+    def load_postcodes(self, postcodes):
+        access.create_tables(self.conn, ['postcode_data'])
+        access.backend_of(self.conn).insert_rows(self.conn, 'postcode_data', access.POSTCODE_COLUMNS,
+                                                 [[field or None for field in fields] for fields in postcodes])
+        self.conn.commit()
+
+    def load_transactions(self, records):
+        access.create_tables(self.conn, ['pp_data'])
+        access.backend_of(self.conn).insert_rows(self.conn, 'pp_data', [column for (column, _) in SCHEMA['pp_data']], records)
+        self.conn.commit()
+
+    def fixture(self):
+        """
+        Transactions of 2015 at postcodes spread over a 0.1 degree box, some of them exactly on the borders
+        of 0.05 degree cells. Returns the coordinates of the postcodes.
+        """
+        r = random.Random(0)
+        points = [(52.3 + r.random()*0.1, -2.3 + r.random()*0.1) for _ in range(40)]
+        points += [(52.3, -2.3), (52.4, -2.2), (52.3, -2.25), (52.35, -2.2), (52.300000000000004, -2.2999999999999998), (52.39999999999999, -2.2)]
+        self.load_postcodes([postcode(f"AB1 {i}XY", lattitude, longitude) for (i, (lattitude, longitude)) in enumerate(points)])
+        self.load_transactions([transaction(i, f"2015-{1 + i % 12:02d}-{1 + i % 28:02d}", postcode=f"AB1 {i % len(points)}XY") for i in range(600)])
+        return points
+
+    # Ingest
+
+    def test_load_transactions_pipelined(self):
+        access.create_tables(self.conn, ['pp_data'])
+        for year in (2015, 2016):
+            for part in (1, 2):
+                serve(f"pp-{year}-part{part}.csv", transaction_csv([transaction(1000*year + 100*part + i, f"{year}-0{part}-15") for i in range(50)]))
+        downloads = os.path.join(self.directory, 'downloads')
+        os.makedirs(downloads)
+        stats = access.load_transactions_pipelined(self.connect, 'pp_data', 2015, 2017, downloads=3, loaders=2,
+                                                   directory=downloads, url=base_url + 'pp-%d-part%d.csv')
+        self.assertEqual(len(stats), 4)
+        self.assertEqual(stats.rows.sum(), 200)
+        self.assertEqual(self.count('pp_data'), 200)
+        self.assertEqual(self.query("SELECT COUNT(DISTINCT transaction_unique_identifier) FROM pp_data")[0][0], 200)
+        self.assertEqual(os.listdir(downloads), [])
+
+    def test_ingest_failed_download(self):
+        access.create_tables(self.conn, ['pp_data'])
+        serve('pp-2015-part1.csv', transaction_csv([transaction(i, '2015-01-15') for i in range(10)]))
+        downloads = os.path.join(self.directory, 'downloads')
+        os.makedirs(downloads)
+        with self.assertRaises(Exception):
+            access.ingest([base_url + 'pp-2015-part1.csv', base_url + 'missing.csv'], self.connect, 'pp_data', directory=downloads)
+        self.assertEqual(os.listdir(downloads), [])
+
+    def test_ingest_loader(self):
+        serve('a.csv', 'x\n' * 3)
+        serve('b.csv', 'x\n' * 5)
+        loaded = []
+        stats = access.ingest([base_url + 'a.csv', base_url + 'b.csv'], self.connect, 'pp_data', downloads=2, loaders=1,
+                              loader=count_lines, on_loaded=loaded.append)
+        self.assertEqual(sorted(stats.rows), [3, 5])
+        self.assertEqual(sorted(record['url'] for record in loaded), [base_url + 'a.csv', base_url + 'b.csv'])
+        self.assertEqual(sorted(stats.bytes), [6, 10])
+        self.assertTrue(stats.checksum.str.len().eq(32).all())
+
+    # Incremental sync
+
+    def sync(self, end_year = 2017):
+        return access.sync_transactions(self.connect, 'pp_data', 2015, end_year, manifest_file=self.manifest, current_year=2016,
+                                        directory=self.directory, base_url=base_url)
+
+    def test_sync_transactions(self):
+        access.create_tables(self.conn, ['pp_data', 'prices_coordinates_data'])
+        serve('pp-2015-part1.csv', transaction_csv([transaction(i, '2015-03-01') for i in range(100)]))
+        serve('pp-2015-part2.csv', transaction_csv([transaction(i, '2015-09-01') for i in range(100, 200)]))
+        serve('pp-2016.csv', transaction_csv([transaction(i, f"2016-0{1 + i % 6}-10") for i in range(200, 300)]))
+        serve(access.MONTHLY_UPDATE_FILE, transaction_csv([transaction(900, '2016-06-01')]))
+        stats = self.sync()
+        self.assertEqual(sorted(url.rsplit('/', 1)[-1] for url in stats.url), ['pp-2015-part1.csv', 'pp-2015-part2.csv', 'pp-2016.csv'])
+        self.assertEqual(self.count('pp_data'), 300)
+        with open(self.manifest) as handle:
+            self.assertEqual(json.load(handle)[base_url + access.MONTHLY_UPDATE_FILE]['month'], '2016-06')
+
+        # The next month's update adds two transactions, changes one and deletes another
+        (db_id, ) = self.query("SELECT db_id FROM pp_data WHERE transaction_unique_identifier = '{T200}'")[0]
+        serve(access.MONTHLY_UPDATE_FILE, transaction_csv([transaction(1000, '2016-07-03'), transaction(1001, '2016-07-04'),
+                                                           transaction(200, '2016-01-10', price=123, status='C'),
+                                                           transaction(201, '2016-02-10', status='D')]), 1e9 + 100)
+        self.assertEqual(len(self.sync()), 1)
+        self.assertEqual(self.count('pp_data'), 301)
+        self.assertEqual(self.query("SELECT price, db_id FROM pp_data WHERE transaction_unique_identifier = '{T200}'"), [(123, db_id)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM pp_data WHERE transaction_unique_identifier = '{T201}'"), [(0, )])
+
+        # Nothing changed, or only the modification time
+        self.assertEqual(len(self.sync()), 0)
+        os.utime(os.path.join(served, access.MONTHLY_UPDATE_FILE), (1e9 + 200, 1e9 + 200))
+        self.assertEqual(len(self.sync()), 0)
+        self.assertEqual(self.count('pp_data'), 301)
+
+        # August was missed, so September's update reloads the year
+        serve('pp-2016.csv', transaction_csv([transaction(i, f"2016-0{1 + i % 9}-10") for i in range(200, 400)]), 1e9 + 300)
+        serve(access.MONTHLY_UPDATE_FILE, transaction_csv([transaction(2000, '2016-09-03')]), 1e9 + 300)
+        self.assertEqual([url.rsplit('/', 1)[-1] for url in self.sync().url], ['pp-2016.csv'])
+        self.assertEqual(self.count('pp_data'), 400)
+        with open(self.manifest) as handle:
+            self.assertEqual(json.load(handle)[base_url + access.MONTHLY_UPDATE_FILE]['month'], '2016-09')
+
+    def test_sync_republished_part_file(self):
+        access.create_tables(self.conn, ['pp_data', 'prices_coordinates_data'])
+        serve('pp-2015-part1.csv', transaction_csv([transaction(i, '2015-03-01') for i in range(100)]))
+        serve('pp-2015-part2.csv', transaction_csv([transaction(i, '2015-09-01') for i in range(100, 200)]))
+        self.assertEqual(len(self.sync(2016)), 2)
+        self.assertEqual(self.count('pp_data'), 200)
+
+        # The first part is republished with one transaction corrected, one withdrawn and one added
+        serve('pp-2015-part1.csv', transaction_csv([transaction(1, '2015-03-01', price=321)] + [transaction(i, '2015-03-01') for i in range(2, 100)] +
+                                                   [transaction(500, '2015-04-01')]), 1e9 + 100)
+        self.assertEqual(len(self.sync(2016)), 2)
+        self.assertEqual(self.query("SELECT COUNT(*), COUNT(DISTINCT transaction_unique_identifier) FROM pp_data"), [(200, 200)])
+        self.assertEqual(self.query("SELECT price FROM pp_data WHERE transaction_unique_identifier IN ('{T0}', '{T1}', '{T500}') ORDER BY price"), [(321, ), (50000 + 997*500, )])
+
+        # Republished with the same contents, or not at all
+        os.utime(os.path.join(served, 'pp-2015-part2.csv'), (1e9 + 200, 1e9 + 200))
+        self.assertEqual(len(self.sync(2016)), 0)
+        self.assertEqual(len(self.sync(2016)), 0)
+        self.assertEqual(self.count('pp_data'), 200)
+
+    def test_apply_transaction_delta(self):
+        self.load_transactions([transaction(i, '2016-01-10') for i in range(10)])
+        records = [transaction(1, '2016-01-10', price=1, status='C'), transaction(2, '2016-01-10', status='D'),
+                   transaction(2, '2016-01-10', status='D'), transaction(20, '2016-02-10'), transaction(30, '2016-02-10', status='D')]
+        counts = access.apply_transaction_delta(self.conn, 'pp_data', records)
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'deleted': 1})
+        self.assertEqual(self.count('pp_data'), 10)
+        self.assertEqual(access.latest_month(self.conn, 'pp_data'), '2016-02')
+
+    # Postcodes
+
+    def test_load_postcodes(self):
+        access.create_tables(self.conn, ['postcode_data'])
+        postcodes = [postcode(f"AB{i // 10} {i % 10}XY", 52 + i/1000, -2 - i/1000) for i in range(250)]
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as handle:
+            handle.writestr('open_postcode_geo.csv', ''.join(','.join(fields) + '\n' for fields in postcodes))
+        serve('open_postcode_geo.csv.zip', archive.getvalue())
+        rows = access.load_postcodes(self.conn, {}, columns=['postcode', 'country', 'lattitude', 'longitude'], method='pipe',
+                                     batch_size=100, chunk_size=512, url=base_url + 'open_postcode_geo.csv.zip')
+        self.assertEqual(rows, 250)
+        self.assertEqual(self.count('postcode_data'), 250)
+        self.assertEqual(self.query("SELECT lattitude, longitude FROM postcode_data WHERE postcode = 'AB4 2XY'"), [(52.042, -2.042)])
+
+    def test_load_postcodes_truncated_archive(self):
+        access.create_tables(self.conn, ['postcode_data'])
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as handle:
+            handle.writestr('open_postcode_geo.csv', ''.join(','.join(postcode(f"AB{i // 10} {i % 10}XY", 52, -2)) + '\n' for i in range(1000)))
+        serve('open_postcode_geo.csv.zip', archive.getvalue()[:2000])
+        with self.assertRaises(ValueError):
+            access.load_postcodes(self.conn, {}, method='executemany', batch_size=100, url=base_url + 'open_postcode_geo.csv.zip')
+        self.assertEqual(self.count('postcode_data'), 0)
+
+    def test_stream_zip_member(self):
+        data = b''.join(b'line %d\n' % i for i in range(10000))
+        for method in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w', method) as handle:
+                handle.writestr('data.csv', data)
+            raw = archive.getvalue()
+            blocks = (raw[start:start+100] for start in range(0, len(raw), 100))
+            self.assertEqual(b''.join(access.stream_zip_member(blocks)), data)
+        self.assertEqual(list(access.project_lines([b'a,b,c\nd,', b'e,f\ng,h,i'], [0, 2])), [[b'a', b'c'], [b'd', b'f'], [b'g', b'i']])
+
+    # Connection pool
+
+    def test_pool_rolls_back_on_return(self):
+        self.load_transactions([])
+        with access.ConnectionPool(size=1, connect=self.connect) as pool:
+            with pool.connection() as conn:
+                first = conn
+                access.backend_of(conn).begin(conn)
+                access.backend_of(conn).insert_rows(conn, 'pp_data', [column for (column, _) in SCHEMA['pp_data']], [transaction(1, '2016-01-10')])
+            with pool.connection() as conn:
+                self.assertIs(conn, first)
+                cur = conn.cursor()
+                cur.execute("SELECT COUNT(*) FROM pp_data")
+                self.assertEqual(cur.fetchone()[0], 0)
+                access.backend_of(conn).insert_rows(conn, 'pp_data', [column for (column, _) in SCHEMA['pp_data']], [transaction(2, '2016-01-10')])
+                conn.commit()
+        self.assertEqual(self.count('pp_data'), 1)
+
+    def test_pool_timeout(self):
+        with access.ConnectionPool(size=1, connect=self.connect) as pool:
+            with pool.connection():
+                with self.assertRaises(TimeoutError):
+                    with pool.connection(timeout=0.01):
+                        pass
+            with pool.connection(timeout=0.01):
+                pass
+
+    def test_pool_recycles_broken_connections(self):
+        with access.ConnectionPool(size=1, recycle=0, connect=self.connect) as pool:
+            with pool.connection() as conn:
+                first = conn
+            first.close()
+            with pool.connection() as conn:
+                self.assertIsNot(conn, first)
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                self.assertEqual(cur.fetchone()[0], 1)
+
+    def test_checkout(self):
+        with access.checkout(self.conn) as conn:
+            self.assertIs(conn, self.conn)
+        with access.ConnectionPool(size=1, connect=self.connect) as pool:
+            with access.checkout(pool) as conn, access.dedicated(self.connect) as other:
+                self.assertIsNot(conn, other)
+
+    def test_ingest_with_pool(self):
+        access.create_tables(self.conn, ['pp_data'])
+        serve('a.csv', transaction_csv([transaction(i, '2015-01-15') for i in range(10)]))
+        serve('b.csv', transaction_csv([transaction(i, '2015-02-15') for i in range(10, 30)]))
+        loaded = []
+        with access.ConnectionPool(size=2, connect=self.connect) as pool:
+            stats = access.ingest([base_url + 'a.csv', base_url + 'b.csv'], pool, 'pp_data', on_loaded=loaded.append,
+                                  should_load=lambda url, checksum: not url.endswith('b.csv'))
+        self.assertEqual(list(stats.rows), [10])
+        self.assertEqual([record['url'] for record in loaded], [base_url + 'a.csv'])
+        self.assertEqual(self.count('pp_data'), 10)
+
+
+    # Streaming
+
+    def test_iter_price_location_data(self):
+        self.fixture()
+        chunks = list(access.iterPriceAndLocationData(self.conn, -2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-06-30', chunksize=70))
+        self.assertEqual([len(chunk) for chunk in chunks[:-1]], [70] * (len(chunks) - 1))
+        data = access.concat_frames(chunks)
+        self.assertEqual(len(data), 300)
+        self.assertEqual(list(data.columns), access.PRICE_LOCATION_COLUMNS)
+        self.assertEqual(sorted(data.db_id), sorted(access.joinPriceAndLocationData(self.conn, -2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-06-30').db_id))
+        self.assertTrue(data.date_of_transfer.between('2015-01-01', '2015-06-30').all())
+
+    def test_iter_fetch_data(self):
+        self.fixture()
+        columns = ['db_id', 'price', 'postcode']
+        chunks = list(access.iter_fetch_data(self.conn, 'pp_data', columns, chunksize=250))
+        self.assertEqual([len(chunk) for chunk in chunks], [250, 250, 100])
+        self.assertEqual(sorted(access.concat_frames(chunks).db_id), sorted(db_id for (db_id, ) in self.query("SELECT db_id FROM pp_data")))
+        if importlib.util.find_spec('pyarrow'):
+            batches = list(access.iter_fetch_data(self.conn, 'pp_data', columns, chunksize=250, arrow=True))
+            self.assertEqual(sum(batch.num_rows for batch in batches), 600)
+            self.assertEqual(batches[0].schema.names, columns)
+
+    def test_fetch_data(self):
+        access.create_tables(self.conn, ['prices_coordinates_data'])
+        self.fixture()
+        access.joinAndStorePriceAndLocationData(self.conn, -2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-01-31')
+        data = access.fetch_data(self.conn, 'prices_coordinates_data', access.PRICE_LOCATION_COLUMNS)
+        self.assertEqual(len(data), 50)
+        self.assertEqual(str(data.price.dtype), 'int32')
+
+    # Typed frames
+
+    def test_typed_frames(self):
+        self.fixture()
+        chunks = list(access.iterPriceAndLocationData(self.conn, -2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-12-31', chunksize=100))
+        self.assertTrue(all(dict(chunk.dtypes.astype(str)) == access.PRICE_LOCATION_DTYPES for chunk in chunks))
+        data = access.concat_frames(chunks)
+        self.assertEqual(dict(data.dtypes.astype(str)), access.PRICE_LOCATION_DTYPES)
+        self.assertEqual(sorted(data.postcode.astype(str)), sorted(code for chunk in chunks for code in chunk.postcode.astype(str)))
+        # Chunks with categories of their own are concatenated to a categorical of all of them
+        (first, second) = (access.typed_frame([(1, 'D'), (2, 'S')], ['price', 'property_type']), access.typed_frame([(3, 'T')], ['price', 'property_type']))
+        both = access.concat_frames([first, second])
+        self.assertEqual((str(both.property_type.dtype), list(both.property_type.astype(str)), list(both.price)), ('category', ['D', 'S', 'T'], [1, 2, 3]))
+        plain = data.astype({column: object for column in data.columns if str(data[column].dtype) in ('category', 'datetime64[ns]')})
+        self.assertLess(data.memory_usage(deep=True).sum()*3, plain.memory_usage(deep=True).sum())
+
+        # Casting leaves columns outside the schema, and columns already of their dtype, as they are
+        other = access.pd.Series(['a', 'b'])
+        frame = access.apply_schema(access.pd.DataFrame({'price': ['100', '200'], 'other': other}))
+        self.assertEqual((str(frame.price.dtype), frame.other.dtype), ('int32', other.dtype))
+
+    # Query builder
+
+    def test_price_location_query(self):
+        self.fixture()
+        (query, params) = access.price_location_query(-2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-12-31', ['db_id', 'property_type'], property_type='D')
+        self.assertNotIn('2015', query)
+        self.assertEqual(params, (52.3, 52.4, -2.3, -2.2, '2015-01-01', '2015-12-31', 'D'))
+        rows = self.query(query, params)
+        self.assertEqual(len(rows), 120)
+        self.assertEqual({property_type for (_, property_type) in rows}, {'D'})
+        # Values are bound, never spliced into the SQL
+        (query, params) = access.price_location_query(-2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-12-31', property_type="D' OR '1'='1")
+        self.assertEqual(self.query(query, params), [])
+
+    def test_ensure_indexes(self):
+        access.create_tables(self.conn, ['pp_data', 'postcode_data'])
+        access.ensure_indexes(self.conn, ['pp_data', 'postcode_data'])
+        access.ensure_indexes(self.conn, ['pp_data', 'postcode_data'])
+        (query, params) = access.price_location_query(-2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-12-31')
+        plan = access.explain(self.conn, query, params)
+        self.assertGreater(len(plan), 0)
+
+
+    # Extract cache
+
+    def extract_cache(self, **settings):
+        return cache.ExtractCache(os.path.join(self.directory, 'extracts'), manifest_file=self.manifest, **settings)
+
+    def test_extract_cache(self):
+        self.fixture()
+        extracts = self.extract_cache()
+        with mock.patch.object(cache, 'joinPriceAndLocationData', wraps=access.joinPriceAndLocationData) as join:
+            self.assertEqual(len(extracts.get(self.conn, -2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-12-31')), 600)
+            # Sub-boxes, sub-ranges and property types are served from the extract, as the database would serve them
+            expected = access.joinPriceAndLocationData(self.conn, -2.28, -2.21, 52.31, 52.38, '2015-03-01', '2015-08-31', property_type='D')
+            cached = extracts.get(self.conn, -2.28, -2.21, 52.31, 52.38, '2015-03-01', '2015-08-31', property_type='D')
+            self.assertEqual(join.call_count, 1)
+            self.assertEqual(sorted(cached.db_id), sorted(expected.db_id))
+            self.assertEqual({column: str(dtype) for (column, dtype) in cached.dtypes.items()}, {column: str(dtype) for (column, dtype) in expected.dtypes.items()})
+            # Loading other files invalidates the extracts
+            with open(self.manifest, 'w') as handle:
+                json.dump({'pp-2015-part1.csv': {'checksum': 'changed'}}, handle)
+            extracts.get(self.conn, -2.28, -2.21, 52.31, 52.38, '2015-03-01', '2015-08-31')
+            self.assertEqual(join.call_count, 2)
+
+    def test_extract_cache_eviction(self):
+        self.fixture()
+        extracts = self.extract_cache(max_bytes=1)
+        extracts.get(self.conn, -2.3, -2.25, 52.3, 52.4, '2015-01-01', '2015-12-31')
+        extracts.get(self.conn, -2.25, -2.2, 52.3, 52.4, '2015-01-01', '2015-12-31')
+        self.assertEqual(len([name for name in os.listdir(extracts.directory) if name != 'index.json']), 1)
+        # The index is persisted for the next process
+        self.assertEqual(len(self.extract_cache()._index), 1)
+        extracts.clear()
+        self.assertEqual(os.listdir(extracts.directory), ['index.json'])
+
+    def test_extract_cache_concurrent_eviction(self):
+        self.fixture()
+        extracts = self.extract_cache(max_bytes=1)
+        boxes = [(-2.3 + 0.025*i, -2.275 + 0.025*i, 52.3, 52.4) for i in range(4)]
+
+        def work(box):
+            # Every miss evicts the other threads' extracts, possibly while they read them
+            return sum(len(extracts.get(pool, *box, '2015-01-01', '2015-12-31')) for _ in range(15))
+
+        with access.ConnectionPool(size=4, connect=self.connect) as pool, ThreadPoolExecutor(max_workers=4) as executor:
+            counts = list(executor.map(work, boxes))
+        expected = [15*len(access.joinPriceAndLocationData(self.conn, *box, '2015-01-01', '2015-12-31')) for box in boxes]
+        self.assertEqual(counts, expected)
+        extracts.clear()
+        self.assertEqual(os.listdir(extracts.directory), ['index.json'])
+
+    # Materialization
+
+    def partitions(self):
+        return dict(((area, month), rows) for (area, month, rows) in self.query("SELECT area, month, rows_inserted FROM materialized_partitions"))
+
+    def test_materialize_prices_coordinates(self):
+        self.fixture()
+        access.create_tables(self.conn, ['prices_coordinates_data'])
+        partitions = access.materialize_prices_coordinates(self.conn, -2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-12-31', cell_size=0.05)
+        # Every transaction is in exactly one cell, the one rollup_cell names
+        self.assertEqual(self.query("SELECT COUNT(*), COUNT(DISTINCT db_id) FROM prices_coordinates_data"), [(600, 600)])
+        cells = collections.Counter(access.rollup_cell(lattitude, longitude, 0.05) for (lattitude, longitude) in self.query("SELECT lattitude, longitude FROM prices_coordinates_data"))
+        self.assertEqual({area: rows for (area, rows) in partitions.groupby('area').rows.sum().items() if rows}, dict(cells))
+        recorded = self.partitions()
+        self.assertEqual(len(recorded), len(partitions))
+
+        # Recorded partitions are skipped, until transactions of their month are loaded or changed
+        self.assertEqual(len(access.materialize_prices_coordinates(self.conn, -2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-12-31', cell_size=0.05)), 0)
+        access.apply_transaction_delta(self.conn, 'pp_data', [transaction(1000, '2015-03-03', postcode='AB1 0XY'),
+                                                              transaction(7, '2015-08-08', price=1000, status='C', postcode='AB1 7XY')])
+        again = access.materialize_prices_coordinates(self.conn, -2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-12-31', cell_size=0.05)
+        self.assertEqual(set(again.month), {'2015-03', '2015-08'})
+        self.assertEqual(len(again), len(partitions[partitions.month.isin(['2015-03', '2015-08'])]))
+        self.assertEqual(again.rows.sum(), 2)
+        self.assertEqual(self.count('prices_coordinates_data'), 601)
+        self.assertEqual(self.query("SELECT COUNT(*) FROM prices_coordinates_data WHERE price = 1000"), [(1, )])
+        # Partitions of other months keep their record, rows_inserted counts every run
+        self.assertEqual(sum(self.partitions().values()), 602)
+        self.assertEqual({key: rows for (key, rows) in self.partitions().items() if key[1] not in ('2015-03', '2015-08')},
+                         {key: rows for (key, rows) in recorded.items() if key[1] not in ('2015-03', '2015-08')})
+
+        # A reloaded year gives its transactions new db_ids, so all its partitions are redone
+        csv = os.path.join(self.directory, 'pp-2015.csv')
+        with open(csv, 'w') as handle:
+            handle.write(transaction_csv([transaction(i, f"2015-{1 + i % 12:02d}-{1 + i % 28:02d}", postcode=f"AB1 {i % 46}XY") for i in range(300)]))
+        access.reload_year(self.conn, 'pp_data', 2015, csv)
+        reloaded = access.materialize_prices_coordinates(self.conn, -2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-12-31', cell_size=0.05)
+        self.assertEqual((reloaded.rows.sum(), self.count('prices_coordinates_data')), (300, 300))
+
+    def test_materialize_prices_coordinates_with_workers(self):
+        self.fixture()
+        access.create_tables(self.conn, ['prices_coordinates_data'])
+        with access.ConnectionPool(size=3, connect=self.connect) as pool:
+            partitions = access.materialize_prices_coordinates(pool, -2.3, -2.2, 52.3, 52.4, '2015-01-01', '2015-06-30', cell_size=0.05, workers=3)
+        self.assertEqual(partitions.rows.sum(), self.count('prices_coordinates_data'))
+        self.assertEqual(self.count('prices_coordinates_data'), 300)
+
+    # Rollups
+
+    def rollups(self):
+        return self.query("SELECT level, area, property_type, month, n, total, min_price, max_price, sketch FROM price_rollups ORDER BY 1, 2, 3, 4")
+
+    def test_materialize_rollups(self):
+        points = self.fixture()
+        for level in ('district', 'cell'):
+            access.materialize_rollups(self.conn, level)
+        # A year is backfilled and a transaction of an older month is changed in place
+        self.load_transactions([transaction(i, f"2014-{1 + i % 12:02d}-05", postcode=f"AB1 {i % len(points)}XY") for i in range(600, 700)])
+        access.apply_transaction_delta(self.conn, 'pp_data', [transaction(5, '2015-06-06', price=1000, status='C', postcode='AB1 5XY')])
+        for level in ('district', 'cell'):
+            access.materialize_rollups(self.conn, level)
+        incremental = self.rollups()
+        for level in ('district', 'cell'):
+            access.materialize_rollups(self.conn, level, from_month='1900-01')
+        self.assertEqual(incremental, self.rollups())
+
+        prices = sorted(price for (price, ) in self.query("SELECT price FROM pp_data"))
+        summary = access.query_rollups(self.conn, by=())
+        self.assertEqual(summary.n.iloc[0], len(prices))
+        self.assertLess(abs(summary['q0.5'].iloc[0]/prices[len(prices)//2] - 1), 0.05)
+
+    def test_price_sketch(self):
+        r = random.Random(0)
+        prices = [r.lognormvariate(12, 0.5) for _ in range(5000)]
+        sketch = access.merge_sketches([access.price_sketch(prices[:2000]), access.price_sketch(prices[2000:])])
+        for q in (0.1, 0.5, 0.9):
+            exact = sorted(prices)[int(q*len(prices))]
+            self.assertLess(abs(math.log(access.sketch_quantile(sketch, q)/exact)), 0.03)
+
+
+class SQLiteTests(AccessTests, unittest.TestCase):
+    backend = 'sqlite'
+
+@unittest.skipUnless(importlib.util.find_spec('duckdb'), "duckdb is not installed")
+class DuckDBTests(AccessTests, unittest.TestCase):
+    backend = 'duckdb'
+
+
+class ImportTests(unittest.TestCase):
+    """
+    Importing fynesse, and its access module for jobs that only load data or compute boundaries, stays
+    within a time budget and leaves the heavy dependencies to be loaded on first use
+    """
+    budget = 0.5
+    heavy = ['pandas', 'numpy', 'osmnx', 'geopandas', 'statsmodels', 'scipy', 'matplotlib', 'mlai', 'pymysql', 'requests', 'yaml', 'pyarrow']
+    probe = """
+import sys, time, json
+start = time.perf_counter()
+import fynesse
+package = [name for name in %r if name in sys.modules]
+from fynesse import access
+access.calculate_boundaries(52.35, -2.25, 0.1)
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'package': package, 'access': [name for name in %r if name in sys.modules]}))
+"""
+
+    def test_import(self):
+        root = os.path.dirname(os.path.abspath(__file__))
+        results = []
+        for _ in range(3):
+            output = subprocess.check_output([sys.executable, '-c', self.probe % (self.heavy, self.heavy)], cwd=root,
+                                             env=dict(os.environ, PYTHONPATH=root))
+            results.append(json.loads(output.decode().strip().splitlines()[-1]))
+        self.assertEqual([result['package'] for result in results], [[]]*3)
+        self.assertEqual([result['access'] for result in results], [[]]*3)
+        self.assertLess(sorted(result['seconds'] for result in results)[1], self.budget)
+
+
+class TileCacheTests(unittest.TestCase):
+    """
+    Tile cache of OSM data, with osmnx replaced by a function serving points inside the asked box
+    """
+    tags = {'amenity': True, 'leisure': True}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.downloads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def geometries_from_bbox(self, north, south, east, west, tags):
+        import geopandas as gpd
+        self.downloads.append((north, south, east, west))
+        if south >= 52.4:
+            # Overpass reports a box without points of interest as an error
+            raise type('InsufficientResponseError', (Exception, ), {})()
+        r = random.Random(f"{north:.6f}{west:.6f}")
+        (longitude, lattitude) = ([r.uniform(west, east) for _ in range(20)], [r.uniform(south, north) for _ in range(20)])
+        pois = gpd.GeoDataFrame({'amenity': ['cafe'] * 20, 'leisure': [None] * 20}, geometry=gpd.points_from_xy(longitude, lattitude), crs="EPSG:4326")
+        pois.index = [f"node/{x:.7f}:{y:.7f}" for (x, y) in zip(longitude, lattitude)]
+        return pois
+
+    def test_tiles(self):
+        tiles = cache.TileCache(self.directory, tile_size=0.05)
+        self.assertEqual(len(tiles.tiles(52.4, 52.3, -2.3, -2.2)), 4)
+        self.assertEqual(len(tiles.tiles(52.41, 52.3, -2.3, -2.2)), 6)
+        for tile in tiles.tiles(52.4, 52.3, -2.3, -2.2):
+            (north, south, west, east) = tiles.bounds(tile)
+            self.assertEqual(tiles.tiles(north, south, west, east), [tile])
+
+    def test_pois(self):
+        tiles = cache.TileCache(self.directory, tile_size=0.05, ttl=3600, offline=False)
+        with mock.patch.object(cache, 'ox', mock.Mock(geometries_from_bbox=self.geometries_from_bbox)):
+            pois = access.download_pois(52.35, -2.25, 0.08, self.tags, tiles=tiles)
+            self.assertEqual(len(self.downloads), 4)
+            self.assertTrue(pois.geometry.y.between(52.31, 52.39).all() and pois.geometry.x.between(-2.29, -2.21).all())
+            # Served from the tiles without downloading them again, also offline
+            self.assertEqual(sorted(access.download_pois(52.35, -2.25, 0.08, self.tags, tiles=tiles).index), sorted(pois.index))
+            offline = cache.TileCache(self.directory, tile_size=0.05, offline=True)
+            self.assertEqual(sorted(access.download_pois(52.35, -2.25, 0.08, self.tags, tiles=offline).index), sorted(pois.index))
+            self.assertEqual(len(self.downloads), 4)
+            # Tiles without points of interest are cached empty, missing tiles are skipped offline
+            self.assertEqual(len(tiles.pois(52.45, 52.4, -2.3, -2.25, self.tags)), 0)
+            self.assertEqual(len(self.downloads), 5)
+            self.assertEqual(len(tiles.pois(52.45, 52.4, -2.3, -2.25, self.tags)), 0)
+            self.assertEqual(len(self.downloads), 5)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                self.assertEqual(len(offline.pois(52.3, 52.25, -2.3, -2.25, self.tags)), 0)
+            self.assertEqual(len(caught), 1)
+            # Expired tiles are downloaded again
+            expired = cache.TileCache(self.directory, tile_size=0.05, ttl=0, offline=False)
+            expired.pois(52.4, 52.35, -2.3, -2.25, self.tags)
+            self.assertEqual(len(self.downloads), 6)
+
+    def test_graph(self):
+        import pandas as pd
+        import geopandas as gpd
+        from shapely.geometry import LineString
+        tiles = cache.TileCache(self.directory, tile_size=0.05, offline=True)
+        # An edge crossing the border of two tiles is stored in both and assembled once
+        edge = gpd.GeoDataFrame({'length': [100.0]}, geometry=[LineString([(-2.26, 52.32), (-2.24, 52.32)])], crs="EPSG:4326",
+                                index=pd.MultiIndex.from_tuples([(1, 2, 0)], names=['u', 'v', 'key']))
+        box = access.calculate_boundaries(52.325, -2.25, 0.1)
+        for (i, tile) in enumerate(tiles.tiles(*box)):
+            (north, south, west, east) = tiles.bounds(tile)
+            # One node per tile, inside the box
+            (lattitude, longitude) = ((max(south, box[1]) + min(north, box[0]))/2, (west + east)/2)
+            nodes = gpd.GeoDataFrame(geometry=gpd.points_from_xy([longitude], [lattitude]), index=pd.Index([i + 1], name='osmid'), crs="EPSG:4326")
+            tiles.put_graph(tile, nodes, edge)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            (nodes, edges) = access.download_graph(52.325, -2.25, 0.1, tiles=tiles)
+        self.assertEqual(len(nodes), len(tiles.tiles(*box)))
+        self.assertEqual(len(edges), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
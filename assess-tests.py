@@ -0,0 +1,204 @@
+# Tests of the assess part, run by .github/workflows/assess-tests.yml
+
+"""The data quality profiles run against embedded SQLite (and DuckDB when it is installed) databases
+filled with generated transactions and postcodes, and the maps are drawn from generated streets,
+points of interest and transactions, so the tests need neither a database server nor the network."""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import importlib.util
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.image
+import matplotlib.pyplot as plt
+
+from fynesse import access, assess
+from fynesse.backends import SCHEMA
+
+
+class HyperLogLogTests(unittest.TestCase):
+    """
+    Distinct counts against exact counts, at the sketch's error bound
+    """
+    def bound(self, precision):
+        # Three standard errors
+        return 3*1.04/np.sqrt(1 << precision)
+
+    def test_error_bounds(self):
+        r = np.random.default_rng(0)
+        for (precision, distinct) in [(12, 50), (12, 3000), (12, 200000), (10, 50000), (14, 100000)]:
+            values = r.integers(0, 1 << 62, distinct)
+            sketch = assess.HyperLogLog(precision)
+            # Every value three times, in chunks
+            for chunk in np.array_split(np.concatenate([values, values, values]), 7):
+                sketch.update(chunk)
+            exact = len(np.unique(values))
+            self.assertLess(abs(sketch.count()/exact - 1), self.bound(precision), (precision, distinct))
+
+    def test_strings(self):
+        values = pd.Series([f"AB{i % 5000} {i % 7}XY" for i in range(40000)] + [None]*100, dtype=object)
+        sketch = assess.HyperLogLog()
+        sketch.update(values)
+        self.assertLess(abs(sketch.count()/values.nunique() - 1), self.bound(12))
+
+    def test_merge(self):
+        values = np.arange(100000)
+        (whole, first, second) = (assess.HyperLogLog(), assess.HyperLogLog(), assess.HyperLogLog())
+        whole.update(values)
+        first.update(values[:60000])
+        second.update(values[40000:])
+        np.testing.assert_array_equal(first.merge(second).registers, whole.registers)
+        self.assertEqual(assess.HyperLogLog().count(), 0)
+
+
+class ProfileTests:
+    """
+    Tests run once per backend, by the TestCase subclasses below
+    """
+    backend = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.' + self.backend)
+        self.conn = access.create_connection(backend=self.backend, path=self.path)
+        r = random.Random(0)
+        # Postcodes with one missing coordinate, one at (0, 0) and one in France
+        points = [(50 + r.random()*5, -4 + r.random()*4) for _ in range(47)] + [(None, -1.0), (0.0, 0.0), (48.85, 2.35)]
+        postcodes = []
+        for (i, (lattitude, longitude)) in enumerate(points):
+            fields = dict.fromkeys(access.POSTCODE_COLUMNS)
+            fields.update(postcode=f"AB{i % 9} {i}XY", status='live', country='England', lattitude=lattitude, longitude=longitude,
+                          postcode_district=f"AB{i % 9}", easting=str(i*100))
+            postcodes.append([fields[column] for column in access.POSTCODE_COLUMNS])
+        # Transactions on known postcodes, ten without a postcode and twenty on postcodes not in postcode_data
+        self.postcodes = [f"AB{i % 9} {i}XY" for i in range(len(points))]
+        codes = [self.postcodes[i % len(points)] for i in range(3000)] + [''] * 10 + [f"ZZ9 {i}ZZ" for i in range(20)]
+        self.prices = [int(r.lognormvariate(12, 0.6)) for _ in codes]
+        transactions = [[f"{{T{i}}}", price, f"{2015 + i % 5}-{1 + i % 12:02d}-{1 + i % 28:02d}", code, 'DSTFO'[i % 5], 'N', 'F',
+                         str(i), '', 'HIGH ST', 'LOC', 'TOWN', 'DIST', 'COUNTY', 'A', 'A'] for (i, (price, code)) in enumerate(zip(self.prices, codes))]
+        access.create_tables(self.conn, ['pp_data', 'postcode_data'])
+        backend = access.backend_of(self.conn)
+        backend.insert_rows(self.conn, 'postcode_data', access.POSTCODE_COLUMNS, postcodes)
+        backend.insert_rows(self.conn, 'pp_data', [column for (column, _) in SCHEMA['pp_data']], transactions)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def connect(self):
+        return access.create_connection(backend=self.backend, path=self.path)
+
+    def test_join_miss_rate(self):
+        self.assertEqual(assess.join_miss_rate(self.conn), {'transactions': 3030, 'no_postcode': 10, 'unknown_postcode': 20, 'miss_rate': 30/3030})
+
+    def test_profile_dataset(self):
+        report = assess.profile_dataset(self.conn, chunksize=700)
+        transactions = report['pp_data']
+        self.assertEqual(transactions['rows'], 3030)
+        self.assertEqual(transactions['columns']['postcode']['empty_rate'], 10/3030)
+        self.assertLess(abs(transactions['columns']['postcode']['distinct']/(len(self.postcodes) + 21) - 1), 0.05)
+        self.assertLess(abs(transactions['columns']['transaction_unique_identifier']['distinct']/3030 - 1), 0.05)
+        self.assertEqual((transactions['columns']['price']['min'], transactions['columns']['price']['max']), (min(self.prices), max(self.prices)))
+        median = sorted(self.prices)[len(self.prices)//2]
+        self.assertLess(abs(transactions['columns']['price']['quantiles']['q0.5']/median - 1), 0.05)
+        self.assertEqual(report['postcode_data']['coordinates'], {'checked': 50, 'missing': 1, 'zero': 1, 'outside_uk': 1})
+        self.assertEqual(report['postcode_data']['columns']['lattitude']['null_rate'], 1/50)
+        self.assertEqual(report['join']['miss_rate'], 30/3030)
+
+    def test_profile_workers(self):
+        # Parallel workers profile db_id ranges; the merged report equals the serial one
+        serial = assess.profile_dataset(self.conn, chunksize=500)
+        with access.ConnectionPool(size=3, connect=self.connect) as pool:
+            parallel = assess.profile_dataset(pool, chunksize=500, workers=3)
+            self.assertRaises(ValueError, assess.profile_table, self.conn, 'pp_data', ['price'], workers=2)
+        self.assertEqual(serial, parallel)
+
+
+class SQLiteProfileTests(ProfileTests, unittest.TestCase):
+    backend = 'sqlite'
+
+@unittest.skipUnless(importlib.util.find_spec('duckdb'), "duckdb is not installed")
+class DuckDBProfileTests(ProfileTests, unittest.TestCase):
+    backend = 'duckdb'
+
+
+class MapTests(unittest.TestCase):
+    """
+    Maps of a 0.1 degree box around (52.35, -2.25): a street grid, points of interest and transactions
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        r = np.random.default_rng(0)
+        streets = [f"LINESTRING ({x} 52.3, {x} 52.4)" for x in np.arange(-2.3, -2.2, 0.01)] + \
+                  [f"LINESTRING (-2.3 {y}, -2.2 {y})" for y in np.arange(52.3, 52.4, 0.01)]
+        self.edges = gpd.GeoDataFrame(geometry=gpd.GeoSeries.from_wkt(streets), crs="EPSG:4326")
+        self.pois = gpd.GeoDataFrame({'amenity': ['cafe']*30}, geometry=gpd.points_from_xy(-2.3 + r.random(30)*0.1, 52.3 + r.random(30)*0.1), crs="EPSG:4326")
+        self.data = pd.DataFrame({'lattitude': 52.3 + r.random(500)*0.1, 'longitude': -2.3 + r.random(500)*0.1,
+                                  'price': r.lognormal(12, 0.5, 500).astype(int)})
+
+    def tearDown(self):
+        plt.close('all')
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def slippy_tile(self, latitude, longitude, zoom):
+        # The usual formula of the XYZ tile of a point
+        n = 2**zoom
+        return (zoom, int((longitude + 180)/360*n), int((1 - np.arcsinh(np.tan(np.radians(latitude)))/np.pi)/2*n))
+
+    def test_render_tiles(self):
+        directory = os.path.join(self.directory, 'tiles')
+        paths = assess.render_tiles(self.pois, self.edges, self.data, 52.4, 52.3, -2.3, -2.2, zooms=range(10, 14), directory=directory)
+        written = sorted(os.path.relpath(os.path.join(root, name), directory) for (root, _, names) in os.walk(directory) for name in names)
+        self.assertEqual(written, sorted(os.path.relpath(path, directory) for path in paths))
+        tiles = {tuple(int(part) for part in name[:-len('.png')].split(os.sep)) for name in written}
+        # Every tile with a transaction is drawn, only tiles covering the region are
+        with_points = {self.slippy_tile(lattitude, longitude, zoom) for zoom in range(10, 14) for (lattitude, longitude) in zip(self.data.lattitude, self.data.longitude)}
+        self.assertLessEqual(with_points, tiles)
+        self.assertLessEqual(tiles, {tile for zoom in range(10, 14) for tile in assess.tiles_covering(52.4, 52.3, -2.3, -2.2, zoom)})
+        self.assertEqual({tile[0] for tile in tiles}, {10, 11, 12, 13})
+        for tile in with_points:
+            image = matplotlib.image.imread(os.path.join(directory, *map(str, tile)) + '.png')
+            self.assertEqual(image.shape[:2], (assess.TILE_PIXELS, assess.TILE_PIXELS))
+            self.assertGreater(image[:, :, 3].max(), 0)
+
+        # Worker processes draw the same tiles
+        parallel = assess.render_tiles(self.pois, self.edges, self.data, 52.4, 52.3, -2.3, -2.2, zooms=range(10, 14),
+                                       directory=os.path.join(self.directory, 'parallel'), workers=2, aggregate='grid')
+        self.assertEqual([os.path.relpath(path, os.path.join(self.directory, 'parallel')) for path in parallel],
+                         [os.path.relpath(path, directory) for path in paths])
+        for (path, other) in zip(paths, parallel):
+            np.testing.assert_array_equal(matplotlib.image.imread(path), matplotlib.image.imread(other))
+
+    def test_tile_bounds(self):
+        for (latitude, longitude) in [(52.35, -2.25), (0.5, 0.5), (-33.9, 151.2)]:
+            (north, south, west, east) = assess.tile_bounds(*self.slippy_tile(latitude, longitude, 12))
+            self.assertTrue(south <= latitude <= north and west <= longitude <= east)
+
+    def test_plot_points_interest(self):
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            os.makedirs('maps')
+            # Raster maps take plain transactions and are drawn at the asked resolution
+            assess.plot_points_interest(self.pois, self.edges, self.data, raster=True, pixels=512)
+            image = matplotlib.image.imread(os.path.join('maps', 'health-care-pois.png'))
+            self.assertEqual(image.shape[:2], (512, 512))
+            assess.plot_points_interest(self.pois, self.edges, self.data, raster=True, pixels=256, aggregate='hexbin')
+            self.assertEqual(matplotlib.image.imread(os.path.join('maps', 'health-care-pois.png')).shape[:2], (256, 256))
+            # Vector maps draw a GeoDataFrame of the transactions
+            assess.plot_points_interest(self.pois, self.edges, assess.to_gdf(self.data))
+            self.assertTrue(os.path.getsize(os.path.join('maps', 'health-care-pois.svg')) > 0)
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
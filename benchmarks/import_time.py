@@ -0,0 +1,61 @@
+# This file measures the import time of the fynesse package
+
+"""Import time: importing fynesse (and the access module, for jobs that only load data or compute
+boundaries) should be fast and should not import the heavy dependencies, which are loaded lazily on
+first use. The budget is enforced in CI by ImportTests in access-tests.py; this reports the numbers.
+
+    python benchmarks/import_time.py
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Dependencies that importing fynesse.access must not pull in
+HEAVY = ['pandas', 'numpy', 'osmnx', 'geopandas', 'statsmodels', 'scipy', 'matplotlib', 'mlai', 'pymysql', 'requests', 'yaml', 'pyarrow']
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import fynesse
+from fynesse import access
+access.calculate_boundaries(52.35, -2.25, 0.1)
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'heavy': [name for name in %r if name in sys.modules]}))
+""" % (HEAVY,)
+
+
+def import_time(repeat = 5):
+    """
+    Time `import fynesse; from fynesse import access` in fresh interpreters
+
+    Arguments:
+      repeat : int - interpreters to start
+    Output:
+      (seconds, heavy) : (double, list(string)) - median import time, heavy modules that were imported
+    """
+    times = []
+    heavy = set()
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT))
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        times.append(result['seconds'])
+        heavy.update(result['heavy'])
+    return (statistics.median(times), sorted(heavy))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    (seconds, heavy) = import_time(args.repeat)
+    print(f"import fynesse.access: {seconds*1000:.1f} ms")
+    if heavy:
+        print(f"Heavy dependencies imported eagerly: {', '.join(heavy)}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,396 @@
+# This file runs the benchmarks of the access, assess and address hot paths
+
+"""Benchmarks of the fynesse hot paths on synthetic data, with no network: an embedded database
+stands in for MariaDB and an offline tile cache of fixture points of interest stands in for OSM.
+
+    python benchmarks/run.py --transactions 100000 --output results.json
+    python benchmarks/run.py --compare baseline.json results.json
+
+Every benchmark reports p50/p95/mean latency over its repeats, rows/s where it processes rows, and
+peak python memory from tracemalloc (allocations made inside the database engine are not seen). The
+results are JSON tagged with the commit, so runs on different commits can be compared. """
+
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import inspect
+import platform
+import tempfile
+import functools
+import threading
+import subprocess
+import tracemalloc
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fynesse import access, assess, address, features
+from fynesse.cache import ExtractCache
+from fynesse.features import FeatureStore
+import synthetic
+import import_time
+
+LATITUDE, LONGITUDE, SIZE = 52.35, -2.25, 0.1
+DATE_MIN, DATE_MAX = '2017-01-01', '2019-12-31'
+
+# Public functions of access, assess and address without a benchmark of their own, and why
+SKIPPED = {
+    'access.create_connection': "connection setup, paid once per process",
+    'access.create_tables': "one-off DDL",
+    'access.ConnectionPool': "connection setup, used by the pooled benchmarks",
+    'access.checkout': "pool bookkeeping inside every benchmark taking a pool",
+    'access.dedicated': "pool bookkeeping inside every benchmark taking a pool",
+    'access.load': "the LOAD DATA path access.load_transaction_file benchmarks",
+    'access.load_transactions': "downloads the Land Registry files, its load path is access.ingest",
+    'access.load_transactions_pipelined': "downloads the Land Registry files, its load path is access.ingest",
+    'access.sync_transactions': "downloads the Land Registry files, built of access.ingest, access.reload_year and access.apply_transaction_delta",
+    'access.transaction_urls': "string formatting",
+    'access.download_file': "network I/O, measured inside access.ingest",
+    'access.head_file': "one HEAD request per file",
+    'access.read_manifest': "sync bookkeeping on a small JSON file",
+    'access.manifest_version': "sync bookkeeping on a small JSON file",
+    'access.write_manifest': "sync bookkeeping on a small JSON file",
+    'access.read_transaction_delta': "parses the monthly update file, small next to the upsert access.apply_transaction_delta benchmarks",
+    'access.delta_month': "sync bookkeeping",
+    'access.latest_month': "one MAX query",
+    'access.stream_zip_member': "inside access.load_postcodes",
+    'access.project_lines': "inside access.load_postcodes",
+    'access.bind': "query building inside every fetch benchmark",
+    'access.price_location_query': "query building inside every fetch benchmark",
+    'access.ensure_indexes': "one-off DDL",
+    'access.explain': "diagnostics",
+    'access.typed_frame': "casting inside every fetch benchmark",
+    'access.apply_schema': "casting inside every fetch benchmark",
+    'access.concat_frames': "inside access.joinPriceAndLocationData",
+    'access.iter_query': "inside access.iterPriceAndLocationData and access.iter_fetch_data",
+    'access.merge_sketches': "inside access.query_rollups",
+    'access.sketch_quantile': "inside access.query_rollups",
+    'access.rollup_level': "string formatting",
+    'access.rollup_cell': "string formatting",
+    'access.calculate_boundaries': "arithmetic",
+    'access.download_graph': "the fixture tile cache holds no street graphs and OSM needs the network",
+    'assess.to_gdf': "inside assess.download_data_to_gdf",
+    'assess.setup_plotting': "matplotlib settings",
+    'assess.plot_points_interest': "writes a figure to ./maps, its raster drawing is the one assess.render_tiles benchmarks",
+    'assess.map_layers': "inside assess.render_tiles",
+    'assess.price_range': "inside assess.render_tiles",
+    'assess.tile_bounds': "inside assess.render_tiles",
+    'assess.tiles_covering': "inside assess.render_tiles",
+    'assess.plot_data': "a matplotlib scatter plot of a fetched frame",
+    'assess.HyperLogLog': "inside assess.profile_dataset",
+    'assess.ColumnProfile': "inside assess.profile_dataset",
+    'assess.TableProfile': "inside assess.profile_dataset",
+    'assess.profile_table': "inside assess.profile_dataset",
+    'address.date_window': "date arithmetic",
+    'address.model_columns': "inside address.predict_price",
+    'address.design_matrix': "inside address.predict_price",
+    'address.fit_model': "inside address.predict_price",
+    'address.ModelRegistry': "benchmarked by address.predict_price[registry]",
+    'address.spatial_folds': "inside address.sweep",
+    'address.sweep_features': "inside address.sweep",
+}
+
+
+def measure(function, repeat = 5, rows = None, memory = True):
+    """
+    Time repeated calls of a function, then measure the peak memory of one more call
+
+    Arguments:
+      function : function - called without arguments, may return the number of rows it processed
+      repeat : int - timed calls
+      rows : int - rows processed per call, overrides the return value
+      memory : bool - trace the peak memory of an extra call
+    Output:
+      result : dictionary - p50, p95, mean (seconds), rows, rows_per_s and peak_bytes
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        returned = function()
+        times.append(time.perf_counter() - start)
+    if rows is None and isinstance(returned, (int, np.integer)):
+        rows = int(returned)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    p50 = float(np.percentile(times, 50))
+    return {'p50': p50, 'p95': float(np.percentile(times, 95)), 'mean': float(np.mean(times)), 'repeat': repeat,
+            'rows': rows, 'rows_per_s': rows/p50 if rows and p50 > 0 else None, 'peak_bytes': peak}
+
+def serve(directory):
+    """
+    Serve a directory over http on a free local port, standing in for the download sites
+
+    Output:
+      base_url : string - url of the directory
+    """
+    handler = type('QuietHandler', (SimpleHTTPRequestHandler, ), {'log_message': lambda self, *args: None})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+def uncovered(names):
+    """
+    Public functions and classes of access, assess and address that are neither benchmarked nor in SKIPPED
+
+    Arguments:
+      names : iterable(string) - benchmark names, e.g. 'access.load' or 'address.predict_price[registry]'
+    Output:
+      names : list(string) - e.g. ['access.new_function']
+    """
+    covered = {name.split('[')[0] for name in names} | set(SKIPPED)
+    public = [f"{module.__name__.split('.')[-1]}.{name}" for module in (access, assess, address)
+              for (name, value) in vars(module).items()
+              if not name.startswith('_') and (inspect.isfunction(value) or inspect.isclass(value)) and value.__module__ == module.__name__]
+    return sorted(name for name in public if name not in covered)
+
+def benchmarks(directory, transactions, postcodes, backend, queries):
+    """
+    The benchmarks, as name mapped to (function, repeat), sharing one synthetic database
+
+    Arguments:
+      directory : string - scratch directory
+      transactions, postcodes : int - scale of the synthetic data
+      backend : string - embedded backend standing in for MariaDB
+      queries : int - points per batch prediction
+    Output:
+      cases : dictionary - name mapped to (function, repeat)
+    """
+    (path, files) = synthetic.build_database(os.path.join(directory, 'data'), transactions, postcodes, backend)
+    tiles = synthetic.fixture_tiles(os.path.join(directory, 'tiles'))
+    conn = access.create_connection(backend = backend, path = path)
+    pool = access.ConnectionPool(4, backend = backend, path = path)
+    access.create_tables(conn, ['prices_coordinates_data'])
+    box = (LONGITUDE - SIZE/2, LONGITUDE + SIZE/2, LATITUDE - SIZE/2, LATITUDE + SIZE/2, DATE_MIN, DATE_MAX)
+    pois = access.download_pois(LATITUDE, LONGITUDE, SIZE, tiles = tiles)
+    data = access.joinPriceAndLocationData(conn, *box)
+    rng = np.random.default_rng(0)
+    points = pd.DataFrame({'latitude': LATITUDE + (rng.random(queries) - 0.5)*SIZE*2,
+                           'longitude': LONGITUDE + (rng.random(queries) - 0.5)*SIZE*2,
+                           'date': '2018-06-01', 'property_type': rng.choice(list('DSTFO'), queries)})
+    extracts = ExtractCache(os.path.join(directory, 'extracts'), max_bytes = 1 << 30)
+    extracts.get(conn, *box)
+    models = address.ModelRegistry(max_models = 64)
+    store = FeatureStore(os.path.join(directory, 'features'))
+    edges = synthetic.street_edges()
+
+    # The transactions split into part files and the postcodes zipped, on a local server
+    served = os.path.join(directory, 'served')
+    os.makedirs(served)
+    os.makedirs(os.path.join(directory, 'downloads'))
+    with open(files['pp_data']) as file:
+        lines = file.readlines()
+    parts = []
+    for part in range(4):
+        parts.append(f"pp-part{part}.csv")
+        with open(os.path.join(served, parts[-1]), 'w') as file:
+            file.writelines(lines[part::4])
+    with zipfile.ZipFile(os.path.join(served, 'postcodes.zip'), 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.write(files['postcode_data'], 'open_postcode_geo.csv')
+    base_url = serve(served)
+    # A year of transactions to reload, and an update changing the prices of a thousand transactions
+    year = os.path.join(directory, 'pp-2018.csv')
+    with open(year, 'w') as file:
+        file.writelines(line for line in lines if '","2018-' in line)
+    delta = [row for row in access.read_transaction_delta(year)[:1000]]
+    for row in delta:
+        (row[1], row[-1]) = (row[1] + 1, 'C')
+
+    def load():
+        scratch = os.path.join(directory, f"load.{backend}")
+        if os.path.exists(scratch):
+            os.remove(scratch)
+        target = access.create_connection(backend = backend, path = scratch)
+        access.create_tables(target, ['pp_data'])
+        return access.load_transaction_file(target, 'pp_data', files['pp_data'])
+
+    def materialize():
+        cur = conn.cursor()
+        cur.execute("DELETE FROM prices_coordinates_data")
+        cur.execute("DROP TABLE IF EXISTS materialized_partitions")
+        conn.commit()
+        return int(access.materialize_prices_coordinates(pool, *box, cell_size = 0.05, workers = 4 if backend == 'duckdb' else 1).rows.sum())
+
+    def scratch_database(name, tables):
+        path = os.path.join(directory, f"{name}.{backend}")
+        if os.path.exists(path):
+            os.remove(path)
+        target = access.create_connection(backend = backend, path = path)
+        access.create_tables(target, tables)
+        target.close()
+        return (lambda: access.create_connection(backend = backend, path = path))
+
+    def ingest():
+        connect = scratch_database('ingest', ['pp_data'])
+        return int(access.ingest([base_url + part for part in parts], connect, 'pp_data', directory = os.path.join(directory, 'downloads')).rows.sum())
+
+    def load_postcodes():
+        target = scratch_database('postcodes', ['postcode_data'])()
+        try:
+            return access.load_postcodes(target, {}, url = base_url + 'postcodes.zip')
+        finally:
+            target.close()
+
+    def join_and_store():
+        cur = conn.cursor()
+        cur.execute("DELETE FROM prices_coordinates_data")
+        conn.commit()
+        access.joinAndStorePriceAndLocationData(conn, *box)
+
+    def stream():
+        return sum(len(chunk) for chunk in access.iterPriceAndLocationData(conn, *box, chunksize = 10000))
+
+    def sketch():
+        access.price_sketch(data.price.to_numpy())
+        return len(data)
+
+    def tiles_pyramid():
+        return len(assess.render_tiles(pois, edges, data, LATITUDE + SIZE/2, LATITUDE - SIZE/2, LONGITUDE - SIZE/2, LONGITUDE + SIZE/2,
+                                       zooms = range(10, 14), directory = os.path.join(directory, 'maps')))
+
+    def registry():
+        for point in points.itertuples():
+            address.predict_price(conn, point.latitude, point.longitude, point.date, point.property_type, SIZE, tiles = tiles, models = models)
+        return len(points)
+
+    return {'access.load_transaction_file': (load, 3),
+            'access.ingest': (ingest, 3),
+            'access.load_postcodes': (load_postcodes, 3),
+            'access.apply_transaction_delta': (lambda: sum(access.apply_transaction_delta(conn, 'pp_data', delta).values()), 3),
+            'access.reload_year': (lambda: access.reload_year(conn, 'pp_data', 2018, year), 3),
+            'access.joinAndStorePriceAndLocationData': (join_and_store, 3),
+            'access.joinPriceAndLocationData': (lambda: len(access.joinPriceAndLocationData(conn, *box)), 10),
+            'access.iterPriceAndLocationData': (stream, 10),
+            'access.fetch_data': (lambda: len(access.fetch_data(conn, 'postcode_data', access.POSTCODE_COLUMNS + ['db_id'])), 5),
+            'access.iter_fetch_data': (lambda: sum(len(chunk) for chunk in access.iter_fetch_data(conn, 'pp_data', ['db_id', 'price', 'date_of_transfer', 'postcode'])), 5),
+            'access.materialize_prices_coordinates': (materialize, 3),
+            'access.materialize_rollups': (lambda: access.materialize_rollups(conn, from_month = '1995-01'), 3),
+            'access.query_rollups': (lambda: len(access.query_rollups(conn)), 10),
+            'access.price_sketch': (sketch, 10),
+            'access.download_pois': (lambda: len(access.download_pois(LATITUDE, LONGITUDE, SIZE, tiles = tiles)), 10),
+            'cache.ExtractCache.get': (lambda: len(extracts.get(conn, *box)), 10),
+            'features.poi_features': (lambda: len(features.poi_features(data.longitude, data.lattitude, pois)), 10),
+            'assess.download_data_to_gdf': (lambda: len(assess.download_data_to_gdf(conn, LATITUDE, LONGITUDE, SIZE, DATE_MIN, DATE_MAX)), 10),
+            'assess.render_tiles': (tiles_pyramid, 3),
+            'assess.join_miss_rate': (lambda: assess.join_miss_rate(conn)['transactions'], 5),
+            'assess.profile_dataset': (lambda: assess.profile_dataset(pool, workers = 4 if backend == 'duckdb' else 1)['pp_data']['rows'], 3),
+            'address.add_poi_features': (lambda: len(address.add_poi_features(data.copy(), pois, store)), 10),
+            'address.predict_price': (lambda: address.predict_price(conn, LATITUDE, LONGITUDE, '2018-06-01', 'D', SIZE, tiles = tiles) is not None, 10),
+            'address.predict_price[registry]': (registry, 3),
+            'address.predict_prices': (lambda: len(address.predict_prices(conn, points, SIZE, tiles = tiles)), 3),
+            'address.sweep': (lambda: len(address.sweep(conn, LATITUDE, LONGITUDE, '2018-06-01', SIZE, tiles = tiles)), 3)}
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def run(transactions = 100000, postcodes = 5000, backend = 'duckdb', queries = 50, only = None, memory = True, directory = None):
+    """
+    Run the benchmarks
+
+    Arguments:
+      transactions, postcodes : int - scale of the synthetic data
+      backend : string - embedded backend standing in for MariaDB
+      queries : int - points per batch prediction
+      only : list(string) - run only benchmarks whose name contains one of these, all if None
+      memory : bool - measure peak memory
+      directory : string - scratch directory, a temporary one if None
+    Output:
+      results : dictionary - machine readable results
+    """
+    scratch = directory or tempfile.mkdtemp(prefix='fynesse-bench-')
+    try:
+        start = time.perf_counter()
+        cases = benchmarks(scratch, transactions, postcodes, backend, queries)
+        setup = time.perf_counter() - start
+        results = {}
+        if not only or any(pattern in 'import' for pattern in only):
+            (seconds, heavy) = import_time.import_time()
+            results['import fynesse.access'] = {'p50': seconds, 'p95': seconds, 'mean': seconds, 'repeat': 5, 'rows': None,
+                                                'rows_per_s': None, 'peak_bytes': None, 'heavy_imports': heavy}
+        missing = uncovered(cases)
+        if missing:
+            print(f"Not benchmarked and not in SKIPPED: {', '.join(missing)}", file=sys.stderr)
+        for (name, (function, repeat)) in cases.items():
+            if only and not any(pattern in name for pattern in only):
+                continue
+            results[name] = measure(function, repeat, memory = memory)
+            print(f"{name:45s} p50 {results[name]['p50']*1000:9.1f} ms  p95 {results[name]['p95']*1000:9.1f} ms" +
+                  (f"  {results[name]['rows_per_s']:12,.0f} rows/s" if results[name]['rows_per_s'] else ''), file=sys.stderr)
+    finally:
+        if directory is None:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return {'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'backend': backend, 'scale': {'transactions': transactions, 'postcodes': postcodes, 'queries': queries},
+            'setup_seconds': setup, 'results': results, 'skipped': SKIPPED}
+
+def compare(baseline, current, threshold = 0.2):
+    """
+    Compare two result files benchmark by benchmark
+
+    Arguments:
+      baseline, current : dictionary - results of run
+      threshold : double - relative p50 slowdown (or peak memory growth) reported as a regression
+    Output:
+      (table, regressions) : (DataFrame, list(string)) - ratios per benchmark, and names of regressed benchmarks
+    """
+    rows = []
+    for (name, new) in current['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        memory = new['peak_bytes']/old['peak_bytes'] if new.get('peak_bytes') and old.get('peak_bytes') else None
+        rows.append({'benchmark': name, 'p50_old': old['p50'], 'p50_new': new['p50'], 'p50_ratio': new['p50']/old['p50'],
+                     'p95_ratio': new['p95']/old['p95'], 'memory_ratio': memory})
+    table = pd.DataFrame(rows, columns = ['benchmark', 'p50_old', 'p50_new', 'p50_ratio', 'p95_ratio', 'memory_ratio'])
+    regressions = [row['benchmark'] for row in rows if row['p50_ratio'] > 1 + threshold or (row['memory_ratio'] or 0) > 1 + threshold]
+    return (table, regressions)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--postcodes', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=50, help='points per batch prediction')
+    parser.add_argument('--backend', default='duckdb', choices=['duckdb', 'sqlite'])
+    parser.add_argument('--only', nargs='*', help='run only benchmarks whose name contains one of these')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--output', help='write the results to this JSON file, stdout if not given')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help='compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown reported as a regression')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as file:
+            baseline = json.load(file)
+        with open(args.compare[1]) as file:
+            current = json.load(file)
+        (table, regressions) = compare(baseline, current, args.threshold)
+        print(table.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+        if regressions:
+            print(f"Regressions beyond {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+        return 0
+
+    results = run(args.transactions, args.postcodes, args.backend, args.queries, args.only, not args.no_memory)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+# This file generates the synthetic data the benchmarks run on
+
+"""Synthetic Land Registry price paid and open postcode geo files, in the formats of the real
+downloads, plus a fixture set of points of interest stored in an offline TileCache. Everything is
+seeded, so two runs at the same scale benchmark exactly the same data. """
+
+import os
+import random
+import datetime
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from fynesse import access
+from fynesse.cache import TileCache
+
+# Box the synthetic postcodes and points of interest are spread over, centred on predict_price's defaults
+NORTH, SOUTH, WEST, EAST = 52.5, 52.2, -2.4, -2.1
+
+
+def postcode_names(postcodes):
+    """
+    Distinct postcodes like 'AB12 3CD', one per index
+    """
+    letters = 'ABDEFGHJLNPQRSTUWXYZ'
+    return [f"{letters[i % 20]}{letters[i//20 % 20]}{i//400 % 100} {i//40000 % 10}{letters[i//7 % 20]}{letters[i//3 % 20]}" for i in range(postcodes)]
+
+def write_postcodes(path, postcodes = 5000, seed = 0):
+    """
+    Write an open postcode geo style csv (unquoted, POSTCODE_COLUMNS) of postcodes spread over the box
+
+    Arguments:
+      path : string - csv file to write
+      postcodes : int - number of postcodes
+      seed : int - random seed
+    Output:
+      names : list(string) - the postcodes written
+    """
+    rng = random.Random(seed)
+    names = postcode_names(postcodes)
+    with open(path, 'w') as file:
+        for (i, name) in enumerate(names):
+            (outcode, incode) = name.split()
+            lattitude = SOUTH + rng.random()*(NORTH - SOUTH)
+            longitude = WEST + rng.random()*(EAST - WEST)
+            fields = [name, 'live', 'small', str(380000 + i), str(260000 + i), '1', 'England', f"{lattitude:.6f}", f"{longitude:.6f}",
+                      name.replace(' ', ''), name, name, outcode[:2], outcode, name[:-2], outcode, incode]
+            file.write(','.join(fields) + '\n')
+    return names
+
+def write_transactions(path, postcodes, transactions = 100000, start_year = 2015, end_year = 2020, seed = 0):
+    """
+    Write a Land Registry price paid style csv (quoted, 16 columns) of transactions on the given postcodes
+
+    Arguments:
+      path : string - csv file to write
+      postcodes : list(string) - postcodes the transactions are spread over
+      transactions : int - number of transactions
+      start_year, end_year : int - years the transactions are spread over
+      seed : int - random seed
+    Output:
+      N/A
+    """
+    rng = random.Random(seed)
+    start = datetime.date(start_year, 1, 1)
+    days = (datetime.date(end_year, 12, 31) - start).days
+    counties = [f"COUNTY {i}" for i in range(8)]
+    with open(path, 'w') as file:
+        for i in range(transactions):
+            date = start + datetime.timedelta(days=rng.randrange(days + 1))
+            property_type = rng.choice('DSTFO')
+            # Log-normal prices, higher for detached houses, so the models have something to fit
+            price = int(rng.lognormvariate(12.4 + (0.4 if property_type == 'D' else 0), 0.5))
+            fields = [f"{{{i:08d}-0000-0000-0000-000000000000}}", str(price), f"{date.isoformat()} 00:00", rng.choice(postcodes),
+                      property_type, rng.choice('YN'), rng.choice('FL'), str(rng.randrange(1, 200)), '', 'HIGH STREET',
+                      'LOCALITY', 'TOWN', 'DISTRICT', rng.choice(counties), 'A', 'A']
+            file.write('"' + '","'.join(fields) + '"\n')
+
+def fixture_tiles(directory, per_tile = 40, seed = 0):
+    """
+    Fill an offline TileCache with points of interest (amenities and leisure) covering the box, so
+    download_pois(tiles = ...) never touches the network
+
+    Arguments:
+      directory : string - tile cache directory
+      per_tile : int - points of interest per tile
+      seed : int - random seed
+    Output:
+      tiles : TileCache - offline tile cache holding the fixture
+    """
+    tiles = TileCache(directory, offline = True)
+    rng = np.random.default_rng(seed)
+    # One tile of margin, since predictions near the edge ask for POIs around the point
+    margin = tiles.tile_size
+    for tile in tiles.tiles(NORTH + margin, SOUTH - margin, WEST - margin, EAST + margin):
+        (north, south, west, east) = tiles.bounds(tile)
+        half = per_tile//2
+        index = pd.MultiIndex.from_tuples([('node', abs(hash(tile)) % 10**9 * 1000 + i) for i in range(per_tile)], names=['element_type', 'osmid'])
+        pois = gpd.GeoDataFrame({'amenity': ['cafe']*half + [None]*(per_tile - half),
+                                 'leisure': [None]*half + ['park']*(per_tile - half)},
+                                geometry=gpd.points_from_xy(west + rng.random(per_tile)*(east - west), south + rng.random(per_tile)*(north - south)),
+                                index=index, crs="EPSG:4326")
+        tiles.put_pois(tile, access.POI_TAGS, pois)
+    return tiles
+
+def street_edges(spacing = 0.005):
+    """
+    A grid of straight streets over the box, standing in for the street graph edges of download_graph
+
+    Arguments:
+      spacing : double - distance between parallel streets in degrees
+    Output:
+      edges : GeoDataFrame - one LineString per street
+    """
+    lines = [((longitude, SOUTH), (longitude, NORTH)) for longitude in np.arange(WEST, EAST, spacing)]
+    lines += [((WEST, latitude), (EAST, latitude)) for latitude in np.arange(SOUTH, NORTH, spacing)]
+    return gpd.GeoDataFrame(geometry=gpd.GeoSeries.from_wkt([f"LINESTRING ({x0} {y0}, {x1} {y1})" for ((x0, y0), (x1, y1)) in lines]), crs="EPSG:4326")
+
+def build_database(directory, transactions = 100000, postcodes = 5000, backend = 'duckdb', seed = 0):
+    """
+    Write the synthetic csv files and load them into a fresh embedded database
+
+    Arguments:
+      directory : string - directory for the csv files and the database file
+      transactions : int - number of transactions
+      postcodes : int - number of postcodes
+      backend : string - embedded backend, 'duckdb' or 'sqlite'
+      seed : int - random seed
+    Output:
+      (path, files) : (string, dictionary) - database file, and csv file of each table
+    """
+    os.makedirs(directory, exist_ok=True)
+    files = {'postcode_data': os.path.join(directory, 'postcodes.csv'), 'pp_data': os.path.join(directory, 'pp.csv')}
+    names = write_postcodes(files['postcode_data'], postcodes, seed)
+    write_transactions(files['pp_data'], names, transactions, seed = seed)
+    path = os.path.join(directory, f"fynesse.{backend}")
+    if os.path.exists(path):
+        os.remove(path)
+    conn = access.create_connection(backend = backend, path = path)
+    access.create_tables(conn)
+    access.load(conn, 'postcode_data', files['postcode_data'], ',', '', '\n')
+    access.load_transaction_file(conn, 'pp_data', files['pp_data'])
+    access.ensure_indexes(conn, ['pp_data', 'postcode_data'])
+    return (path, files)
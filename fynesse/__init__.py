@@ -1,3 +1,15 @@
-from . import access
-from . import assess
-from . import address
+import importlib
+
+# Submodules are imported on first access (PEP 562), so `import fynesse` stays cheap
+__all__ = ['access', 'assess', 'address', 'backends', 'cache', 'features', 'instrument', 'service']
+
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module(f".{name}", __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,22 +1,151 @@
 from .config import *
+from .backends import *
+from . import instrument
 
-import pymysql
+import os
+import json
+import hashlib
+import contextlib
+import csv
+import datetime
+import errno
+import math
+import queue
+import tempfile
+import threading
+import time
+import zlib
 import urllib.request
-from progressbar import ProgressBar
-import zipfile
-import requests
-import pandas as pd
-import osmnx as ox
+from concurrent.futures import ThreadPoolExecutor
+from .lazy import lazy_module
+
+# Imported on first use, see lazy.py
+pymysql = lazy_module('pymysql')
+progressbar = lazy_module('progressbar')
+requests = lazy_module('requests')
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+ox = lazy_module('osmnx')
 
 # This file accesses the data
 
 """Place commands in this file to access the data electronically. Don't remove any missing values, or deal with outliers. Make sure you have legalities correct, both intellectual property and personal data privacy rights. Beyond the legal side also think about the ethical issues around this data. """
 
+# Land Registry price paid files
+LAND_REGISTRY_URL = 'http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com/'
+# Year/part files, formatted with year and part number
+TRANSACTIONS_URL = LAND_REGISTRY_URL + 'pp-%d-part%d.csv'
+# Whole-year file, only used for the first load of the current year
+YEAR_FILE = 'pp-%d.csv'
+# Monthly delta file with the transactions added/changed in the latest month
+MONTHLY_UPDATE_FILE = 'pp-monthly-update-new-version.csv'
+
+# Open postcode geo, a zip archive holding a single csv file
+POSTCODE_URL = 'https://www.getthedata.com/downloads/open_postcode_geo.csv.zip'
+# Columns of the postcode csv, named as in the postcode_data table
+POSTCODE_COLUMNS = ['postcode', 'status', 'usertype', 'easting', 'northing', 'positional_quality_indicator', 'country', 'lattitude', 'longitude', 'postcode_no_space', 'postcode_fixed_width_seven', 'postcode_fixed_width_eight', 'postcode_area', 'postcode_district', 'postcode_sector', 'outcode', 'incode']
+
+# Columns of joined price and location data (prices_coordinates_data) and the table each comes from
+PRICE_LOCATION_COLUMNS = ['price', 'date_of_transfer', 'postcode', 'property_type', 'new_build_flag', 'tenure_type', 'locality', 'town_city', 'district', 'county', 'country', 'lattitude', 'longitude', 'db_id']
+PRICE_LOCATION_SOURCES = {column: ('pc.' if column in ['country', 'lattitude', 'longitude'] else 'pp.') + column for column in PRICE_LOCATION_COLUMNS}
+# Compact dtypes of fetched columns: codes and place names repeat, so they are categoricals; prices fit int32
+# (the largest ever is below 2^31) and float32 keeps coordinates to about half a metre
+PRICE_LOCATION_DTYPES = {'price': 'int32', 'date_of_transfer': 'datetime64[ns]', 'postcode': 'category', 'property_type': 'category',
+                         'new_build_flag': 'category', 'tenure_type': 'category', 'locality': 'category', 'town_city': 'category',
+                         'district': 'category', 'county': 'category', 'country': 'category', 'lattitude': 'float32',
+                         'longitude': 'float32', 'db_id': 'int64'}
+
+# Indexes the bounding box and date range queries rely on: table mapped to (index name, columns)
+INDEXES = {'pp_data': [('pp_postcode_date', ['postcode', 'date_of_transfer']),
+                       ('pp_date', ['date_of_transfer']),
+                       ('pp_transaction', ['transaction_unique_identifier'])],
+           'postcode_data': [('po_postcode', ['postcode']),
+                             ('po_lattitude_longitude', ['lattitude', 'longitude'])],
+           'prices_coordinates_data': [('pcd_lattitude_longitude_date', ['lattitude', 'longitude', 'date_of_transfer']),
+                                       ('pcd_db_id', ['db_id'])]}
+
+# Partitions of prices_coordinates_data (grid cell and month) that are already materialized, with the last
+# pp_data db_id they include: a partition is outdated once its month has transactions loaded since (a larger
+# db_id) or changed in place (loaded_id is then reset to 0)
+PARTITION_TABLE = """CREATE TABLE IF NOT EXISTS materialized_partitions (
+  level VARCHAR(16) NOT NULL,
+  area VARCHAR(32) NOT NULL,
+  month CHAR(7) NOT NULL,
+  rows_inserted INT NOT NULL,
+  materialized_at VARCHAR(19) NOT NULL,
+  loaded_id BIGINT NOT NULL,
+  PRIMARY KEY (level, area, month)
+)"""
+
+# Price sketches bucket log(price) into steps of 1/SKETCH_RESOLUTION, quantiles are then within about 1% of the exact value
+SKETCH_RESOLUTION = 50
 
+# Rollup table of price statistics per area, property type and month
+ROLLUP_TABLE = """CREATE TABLE IF NOT EXISTS price_rollups (
+  level VARCHAR(16) NOT NULL,
+  area VARCHAR(32) NOT NULL,
+  property_type VARCHAR(1) NOT NULL,
+  month CHAR(7) NOT NULL,
+  n INT NOT NULL,
+  total DOUBLE NOT NULL,
+  min_price INT NOT NULL,
+  max_price INT NOT NULL,
+  sketch TEXT NOT NULL,
+  PRIMARY KEY (level, area, property_type, month)
+)"""
+
+# Progress of every rollup level: the last pp_data db_id rolled up, so rows loaded since are found by their
+# db_id whatever their month, and the first month changed in place since (updates, deletions, reloads)
+ROLLUP_STATE_TABLE = """CREATE TABLE IF NOT EXISTS price_rollup_state (
+  level VARCHAR(16) NOT NULL PRIMARY KEY,
+  loaded_id BIGINT NOT NULL,
+  stale_month CHAR(7)
+)"""
+
+
+def _connection_settings(user = None, password = None, host = None, database = None, port = None):
+    """
+    Fill in missing connection settings from the config (database_user, database_password,
+    database_host, database_name, database_port)
+
+    Argument:
+      user : (string) - username
+      password : (string) - password
+      host : (string) - host url
+      database : (string) - database name
+      port : (int) - port number
+    Output:
+      settings : (dictionary) - keyword arguments for pymysql.connect
+    """
+    return {'user': user if user is not None else config.get('database_user'),
+            'passwd': password if password is not None else config.get('database_password'),
+            'host': host if host is not None else config.get('database_host'),
+            'port': int(port if port is not None else config.get('database_port', 3306)),
+            'db': database if database is not None else config.get('database_name'),
+            'local_infile': 1}
+
+def _connector(user = None, password = None, host = None, database = None, port = None, backend = None, path = None):
+    """
+    Function opening new connections of a backend
+
+    Argument:
+      user, password, host, database, port - server connection settings, read from the config if None
+      backend : (string) - backend name, config database_backend if None
+      path : (string) - database file of embedded backends, config database_path if None
+    Output:
+      connect : (function) - function returning a new connection
+    """
+    backend = get_backend(backend)
+    if backend.embedded:
+        path = path if path is not None else config.get('database_path', ':memory:')
+        return lambda: backend.connect(database = path)
+    settings = _connection_settings(user, password, host, database, port)
+    return lambda: backend.connect(**settings)
 
-def create_connection(user, password, host, database, port=3306):
+def create_connection(user = None, password = None, host = None, database = None, port = None, backend = None, path = None):
     """ 
-    Create a database connection to the MariaDB database specified by the host url and database name.
+    Create a database connection to the MariaDB database specified by the host url and database name,
+    or to an embedded database file. Settings that are not given are read from the config.
 
     Argument:
       user : (string) - username
@@ -24,88 +153,980 @@ def create_connection(user, password, host, database, port=3306):
       host : (string) - host url
       database : (string) - database name
       port : (int) - port number
+      backend : (string) - 'mariadb', 'duckdb' or 'sqlite', config database_backend if None
+      path : (string) - database file of embedded backends, config database_path if None
     Output:
       conn : (Connection object)/None - connection object
     """
     conn = None
     try:
-        conn = pymysql.connect(user=user,
-                               passwd=password,
-                               host=host,
-                               port=port,
-                               local_infile=1,
-                               db=database
-                               )
+        conn = _connector(user, password, host, database, port, backend, path)()
     except Exception as e:
-        print(f"Error connecting to the MariaDB Server: {e}")
+        print(f"Error connecting to the {backend or config.get('database_backend', 'mariadb')} database: {e}")
     return conn
 
+def create_tables(conn, tables = None):
+    """
+    Create the pp_data, postcode_data and prices_coordinates_data tables that do not exist yet,
+    with the column types of the connection's backend
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection to database
+      tables : (list(string)) - tables to create, all if None
+    Output:
+      N/A
+    """
+    with checkout(conn) as conn:
+        backend_of(conn).create_tables(conn, tables)
+
+class ConnectionPool:
+    """
+    Pool of reusable database connections, so repeated calls do not pay connection setup every time.
+
+    Connections are checked out with a context manager and returned to the pool afterwards, after
+    rolling back whatever the with block did not commit. A connection that sat idle for longer than
+    `recycle` seconds is health checked (and reconnected if stale) before it is handed out again.
+    Every access function accepts a pool wherever it accepts a connection.
+
+    Arguments:
+      size : int - maximum number of connections checked out at once, config pool_size if None
+      user, password, host, database, port - connection settings, read from the config if None
+      recycle : double - idle seconds after which a connection is checked, config pool_recycle if None
+      connect : function - optional function returning a new connection, overrides the settings
+      backend : string - 'mariadb', 'duckdb' or 'sqlite', config database_backend if None
+      path : string - database file of embedded backends, config database_path if None
+    """
+    def __init__(self, size = None, user = None, password = None, host = None, database = None, port = None, recycle = None, connect = None, backend = None, path = None):
+        self.size = int(size if size is not None else config.get('pool_size', 4))
+        self.recycle = float(recycle if recycle is not None else config.get('pool_recycle', 300))
+        if connect is None:
+            connect = _connector(user, password, host, database, port, backend, path)
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    @contextlib.contextmanager
+    def connection(self, timeout = None):
+        """
+        Check a connection out of the pool for the duration of a with block.
+
+        Arguments:
+          timeout : double - seconds to wait for a free connection, forever if None
+        Output:
+          conn : Connection Object - healthy connection, returned to the pool on exit
+        """
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f"No connection available within {timeout} seconds")
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        finally:
+            if conn is not None:
+                # Roll back on every return, not only after errors: work left uncommitted must not leak to the
+                # next user, and a reused connection must not keep an old REPEATABLE READ snapshot or its locks.
+                # Connections that cannot even roll back are dropped.
+                try:
+                    backend_of(conn).rollback(conn)
+                except Exception:
+                    self._close(conn)
+                    conn = None
+            if conn is not None:
+                self._idle.put((conn, time.monotonic()))
+            self._slots.release()
+
+    def close(self):
+        """
+        Close all idle connections of the pool.
+        """
+        while True:
+            try:
+                (conn, _) = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _checkout(self):
+        while True:
+            try:
+                (conn, last_used) = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - last_used < self.recycle or self._healthy(conn):
+                return conn
+            self._close(conn)
+
+    @staticmethod
+    def _healthy(conn):
+        try:
+            if hasattr(conn, 'ping'):
+                conn.ping(reconnect=True)
+            else:
+                conn.cursor().execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+@contextlib.contextmanager
+def checkout(conn):
+    """
+    Use a connection pool or a plain connection interchangeably
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection, or pool to check one out of
+    Output:
+      conn : (Connection object) - connection for the duration of the with block
+    """
+    if isinstance(conn, ConnectionPool):
+        with conn.connection() as pooled:
+            yield pooled
+    else:
+        yield conn
+
+def dedicated(connect):
+    """
+    Get a connection owned by one worker for its whole lifetime
+
+    Argument:
+      connect : (function/ConnectionPool) - function returning a new connection, or pool to check one out of
+    Output:
+      context : (context manager) - yields the connection, and closes or returns it on exit
+    """
+    if isinstance(connect, ConnectionPool):
+        return connect.connection()
+    return contextlib.closing(connect())
+
 def load(conn, table, file, field_term = "\",\"", lines_start = "\"", lines_term = "\"\n"):
     """ 
-    Load data from file to table
+    Load data from file to table, with LOAD DATA on MariaDB or the bulk csv import of an embedded backend
 
     Argument:
-      conn : (Connection object) - connection to database
+      conn : (Connection object/ConnectionPool) - connection to database
       table : (string) - table name
       file : (string) - csv file name
       field_term : (string) - end of each field
       lines_start : (string) - start of each csv line
       lines_term : (string) - end of each csv line
     Output:
-      N/A
+      rows : (int) - number of rows loaded
+    """
+    with instrument.span('access.load', table=table) as span, checkout(conn) as conn:
+        rows = backend_of(conn).load_csv(conn, table, file, field_term, lines_start, lines_term)
+        conn.commit()
+        span.set(rows=rows)
+    instrument.count('access.rows_loaded', rows, table=table)
+    return rows
+
+def load_transaction_file(conn, table, file):
+    """
+    Load one downloaded price paid csv file to table
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection to database
+      table : (string) - table name
+      file : (string) - csv file name
+    Output:
+      rows : (int) - number of rows loaded
+    """
+    return load(conn, table, file, "\",\"", "\"", "\"\n")
+
+def transaction_urls(start_year, end_year, url = TRANSACTIONS_URL):
+    """
+    List the urls of all transaction files between two years
+
+    Argument:
+      start_year : (int) - transactions from year
+      end_year : (int) - transactions to year (excluding the year)
+      url : (string) - url template formatted with year and part number
+    Output:
+      urls : (list(string)) - urls of the year/part files
+    """
+    return [url % (i,j) for i in range(start_year, end_year) for j in range(1,3)]
+
+def download_file(url, directory = None, chunk_size = 1 << 20):
+    """
+    Download a file into a unique temporary path, so concurrent runs never clobber each other
+
+    Argument:
+      url : (string) - url of the file
+      directory : (string) - directory for the temporary file, system default if None
+      chunk_size : (int) - bytes read per block
+    Output:
+      (path, size, seconds, checksum) : (string, int, double, string) - downloaded file, its size in bytes, download time and md5 checksum
+    """
+    with instrument.span('access.download', url=url) as span:
+        (path, size, seconds, checksum) = _download_file(url, directory, chunk_size)
+        span.set(bytes=size)
+    instrument.count('access.bytes_downloaded', size)
+    return (path, size, seconds, checksum)
+
+def _download_file(url, directory, chunk_size):
+    start = time.perf_counter()
+    fd, path = tempfile.mkstemp(suffix='.csv', dir=directory)
+    size = 0
+    md5 = hashlib.md5()
+    try:
+        with os.fdopen(fd, 'wb') as handle, urllib.request.urlopen(url) as resp:
+            while True:
+                block = resp.read(chunk_size)
+                if not block:
+                    break
+                handle.write(block)
+                md5.update(block)
+                size += len(block)
+    except Exception:
+        os.remove(path)
+        raise
+    return (path, size, time.perf_counter() - start, md5.hexdigest())
+
+def head_file(url):
+    """
+    Ask the server for size and ETag of a file without downloading it
+
+    Argument:
+      url : (string) - url of the file
+    Output:
+      (size, etag) : (int/None, string/None) - size and ETag (Last-Modified if the server sends no ETag), None where not reported
+    """
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method='HEAD')) as resp:
+            size = resp.headers.get('Content-Length')
+            return (int(size) if size is not None else None, resp.headers.get('ETag') or resp.headers.get('Last-Modified'))
+    except Exception:
+        return (None, None)
+
+@instrument.traced()
+def ingest(urls, connect, table, downloads = 4, loaders = 2, directory = None, loader = load_transaction_file, on_loaded = None, should_load = None):
     """
-    cur = conn.cursor()
-    cur.execute(f"LOAD DATA LOCAL INFILE '{file}' INTO TABLE {table} FIELDS TERMINATED BY '{field_term}' LINES STARTING BY '{lines_start}' TERMINATED BY '{lines_term}';")
-    conn.commit()
+    Pipelined ingest of csv files: several files are downloaded at once into unique temporary
+    paths and handed over a bounded queue to loader workers, each with its own connection.
+    Network and database time therefore overlap.
+
+    Argument:
+      urls : (list(string)) - urls of files to load
+      connect : (function/ConnectionPool) - returns a new connection for every loader worker, or pool to check them out of
+      table : (string) - table name
+      downloads : (int) - number of concurrent downloads
+      loaders : (int) - number of concurrent loader workers
+      directory : (string) - directory for temporary files, system default if None
+      loader : (function) - loader(conn, table, file) that loads one file and returns its row count
+      on_loaded : (function) - optional callback called with the statistics of every loaded file
+      should_load : (function) - optional should_load(url, checksum), files for which it returns False are not loaded
+    Output:
+      stats : (DataFrame) - per file url, bytes, checksum, rows, timings and throughput (bytes/s, rows/s)
+    """
+    # Bounded, so at most `loaders` downloaded files wait on disk for a free loader
+    files = queue.Queue(maxsize=loaders)
+    stats = []
+    errors = []
+    lock = threading.Lock()
+
+    def load_worker():
+        with contextlib.ExitStack() as stack:
+            conn = None
+            try:
+                conn = stack.enter_context(dedicated(connect))
+            except Exception as e:
+                errors.append(e)
+            load_files(conn)
+
+    def load_files(conn):
+        # Keep draining the queue even after a failure so downloads never block
+        while True:
+            item = files.get()
+            if item is None:
+                break
+            (url, path, size, download_seconds, checksum) = item
+            try:
+                if should_load is not None and not should_load(url, checksum):
+                    continue
+                if conn is not None and not errors:
+                    start = time.perf_counter()
+                    rows = loader(conn, table, path)
+                    load_seconds = time.perf_counter() - start
+                    record = {'url': url,
+                              'bytes': size,
+                              'checksum': checksum,
+                              'rows': rows,
+                              'download_seconds': download_seconds,
+                              'load_seconds': load_seconds,
+                              'bytes_per_s': size/download_seconds if download_seconds > 0 else float('nan'),
+                              'rows_per_s': rows/load_seconds if rows is not None and load_seconds > 0 else float('nan')}
+                    with lock:
+                        stats.append(record)
+                    if on_loaded is not None:
+                        on_loaded(record)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                os.remove(path)
+
+    def fetch(url):
+        if errors:
+            return
+        (path, size, seconds, checksum) = download_file(url, directory)
+        files.put((url, path, size, seconds, checksum))
+
+    workers = [threading.Thread(target=load_worker, daemon=True) for _ in range(loaders)]
+    for worker in workers:
+        worker.start()
+    try:
+        with ThreadPoolExecutor(max_workers=downloads) as pool:
+            for future in [pool.submit(fetch, url) for url in urls]:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(e)
+    finally:
+        for _ in workers:
+            files.put(None)
+        for worker in workers:
+            worker.join()
+    if errors:
+        raise errors[0]
+    return pd.DataFrame(stats, columns=['url', 'bytes', 'checksum', 'rows', 'download_seconds', 'load_seconds', 'bytes_per_s', 'rows_per_s'])
     
 def load_transactions(conn, table, start_year, end_year):
     """
     Load all transaction data from files downloaded from uk.gov to table
 
     Argument:
-      conn : (Connection object) - connection to database
+      conn : (Connection object/ConnectionPool) - connection to database
       table : (string) - table name
       start_year : (int) - download transactions from year
       end_year : (int) - download transaction to year (excluding the year)
     Output:
       N/A
     """
-    pbar = ProgressBar()
+    pbar = progressbar.ProgressBar()
 
     for i in pbar(range(start_year, end_year)):
         for j in range(1,3):
-            urllib.request.urlretrieve('http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com/pp-%d-part%d.csv' % (i,j), 'data.csv')
-            load(conn, table, 'data.csv', "\",\"", "\"", "\"\n")
+            (path, _, _, _) = download_file(TRANSACTIONS_URL % (i,j))
+            try:
+                load_transaction_file(conn, table, path)
+            finally:
+                os.remove(path)
+
+def load_transactions_pipelined(connect, table, start_year, end_year, downloads = 4, loaders = 2, directory = None, url = TRANSACTIONS_URL):
+    """
+    Load all transaction data from files downloaded from uk.gov to table, overlapping downloads with loads
+
+    Argument:
+      connect : (function/ConnectionPool) - returns a new connection for every loader worker, or pool to check them out of
+      table : (string) - table name
+      start_year : (int) - download transactions from year
+      end_year : (int) - download transaction to year (excluding the year)
+      downloads : (int) - number of concurrent downloads
+      loaders : (int) - number of concurrent loader workers
+      directory : (string) - directory for temporary files, system default if None
+      url : (string) - url template formatted with year and part number
+    Output:
+      stats : (DataFrame) - per file throughput, see ingest
+    """
+    return ingest(transaction_urls(start_year, end_year, url), connect, table, downloads, loaders, directory)
+
+def read_manifest(manifest_file = None):
+    """
+    Read the load manifest recording which source files are already in the database
+
+    Argument:
+      manifest_file : (string) - manifest path, config entry manifest_file or load_manifest.json if None
+    Output:
+      manifest : (dictionary) - url mapped to its url, size, etag, checksum, rows and loaded_at
+    """
+    manifest_file = manifest_file or config.get('manifest_file', 'load_manifest.json')
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as handle:
+        return json.load(handle)
+
+def manifest_version(manifest_file = None):
+    """
+    Fingerprint of the load manifest, which changes whenever new files are loaded
+
+    Argument:
+      manifest_file : (string) - manifest path, config entry manifest_file or load_manifest.json if None
+    Output:
+      version : (string) - md5 of the manifest, '' if there is no manifest
+    """
+    manifest_file = manifest_file or config.get('manifest_file', 'load_manifest.json')
+    if not os.path.exists(manifest_file):
+        return ''
+    with open(manifest_file, 'rb') as handle:
+        return hashlib.md5(handle.read()).hexdigest()
+
+def write_manifest(manifest, manifest_file = None):
+    """
+    Atomically write the load manifest, so a crash never leaves it half written
+
+    Argument:
+      manifest : (dictionary) - manifest as returned by read_manifest
+      manifest_file : (string) - manifest path, config entry manifest_file or load_manifest.json if None
+    Output:
+      N/A
+    """
+    manifest_file = manifest_file or config.get('manifest_file', 'load_manifest.json')
+    fd, path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifest_file)))
+    with os.fdopen(fd, 'w') as handle:
+        json.dump(manifest, handle, indent=1, sort_keys=True)
+    os.replace(path, manifest_file)
+
+def read_transaction_delta(file):
+    """
+    Read a price paid update file, whose last column (record_status) says whether a transaction was
+    added (A), changed (C) or deleted (D)
+
+    Argument:
+      file : (string) - csv file name
+    Output:
+      records : (list(list)) - fields of every transaction in pp_data column order, price as an int and dates as 'YYYY-MM-DD'
+    """
+    columns = [column for (column, _) in SCHEMA['pp_data']]
+    (price, date) = (columns.index('price'), columns.index('date_of_transfer'))
+    records = []
+    with open(file, newline='') as handle:
+        for fields in csv.reader(handle):
+            if len(fields) != len(columns):
+                continue
+            fields[price] = int(fields[price]) if fields[price] else None
+            fields[date] = fields[date][:10]
+            records.append(fields)
+    return records
+
+def delta_month(records):
+    """
+    Latest month of transfer of the added and changed transactions of an update file, e.g. '2024-05'
+    """
+    date = [column for (column, _) in SCHEMA['pp_data']].index('date_of_transfer')
+    months = [fields[date][:7] for fields in records if fields[-1] in ('A', 'C')]
+    return max(months) if months else None
+
+def latest_month(conn, table):
+    """
+    Latest month of transfer in a transaction table, e.g. '2024-05', None if it is empty
+    """
+    with checkout(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT MAX(date_of_transfer) FROM {table}")
+        latest = cur.fetchone()[0]
+        conn.commit()
+    return str(latest)[:7] if latest is not None else None
 
-def load_postcodes(conn, headers):
+def _mark_rollups_stale(conn, month):
     """
-    Load all postcode data to the table
+    Make the next incremental materialize_rollups run of every level recompute from a month on, after
+    transactions of that month were changed or deleted. Part of the caller's transaction.
 
     Argument:
       conn : (Connection object) - connection to database
+      month : (string) - e.g. '2021-01', nothing is marked if None
+    """
+    if month is not None:
+        conn.cursor().execute(bind(conn, "UPDATE price_rollup_state SET stale_month = %s WHERE stale_month IS NULL OR stale_month > %s"), (month, month))
+
+def _mark_partitions_stale(conn, months):
+    """
+    Make the next materialize_prices_coordinates run redo the partitions of months whose transactions were
+    changed in place (keeping their db_id). Part of the caller's transaction.
+
+    Argument:
+      conn : (Connection object) - connection to database
+      months : (list(string)) - e.g. ['2021-01', '2021-03']
+    """
+    months = sorted(set(months))
+    if months:
+        conn.cursor().execute(bind(conn, f"UPDATE materialized_partitions SET loaded_id = 0 WHERE month IN ({', '.join(['%s'] * len(months))})"), months)
+
+def apply_transaction_delta(conn, table, records, batch_size = 1000):
+    """
+    Apply a price paid update to a transaction table in one transaction. Added and changed transactions
+    are upserted by transaction_unique_identifier (updated in place, so they keep their db_id, or inserted),
+    deleted ones are removed. Materialized copies of changed and deleted transactions are removed from
+    prices_coordinates_data and the partitions of the months touched are marked outdated, so the next
+    materialization run picks up their new values, and rollups are marked stale from the first month touched,
+    so the next materialize_rollups run recomputes it.
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection to database
+      table : (string) - table name
+      records : (list(list)) - update, see read_transaction_delta
+      batch_size : (int) - transactions per statement
+    Output:
+      counts : (dictionary) - number of transactions inserted, updated and deleted
+    """
+    columns = [column for (column, _) in SCHEMA['pp_data']]
+    date = columns.index('date_of_transfer')
+    # The last record of a transaction wins
+    latest = {fields[0]: fields for fields in records}
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0}
+    with checkout(conn) as conn:
+        backend = backend_of(conn)
+        materialized = backend.has_table(conn, 'prices_coordinates_data')
+        partitioned = backend.has_table(conn, 'materialized_partitions')
+        rolled_up = backend.has_table(conn, 'price_rollup_state')
+        backend.begin(conn)
+        cur = conn.cursor()
+        try:
+            identifiers = list(latest)
+            existing = set()
+            # Months touched: those of the new records and the old months of the transactions they replace
+            months = [fields[date][:7] for fields in latest.values()]
+            for start in range(0, len(identifiers), batch_size):
+                batch = identifiers[start:start+batch_size]
+                marks = ', '.join(['%s'] * len(batch))
+                cur.execute(bind(conn, f"SELECT transaction_unique_identifier, date_of_transfer FROM {table} WHERE transaction_unique_identifier IN ({marks})"), batch)
+                rows = cur.fetchall()
+                found = [row[0] for row in rows]
+                months.extend(str(row[1])[:7] for row in rows)
+                existing.update(found)
+                if materialized and found:
+                    marks = ', '.join(['%s'] * len(found))
+                    cur.execute(bind(conn, f"DELETE FROM prices_coordinates_data WHERE db_id IN (SELECT db_id FROM {table} WHERE transaction_unique_identifier IN ({marks}))"), found)
+
+            deleted = [identifier for (identifier, fields) in latest.items() if fields[-1] == 'D' and identifier in existing]
+            for start in range(0, len(deleted), batch_size):
+                batch = deleted[start:start+batch_size]
+                cur.execute(bind(conn, f"DELETE FROM {table} WHERE transaction_unique_identifier IN ({', '.join(['%s'] * len(batch))})"), batch)
+            counts['deleted'] = len(deleted)
+
+            updated = [fields[1:] + [fields[0]] for (identifier, fields) in latest.items() if fields[-1] != 'D' and identifier in existing]
+            if updated:
+                cur.executemany(bind(conn, f"UPDATE {table} SET {', '.join(column + ' = %s' for column in columns[1:])} WHERE transaction_unique_identifier = %s"), updated)
+            counts['updated'] = len(updated)
+
+            inserted = [fields for (identifier, fields) in latest.items() if fields[-1] != 'D' and identifier not in existing]
+            for start in range(0, len(inserted), 10000):
+                backend.insert_rows(conn, table, columns, inserted[start:start+10000])
+            counts['inserted'] = len(inserted)
+            if partitioned:
+                _mark_partitions_stale(conn, months)
+            if rolled_up:
+                _mark_rollups_stale(conn, min(months, default=None))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    instrument.count('access.delta_applied', sum(counts.values()), table=table)
+    return counts
+
+def reload_year(conn, table, year, files):
+    """
+    Replace all transactions of a year with the contents of its whole-year file (or of all its part files), in
+    one transaction where the backend allows it. Materialized copies of the year's transactions are removed, as
+    the reload gives them new db_ids, and rollups are marked stale from the start of the year.
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection to database
+      table : (string) - table name
+      year : (int) - year of the files
+      files : (string/list(string)) - downloaded whole-year csv file, or all part files of the year
+    Output:
+      rows : (int) - number of rows loaded
+    """
+    files = [files] if isinstance(files, str) else files
+    bounds = (f"{year}-01-01", f"{year}-12-31")
+    rows = 0
+    with checkout(conn) as conn:
+        backend = backend_of(conn)
+        materialized = backend.has_table(conn, 'prices_coordinates_data')
+        rolled_up = backend.has_table(conn, 'price_rollup_state')
+        backend.begin(conn)
+        cur = conn.cursor()
+        try:
+            if materialized:
+                cur.execute(bind(conn, "DELETE FROM prices_coordinates_data WHERE date_of_transfer BETWEEN %s AND %s"), bounds)
+            cur.execute(bind(conn, f"DELETE FROM {table} WHERE date_of_transfer BETWEEN %s AND %s"), bounds)
+            if rolled_up:
+                _mark_rollups_stale(conn, f"{year}-01")
+            for file in files:
+                with instrument.span('access.load', table=table) as span:
+                    loaded = backend.load_csv(conn, table, file, "\",\"", "\"", "\"\n")
+                    span.set(rows=loaded)
+                rows += loaded
+            # The deletes are committed together with the new rows
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    instrument.count('access.rows_loaded', rows, table=table)
+    return rows
+
+@instrument.traced()
+def sync_transactions(connect, table, start_year, end_year, manifest_file = None, current_year = None, downloads = 4, loaders = 2, directory = None, base_url = LAND_REGISTRY_URL):
+    """
+    Resumable, incremental version of load_transactions. Every loaded file is recorded in the manifest
+    as soon as it is committed, unchanged files (same ETag/size, or same checksum once downloaded) are
+    skipped, so re-runs never duplicate rows and a crashed run resumes where it stopped.
+    Past years are loaded from their part files; when a part file that was loaded is republished with
+    other contents, its whole year is reloaded from its part files (see reload_year). The current year is loaded once from its whole-year
+    file and afterwards only from the monthly update file, applied by record_status (see
+    apply_transaction_delta); a year first loaded that way keeps being maintained by the updates rather
+    than by its part files. The manifest keeps the latest month of transfer applied, and when an update
+    skips a month (a run was missed) the current year is reloaded from its whole-year file instead.
+
+    Argument:
+      connect : (function/ConnectionPool) - returns a new connection for every loader worker, or pool to check them out of
+      table : (string) - table name
+      start_year : (int) - transactions from year
+      end_year : (int) - transactions to year (excluding the year)
+      manifest_file : (string) - manifest path, config entry manifest_file or load_manifest.json if None
+      current_year : (int) - year served by the monthly delta, this year if None
+      downloads : (int) - number of concurrent downloads
+      loaders : (int) - number of concurrent loader workers
+      directory : (string) - directory for temporary files, system default if None
+      base_url : (string) - url the Land Registry files are served from
+    Output:
+      stats : (DataFrame) - per file throughput of the files loaded in this run, see ingest
+    """
+    current_year = current_year or datetime.date.today().year
+    current_url = base_url + YEAR_FILE % current_year
+    update_url = base_url + MONTHLY_UPDATE_FILE
+    manifest = read_manifest(manifest_file)
+    lock = threading.Lock()
+
+    years = {}
+    for year in range(start_year, min(end_year, current_year)):
+        if base_url + YEAR_FILE % year not in manifest:
+            years[year] = transaction_urls(year, year+1, base_url + 'pp-%d-part%d.csv')
+
+    # Skip files the server reports as unchanged before downloading them
+    heads = {}
+    pending = []
+    republished = {}
+    for (year, urls) in years.items():
+        for url in urls:
+            (size, etag) = heads[url] = head_file(url)
+            entry = manifest.get(url)
+            if entry is not None and etag is not None and entry['etag'] == etag and entry['size'] == size:
+                continue
+            if entry is not None:
+                # A loaded file may have been republished: appending it again would duplicate its transactions
+                republished[year] = urls
+            else:
+                pending.append(url)
+    pending = [url for url in pending if not any(url in urls for urls in republished.values())]
+
+    def should_load(url, checksum):
+        entry = manifest.get(url)
+        return entry is None or entry['checksum'] != checksum
+
+    def on_loaded(record):
+        (size, etag) = heads[record['url']]
+        with lock:
+            manifest[record['url']] = {'url': record['url'],
+                                       'size': record['bytes'],
+                                       'etag': etag,
+                                       'checksum': record['checksum'],
+                                       'rows': record['rows'],
+                                       'loaded_at': datetime.datetime.now().isoformat(timespec='seconds')}
+            write_manifest(manifest, manifest_file)
+
+    stats = ingest(pending, connect, table, downloads, loaders, directory, on_loaded=on_loaded, should_load=should_load)
+    for (year, urls) in sorted(republished.items()):
+        records = _resync_year(connect, table, manifest, manifest_file, year, urls, heads, directory)
+        if records:
+            stats = pd.DataFrame(stats.to_dict('records') + records, columns=stats.columns)
+    if end_year > current_year:
+        record = _sync_current_year(connect, table, manifest, manifest_file, current_year, current_url, update_url, directory)
+        if record is not None:
+            stats = pd.DataFrame(stats.to_dict('records') + [record], columns=stats.columns)
+    return stats
+
+def _resync_year(connect, table, manifest, manifest_file, year, urls, heads, directory):
+    """
+    Check the part files of a past year of which some loaded file changed on the server: if a checksum
+    differs the whole year is reloaded from its part files (see reload_year), otherwise only the manifest
+    is updated. Returns the ingest statistics of the files loaded.
+    """
+    files = {}
+    try:
+        for url in urls:
+            files[url] = download_file(url, directory)
+        if all(manifest.get(url) is not None and manifest[url]['checksum'] == files[url][3] for url in urls):
+            for url in urls:
+                manifest[url] = dict(manifest[url], size=files[url][1], etag=heads[url][1])
+            write_manifest(manifest, manifest_file)
+            return []
+        with dedicated(connect) as conn:
+            start = time.perf_counter()
+            rows = reload_year(conn, table, year, [files[url][0] for url in urls])
+            load_seconds = time.perf_counter() - start
+        instrument.count('access.year_reloaded', rows, year=year)
+        loaded_at = datetime.datetime.now().isoformat(timespec='seconds')
+        records = []
+        for (i, url) in enumerate(urls):
+            (_, size, download_seconds, checksum) = files[url]
+            # The files are loaded together, their rows and load time are reported against the first one
+            (file_rows, file_seconds) = (rows, load_seconds) if i == 0 else (0, 0.0)
+            manifest[url] = {'url': url, 'size': size, 'etag': heads[url][1], 'checksum': checksum, 'rows': file_rows, 'loaded_at': loaded_at}
+            records.append(_file_record(url, size, checksum, file_rows, download_seconds, file_seconds))
+        write_manifest(manifest, manifest_file)
+        return records
+    finally:
+        for (path, _, _, _) in files.values():
+            os.remove(path)
+
+def _sync_current_year(connect, table, manifest, manifest_file, current_year, current_url, update_url, directory):
+    """
+    Bring the current year up to date: apply the monthly update if it follows the last month applied,
+    otherwise (first run, or a missed month) reload the whole-year file. Returns the ingest statistics
+    of the file loaded, None if the update was unchanged.
+    """
+    with dedicated(connect) as conn:
+        entry = manifest.get(update_url)
+        if current_url in manifest:
+            (size, etag) = head_file(update_url)
+            if entry is not None and etag is not None and entry['etag'] == etag and entry['size'] == size:
+                return None
+            (path, size, download_seconds, checksum) = download_file(update_url, directory)
+            try:
+                if entry is not None and entry['checksum'] == checksum:
+                    return None
+                records = read_transaction_delta(path)
+            finally:
+                os.remove(path)
+            month = delta_month(records)
+            previous = entry.get('month') if entry is not None else None
+            if previous is None or month is None or month <= str(pd.Period(previous, freq='M') + 1):
+                start = time.perf_counter()
+                apply_transaction_delta(conn, table, records)
+                load_seconds = time.perf_counter() - start
+                manifest[update_url] = {'url': update_url, 'size': size, 'etag': etag, 'checksum': checksum, 'rows': len(records),
+                                        'month': max(month or '', previous or '') or None,
+                                        'loaded_at': datetime.datetime.now().isoformat(timespec='seconds')}
+                write_manifest(manifest, manifest_file)
+                return _file_record(update_url, size, checksum, len(records), download_seconds, load_seconds)
+            # The update skips a month, whose changes are now only in the whole-year file
+            instrument.count('access.delta_missed_month', month=month, previous=previous)
+
+        (size, etag) = head_file(current_url)
+        (path, size, download_seconds, checksum) = download_file(current_url, directory)
+        try:
+            start = time.perf_counter()
+            rows = reload_year(conn, table, current_year, path)
+            load_seconds = time.perf_counter() - start
+        finally:
+            os.remove(path)
+        loaded_at = datetime.datetime.now().isoformat(timespec='seconds')
+        manifest[current_url] = {'url': current_url, 'size': size, 'etag': etag, 'checksum': checksum, 'rows': rows, 'loaded_at': loaded_at}
+        # The whole-year file already contains the latest month
+        (delta_size, delta_etag) = head_file(update_url)
+        manifest[update_url] = {'url': update_url, 'size': delta_size, 'etag': delta_etag, 'checksum': None, 'rows': 0,
+                                'month': latest_month(conn, table), 'loaded_at': loaded_at}
+        write_manifest(manifest, manifest_file)
+        return _file_record(current_url, size, checksum, rows, download_seconds, load_seconds)
+
+def _file_record(url, size, checksum, rows, download_seconds, load_seconds):
+    return {'url': url, 'bytes': size, 'checksum': checksum, 'rows': rows, 'download_seconds': download_seconds, 'load_seconds': load_seconds,
+            'bytes_per_s': size/download_seconds if download_seconds > 0 else float('nan'),
+            'rows_per_s': rows/load_seconds if rows is not None and load_seconds > 0 else float('nan')}
+
+def stream_zip_member(blocks):
+    """
+    Decompress the first member of a zip archive while it is still downloading. Zip files keep their
+    directory at the end, but every member is preceded by a local header, which is enough to inflate
+    it from a forward-only stream.
+
+    Argument:
+      blocks : (iterable(bytes)) - raw archive bytes, e.g. resp.iter_content()
+    Output:
+      data : (generator(bytes)) - decompressed blocks of the first member
+    """
+    blocks = iter(blocks)
+    buffer = b''
+    while len(buffer) < 30:
+        block = next(blocks, None)
+        if block is None:
+            raise ValueError("Truncated zip archive")
+        buffer += block
+    if buffer[:4] != b'PK\x03\x04':
+        raise ValueError("Not a zip archive")
+    flags = int.from_bytes(buffer[6:8], 'little')
+    method = int.from_bytes(buffer[8:10], 'little')
+    compressed_size = int.from_bytes(buffer[18:22], 'little')
+    start = 30 + int.from_bytes(buffer[26:28], 'little') + int.from_bytes(buffer[28:30], 'little')
+    while len(buffer) < start:
+        block = next(blocks, None)
+        if block is None:
+            raise ValueError("Truncated zip archive")
+        buffer += block
+    buffer = buffer[start:]
+
+    if method == 8:
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not inflater.eof:
+            if buffer:
+                data = inflater.decompress(buffer)
+                buffer = inflater.unconsumed_tail
+                if data:
+                    yield data
+            if not buffer and not inflater.eof:
+                block = next(blocks, None)
+                if block is None:
+                    raise ValueError("Truncated zip archive")
+                buffer = block
+    elif method == 0 and not flags & 0x08 and compressed_size != 0xFFFFFFFF:
+        remaining = compressed_size
+        while remaining > 0:
+            if not buffer:
+                buffer = next(blocks, None)
+                if buffer is None:
+                    raise ValueError("Truncated zip archive")
+            data = buffer[:remaining]
+            buffer = buffer[remaining:]
+            remaining -= len(data)
+            yield data
+    else:
+        raise ValueError(f"Unsupported zip member (method {method}, flags {flags})")
+
+def project_lines(data, indices = None, separator = b','):
+    """
+    Split a stream of csv bytes into lines, keeping only some of the fields
+
+    Argument:
+      data : (iterable(bytes)) - csv bytes in arbitrary blocks
+      indices : (list(int)) - positions of the fields to keep, all fields if None
+      separator : (bytes) - field separator
+    Output:
+      lines : (generator(list(bytes))) - fields of each line
+    """
+    rest = b''
+    for block in data:
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            fields = line.rstrip(b'\r').split(separator)
+            yield fields if indices is None else [fields[i] for i in indices]
+    if rest.strip():
+        fields = rest.rstrip(b'\r').split(separator)
+        yield fields if indices is None else [fields[i] for i in indices]
+
+@instrument.traced()
+def load_postcodes(conn, headers, columns = None, method = 'pipe', batch_size = 50000, chunk_size = 1 << 20, url = POSTCODE_URL):
+    """
+    Load all postcode data to the table, streaming it from the zip archive without temporary files
+
+    The archive is inflated while it downloads and is either piped into LOAD DATA through a named
+    pipe, or inserted with executemany in batches (used where named pipes are not available).
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection to database
       headers : (dicctionary) - necessary headers to download data
+      columns : (list(string)) - postcode_data columns to load (e.g. ['postcode', 'country', 'lattitude', 'longitude']), all if None
+      method : (string) - 'pipe' for LOAD DATA through a named pipe (MariaDB only), 'executemany' for batched inserts
+      batch_size : (int) - rows per executemany batch
+      chunk_size : (int) - bytes per network read
+      url : (string) - url of the zip archive
     Output:
-      N/A
+      rows : (int) - number of rows loaded
     """
-    resp1 = requests.get('https://www.getthedata.com/downloads/open_postcode_geo.csv.zip',headers=headers)
+    columns = columns or POSTCODE_COLUMNS
+    indices = [POSTCODE_COLUMNS.index(column) for column in columns]
 
-    with open('open_postcode_geo.csv.zip', 'wb') as handle:
-        for block in resp1.iter_content(1024):
-            if not block:
-                break
-            handle.write(block)
+    resp = requests.get(url, headers=headers, stream=True)
+    resp.raise_for_status()
+    lines = project_lines(stream_zip_member(resp.iter_content(chunk_size)), indices)
+    with checkout(conn) as conn:
+        backend = backend_of(conn)
+        if method == 'pipe' and (backend.name != 'mariadb' or not hasattr(os, 'mkfifo')):
+            method = 'executemany'
+        # One transaction, so a broken download leaves no partial table behind
+        backend.begin(conn)
+        cur = conn.cursor()
+        try:
+            if method == 'pipe':
+                rows = _load_through_pipe(cur, 'postcode_data', columns, lines)
+            elif method == 'executemany':
+                rows = 0
+                batch = []
+                for fields in lines:
+                    batch.append([field.decode() if field else None for field in fields])
+                    if len(batch) == batch_size:
+                        rows += backend.insert_rows(conn, 'postcode_data', columns, batch)
+                        batch = []
+                if batch:
+                    rows += backend.insert_rows(conn, 'postcode_data', columns, batch)
+            else:
+                raise ValueError(f"Unknown load method {method}")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            resp.close()
+        conn.commit()
+    return rows
+
+def _load_through_pipe(cur, table, columns, lines):
+    """
+    Run LOAD DATA on a named pipe that a writer thread fills with the given lines
+
+    Argument:
+      cur : (Cursor object) - cursor of the connection to load through
+      table : (string) - table name
+      columns : (list(string)) - columns the fields of each line go to
+      lines : (iterable(list(bytes))) - fields of each line
+    Output:
+      rows : (int) - number of rows loaded
+    """
+    directory = tempfile.mkdtemp()
+    pipe = os.path.join(directory, 'data.csv')
+    os.mkfifo(pipe)
+    errors = []
+    done = threading.Event()
+
+    def write():
+        try:
+            # Poll for the reader instead of blocking in open, so a failed LOAD DATA cannot strand the writer
+            while True:
+                try:
+                    fd = os.open(pipe, os.O_WRONLY | os.O_NONBLOCK)
+                    break
+                except OSError as e:
+                    if e.errno != errno.ENXIO:
+                        raise
+                    if done.wait(0.05):
+                        return
+            os.set_blocking(fd, True)
+            with open(fd, 'wb', buffering=1 << 20) as handle:
+                for fields in lines:
+                    handle.write(b','.join(fields) + b'\n')
+        except Exception as e:
+            errors.append(e)
 
-    with zipfile.ZipFile('open_postcode_geo.csv.zip', 'r') as zip_ref:
-        zip_ref.extractall('open_postcode_geo.csv')    
-        
-    load(conn, 'postcode_data', 'open_postcode_geo.csv/open_postcode_geo.csv', ',', '', '\n')
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    try:
+        rows = cur.execute(f"LOAD DATA LOCAL INFILE '{pipe}' INTO TABLE {table} FIELDS TERMINATED BY ',' LINES STARTING BY '' TERMINATED BY '\\n' ({', '.join(columns)});")
+    finally:
+        done.set()
+        writer.join()
+        os.remove(pipe)
+        os.rmdir(directory)
+    if errors:
+        # A broken download would otherwise commit a truncated table
+        raise errors[0]
+    return rows
     
 def joinAndStorePriceAndLocationData(conn, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax):
     """
     Function that joins location and price data and stores it into the third table.
 
     Arguments:
-      conn : Connection Object - connection to database
+      conn : Connection Object/ConnectionPool - connection to database
       longitudeMin : double - minimum limit for box of interest of longitude
       longitudeMax : double - maximum limit for box of interest of longitude
       lattitudeMin : double - minimum limit for box of interest of lattitude
@@ -115,64 +1136,605 @@ def joinAndStorePriceAndLocationData(conn, longitudeMin, longitudeMax, lattitude
     Outputs:
       N/A 
     """
-    cur = conn.cursor()
-    # Execute Query
-    cur.execute(f"INSERT INTO prices_coordinates_data \n" + 
-                f"SELECT pp.price, pp.date_of_transfer, pp.postcode, pp.property_type, pp.new_build_flag, pp.tenure_type, pp.locality, pp.town_city, pp.district, pp.county, pc.country, pc.lattitude, pc.longitude, pp.db_id \n" +
-                f"FROM \n" +
-                f"(SELECT db_id, price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county FROM pp_data WHERE date_of_transfer >= '{dateMin}' AND date_of_transfer <= '{dateMax}') pp \n" +
-                f"INNER JOIN \n" +
-                f"(SELECT postcode, country, lattitude, longitude FROM postcode_data WHERE (longitude BETWEEN {str(longitudeMin)} AND {str(longitudeMax)}) AND (lattitude BETWEEN {str(lattitudeMin)} AND {str(lattitudeMax)})) pc \n" +
-                f"ON \n" +
-                f"pp.postcode = pc.postcode;")
-    # Commit Results
-    conn.commit()
+    # Transactions already in the table are skipped, so overlapping calls do not duplicate rows
+    (query, params) = price_location_query(longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, exclude_table = 'prices_coordinates_data')
+    with checkout(conn) as conn:
+        cur = conn.cursor()
+        # Execute Query
+        cur.execute(bind(conn, f"INSERT INTO prices_coordinates_data ({', '.join(PRICE_LOCATION_COLUMNS)}) \n" + query), params)
+        # Commit Results
+        conn.commit()
     
+@instrument.traced()
+def materialize_prices_coordinates(conn, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, cell_size = 0.1, workers = 1, on_partition = None):
+    """
+    Incremental, idempotent version of joinAndStorePriceAndLocationData. The box and time of interest are
+    split into (grid cell, month) partitions; partitions recorded in materialized_partitions are skipped,
+    every other partition is inserted (skipping db_ids already present) and recorded in its own short
+    transaction, so locks and undo logs stay small and an interrupted run simply continues. Whole
+    partitions are materialized, so the stored data can extend beyond the box and dates asked for.
+    A partition is recorded with the last pp_data db_id it includes and is run again (adding only the new
+    transactions) once transactions of its month have been loaded since (e.g. by ingest, sync_transactions
+    or reload_year) or changed by apply_transaction_delta; partitions of other months are left alone and
+    partitions of the current month or later are never recorded, as they are still filling.
+
+    Arguments:
+      conn : Connection Object/ConnectionPool - connection to database, a pool is needed for several workers
+      longitudeMin : double - minimum limit for box of interest of longitude
+      longitudeMax : double - maximum limit for box of interest of longitude
+      lattitudeMin : double - minimum limit for box of interest of lattitude
+      lattitudeMax : double - maximum limit for box of interest of lattitude
+      dateMin : string - minimum limit for time of interest of date e.g. '2018-01-01'
+      dateMax : string - maximum limit for time of interest of date e.g. '2018-12-31'
+      cell_size : double - width/height of grid cells in degrees
+      workers : int - partitions materialized in parallel
+      on_partition : function - optional on_partition((north, south, west, east), month, rows) called after every
+                                partition, e.g. to invalidate a ModelRegistry
+    Outputs:
+      partitions : DataFrame - area, month and rows inserted of every partition materialized by this call
+    """
+    if workers > 1 and not isinstance(conn, ConnectionPool):
+        raise ValueError("Several workers need a ConnectionPool")
+    level = rollup_level('cell', cell_size)
+    # Cells as rollup_cell numbers them: a point is in the cell of floor(coordinate / cell_size)
+    rows = range(math.floor(lattitudeMin/cell_size), math.floor(lattitudeMax/cell_size) + 1)
+    columns = range(math.floor(longitudeMin/cell_size), math.floor(longitudeMax/cell_size) + 1)
+    months = [str(month) for month in pd.period_range(dateMin[:7], dateMax[:7], freq='M')]
+    current_month = datetime.date.today().strftime('%Y-%m')
+    with checkout(conn) as connection:
+        cur = connection.cursor()
+        cur.execute(PARTITION_TABLE)
+        # Rows loaded after this are picked up by the next run
+        cur.execute("SELECT MAX(db_id) FROM pp_data")
+        loaded = cur.fetchone()[0] or 0
+        cur.execute(bind(connection, "SELECT area, month, loaded_id, rows_inserted FROM materialized_partitions WHERE level = %s AND month BETWEEN %s AND %s"),
+                    (level, months[0], months[-1]))
+        recorded = {(area, month): (loaded_id, rows_inserted) for (area, month, loaded_id, rows_inserted) in cur.fetchall()}
+        # Last db_id of every month, one aggregate over the date range
+        period = (pd.Period(months[0], freq='M').start_time.date().isoformat(), pd.Period(months[-1], freq='M').end_time.date().isoformat())
+        cur.execute(bind(connection, f"SELECT {backend_of(connection).month_sql('date_of_transfer')}, MAX(db_id) FROM pp_data WHERE date_of_transfer BETWEEN %s AND %s GROUP BY 1"), period)
+        latest = {str(month): db_id for (month, db_id) in cur.fetchall()}
+        connection.commit()
+
+    def outdated(area, month):
+        if (area, month) not in recorded:
+            return True
+        return latest.get(month) is not None and latest[month] > recorded[(area, month)][0]
+
+    tasks = [(row, column, month) for row in rows for column in columns for month in months if outdated(f"{row}:{column}", month)]
+
+    def materialize(task):
+        (row, column, month) = task
+        area = f"{row}:{column}"
+        period = pd.Period(month, freq='M')
+        # The box only lets the query use the coordinate indexes, so it is widened past rounding errors;
+        # the FLOOR condition assigns every postcode to exactly one cell
+        margin = cell_size*1e-6
+        (query, params) = price_location_query(column*cell_size - margin, (column+1)*cell_size + margin, row*cell_size - margin, (row+1)*cell_size + margin,
+                                               period.start_time.date().isoformat(), period.end_time.date().isoformat(),
+                                               exclude_table = 'prices_coordinates_data', cell = (row, column, cell_size))
+        with checkout(conn) as connection:
+            backend = backend_of(connection)
+            backend.begin(connection)
+            cur = connection.cursor()
+            try:
+                cur.execute(bind(connection, f"INSERT INTO prices_coordinates_data ({', '.join(PRICE_LOCATION_COLUMNS)}) \n" + query), params)
+                inserted = backend.rowcount(cur)
+                if month < current_month:
+                    # rows_inserted counts the rows of every run of the partition
+                    previous = recorded.get((area, month), (0, 0))[1]
+                    cur.execute(bind(connection, "DELETE FROM materialized_partitions WHERE level = %s AND area = %s AND month = %s"), (level, area, month))
+                    cur.execute(bind(connection, "INSERT INTO materialized_partitions (level, area, month, rows_inserted, materialized_at, loaded_id) VALUES (%s, %s, %s, %s, %s, %s)"),
+                                (level, area, month, previous + inserted, datetime.datetime.now().isoformat(sep=' ', timespec='seconds'), loaded))
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+        instrument.count('access.partitions_materialized', rows=inserted)
+        if on_partition is not None:
+            on_partition(((row+1)*cell_size, row*cell_size, column*cell_size, (column+1)*cell_size), month, inserted)
+        return (area, month, inserted)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(materialize, tasks))
+    else:
+        results = [materialize(task) for task in tasks]
+    return pd.DataFrame(results, columns = ['area', 'month', 'rows'])
+
+def bind(conn, query):
+    """
+    Adapt a query written with %s placeholders to the parameter style of the connection's driver
+
+    Argument:
+      conn : (Connection object) - connection the query will run on
+      query : (string) - query with %s placeholders
+    Output:
+      query : (string) - query with the driver's placeholders
+    """
+    if backend_of(conn).paramstyle == 'qmark':
+        return query.replace('%s', '?')
+    return query
+
+def price_location_query(longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, columns = None, property_type = None, exclude_table = None, cell = None):
+    """
+    Build the price and location join with bound parameters. The bounding box is applied to
+    postcode_data before the join, so with the INDEXES in place both sides are index lookups.
+
+    Arguments:
+      longitudeMin : double - minimum limit for box of interest of longitude
+      longitudeMax : double - maximum limit for box of interest of longitude
+      lattitudeMin : double - minimum limit for box of interest of lattitude
+      lattitudeMax : double - maximum limit for box of interest of lattitude
+      dateMin : string - minimum limit for time of interest of date e.g. '2018-01-01'
+      dateMax : string - maximum limit for time of interest of date e.g. '2018-12-31'
+      columns : list(string) - subset of PRICE_LOCATION_COLUMNS to select, all if None
+      property_type : string - only transactions of this property type (e.g. 'D'), all if None
+      exclude_table : string - skip transactions whose db_id is already in this table, e.g. 'prices_coordinates_data'
+      cell : (int, int, double) - (row, column, cell_size) only postcodes of this grid cell, assigned with FLOOR as in
+                                  rollup_cell and the cell rollups, so every postcode is in exactly one cell
+    Outputs:
+      (query, params) : (string, tuple) - query with %s placeholders and its parameters
+    """
+    columns = columns or PRICE_LOCATION_COLUMNS
+    query = (f"SELECT {', '.join(PRICE_LOCATION_SOURCES[column] for column in columns)} \n" +
+             f"FROM \n" +
+             f"(SELECT postcode, country, lattitude, longitude FROM postcode_data WHERE (lattitude BETWEEN %s AND %s) AND (longitude BETWEEN %s AND %s)" +
+             (" AND FLOOR(lattitude / %s) = %s AND FLOOR(longitude / %s) = %s" if cell is not None else "") + ") pc \n" +
+             f"INNER JOIN \n" +
+             f"pp_data pp \n" +
+             f"ON \n" +
+             f"pp.postcode = pc.postcode \n" +
+             f"WHERE pp.date_of_transfer BETWEEN %s AND %s")
+    params = [lattitudeMin, lattitudeMax, longitudeMin, longitudeMax]
+    if cell is not None:
+        (row, column, cell_size) = cell
+        params += [cell_size, row, cell_size, column]
+    params += [dateMin, dateMax]
+    if property_type is not None:
+        query += " AND pp.property_type = %s"
+        params.append(property_type)
+    if exclude_table is not None:
+        query += f" \nAND NOT EXISTS (SELECT 1 FROM {exclude_table} ex WHERE ex.db_id = pp.db_id)"
+    return (query, tuple(params))
+
+def ensure_indexes(conn, tables = None):
+    """
+    Create the indexes of INDEXES that do not exist yet
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection to database
+      tables : (list(string)) - tables to index, all tables of INDEXES if None
+    Output:
+      N/A
+    """
+    with checkout(conn) as conn:
+        cur = conn.cursor()
+        for table in tables or INDEXES:
+            for (name, columns) in INDEXES[table]:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+        conn.commit()
+
+def explain(conn, query, params = None):
+    """
+    EXPLAIN a query, e.g. one from price_location_query, to check it uses the indexes
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection to database
+      query : (string) - query with %s placeholders
+      params : (tuple) - query parameters
+    Output:
+      plan : (DataFrame) - query plan as reported by the database
+    """
+    with checkout(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(bind(conn, "EXPLAIN " + query), params or ())
+        rows = cur.fetchall()
+        columns = [column[0] for column in cur.description]
+    return pd.DataFrame(rows, columns = columns)
+
+def _streaming_cursor(conn):
+    """
+    Cursor that streams rows from the server instead of buffering the whole result in memory
+
+    Argument:
+      conn : (Connection object) - connection to database
+    Output:
+      cur : (Cursor object) - unbuffered cursor where the driver has one
+    """
+    return backend_of(conn).streaming_cursor(conn)
+
+def _fetch_rows(cur, chunksize = 10000):
+    """
+    Iterate over the rows of an executed cursor, fetching them in chunks
+    """
+    while True:
+        rows = cur.fetchmany(chunksize)
+        if not rows:
+            break
+        yield from rows
+
+def typed_frame(rows, columns, dtypes = PRICE_LOCATION_DTYPES):
+    """
+    Build a DataFrame from fetched rows with explicit column dtypes
+
+    Argument:
+      rows : (list(tuple)) - fetched rows
+      columns : (list(string)) - column names
+      dtypes : (dictionary) - column mapped to dtype, columns not listed are left as they are
+    Output:
+      data : (DataFrame) - typed frame
+    """
+    return apply_schema(pd.DataFrame(rows, columns = columns), dtypes)
+
+def apply_schema(data, dtypes = PRICE_LOCATION_DTYPES):
+    """
+    Cast the columns of a frame to the compact schema
+
+    Argument:
+      data : (DataFrame) - frame to cast
+      dtypes : (dictionary) - column mapped to dtype, columns not listed are left as they are
+    Output:
+      data : (DataFrame) - typed frame
+    """
+    for column in data.columns:
+        if column in dtypes and data[column].dtype != dtypes[column]:
+            data[column] = data[column].astype(dtypes[column])
+    return data
+
+def concat_frames(frames):
+    """
+    Concatenate typed chunks. pandas falls back to objects when categoricals of the chunks have
+    different categories, so their categories are unioned instead.
+
+    Argument:
+      frames : (list(DataFrame)) - chunks with the same columns
+    Output:
+      data : (DataFrame) - all chunks, with a fresh index
+    """
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+    columns = {}
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            columns[column] = pd.api.types.union_categoricals([frame[column] for frame in frames])
+    data = pd.concat([frame.drop(columns=list(columns)) for frame in frames], ignore_index=True)
+    for (column, values) in columns.items():
+        data[column] = values
+    return data[list(frames[0].columns)]
+
+def iter_query(conn, query, columns, params = None, chunksize = 100000, dtypes = PRICE_LOCATION_DTYPES, arrow = False):
+    """
+    Run a query on a server-side cursor and yield its result in typed chunks, so only one chunk
+    of rows is ever held as python tuples
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection to database
+      query : (string) - query to run
+      columns : (list(string)) - names of the selected columns
+      params : (tuple) - bound query parameters, for a query with %s placeholders
+      chunksize : (int) - rows per chunk
+      dtypes : (dictionary) - column mapped to dtype
+      arrow : (bool) - yield pyarrow RecordBatches instead of DataFrames
+    Output:
+      chunks : (generator(DataFrame/RecordBatch)) - typed chunks of the result
+    """
+    if arrow:
+        import pyarrow as pa
+    with checkout(conn) as conn:
+        cur = _streaming_cursor(conn)
+        try:
+            if params is None:
+                cur.execute(query)
+            else:
+                cur.execute(bind(conn, query), params)
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if not rows:
+                    break
+                instrument.count('access.rows_fetched', len(rows))
+                chunk = typed_frame(rows, columns, dtypes)
+                yield pa.RecordBatch.from_pandas(chunk, preserve_index=False) if arrow else chunk
+        finally:
+            cur.close()
+
+def iter_fetch_data(conn, table_name, columns, chunksize = 100000, dtypes = PRICE_LOCATION_DTYPES, arrow = False):
+    """
+    Streaming version of fetch_data, selecting only the given columns
+
+    Arguments:
+      conn : connection object/ConnectionPool - Connection to the database we want to extract data from
+      table_name : string - name of the table
+      columns : list(string) - columns to select
+      chunksize : int - rows per chunk
+      dtypes : dictionary - column mapped to dtype
+      arrow : bool - yield pyarrow RecordBatches instead of DataFrames
+    Output:
+      chunks : generator(DataFrame/RecordBatch) - typed chunks of the table
+    """
+    return iter_query(conn, f"SELECT {', '.join(columns)} FROM {table_name}", columns, None, chunksize, dtypes, arrow)
+
 def fetch_data(conn, table_name, columns):
     """
     Extracts data from database required to do assess and address part.
 
     Arguments:
-      conn : connection object - Connection to the database we want to extract data from
+      conn : connection object/ConnectionPool - Connection to the database we want to extract data from
       table_name : string - name of the table
       columns : list(string) - columns that table has
     Output:
-      rows : tuple - data extracted as tuple 
+      rows : DataFrame - data extracted, with the compact dtypes of PRICE_LOCATION_DTYPES 
     """
-    cur = conn.cursor()
-    cur.execute(f"SELECT * FROM {table_name}")
+    with checkout(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT * FROM {table_name}")
 
-    rows = cur.fetchall()
-    return pd.DataFrame(rows, columns = columns)
+        rows = cur.fetchall()
+    return typed_frame(rows, columns)
 
-def joinPriceAndLocationData(conn, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax):
+def iterPriceAndLocationData(conn, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, columns = None, chunksize = 100000, arrow = False, property_type = None):
+    """
+    Streaming version of joinPriceAndLocationData, yielding the joined data in typed chunks.
+
+    Arguments:
+      conn : connection object/ConnectionPool - Connection to the database we want to extract data from
+      longitudeMin : double - minimum limit for box of interest of longitude
+      longitudeMax : double - maximum limit for box of interest of longitude
+      lattitudeMin : double - minimum limit for box of interest of lattitude
+      lattitudeMax : double - maximum limit for box of interest of lattitude
+      dateMin : string - minimum limit for time of interest of date e.g. '2018-01-01'
+      dateMax : string - maximum limit for time of interest of date e.g. '2018-12-31'
+      columns : list(string) - subset of PRICE_LOCATION_COLUMNS to select, all if None
+      chunksize : int - rows per chunk
+      arrow : bool - yield pyarrow RecordBatches instead of DataFrames
+      property_type : string - only transactions of this property type (e.g. 'D'), all if None
+    Outputs:
+      chunks : generator(DataFrame/RecordBatch) - typed chunks of the joined data
+    """
+    columns = columns or PRICE_LOCATION_COLUMNS
+    (query, params) = price_location_query(longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, columns, property_type)
+    return iter_query(conn, query, columns, params, chunksize, PRICE_LOCATION_DTYPES, arrow)
+
+def joinPriceAndLocationData(conn, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, columns = None, property_type = None):
     """
     Function that joins price and location data and returns dataframe.
 
     Arguments:
-      conn : connection object - Connection to the database we want to extract data from
+      conn : connection object/ConnectionPool - Connection to the database we want to extract data from
       longitudeMin : double - minimum limit for box of interest of longitude
       longitudeMax : double - maximum limit for box of interest of longitude
       lattitudeMin : double - minimum limit for box of interest of lattitude
       lattitudeMax : double - maximum limit for box of interest of lattitude
       dateMin : string - minimum limit for time of interest of date e.g. '2018-01-01'
       dateMax : string - maximum limit for time of interest of date e.g. '2018-12-31'
+      columns : list(string) - subset of PRICE_LOCATION_COLUMNS to select, all if None
+      property_type : string - only transactions of this property type (e.g. 'D'), all if None
     Outputs:
       data : DataFrame - joined data for exploration
     """
-    cur = conn.cursor()
-    # Execute Query
-    cur.execute(f"SELECT pp.price, pp.date_of_transfer, pp.postcode, pp.property_type, pp.new_build_flag, pp.tenure_type, pp.locality, pp.town_city, pp.district, pp.county, pc.country, pc.lattitude, pc.longitude, pp.db_id \n" +
-                f"FROM \n" +
-                f"(SELECT postcode, country, lattitude, longitude FROM postcode_data) pc \n" +
-                f"INNER JOIN \n" +
-                f"(SELECT db_id, price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county FROM pp_data WHERE date_of_transfer >= '{dateMin}' AND date_of_transfer <= '{dateMax}') pp \n" +
-                f"ON \n" +
-                f"pp.postcode = pc.postcode\n" +
-                f"WHERE (longitude BETWEEN {str(longitudeMin)} AND {str(longitudeMax)}) AND (lattitude BETWEEN {str(lattitudeMin)} AND {str(lattitudeMax)});")
-    # Collect Data
-    rows = cur.fetchall()
-    return pd.DataFrame(rows, columns = ['price', 'date_of_transfer', 'postcode', 'property_type', 'new_build_flag', 'tenure_type', 'locality', 'town_city', 'district', 'county', 'country', 'lattitude', 'longitude', 'db_id'])
+    columns = columns or PRICE_LOCATION_COLUMNS
+    with instrument.span('access.join') as span:
+        # Streamed in typed chunks, so the full result never exists as python tuples
+        chunks = list(iterPriceAndLocationData(conn, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, columns, property_type=property_type))
+        data = concat_frames(chunks) if chunks else typed_frame([], columns)
+        span.set(rows=len(data))
+    return data
+
+def price_sketch(prices):
+    """
+    Mergeable quantile sketch of prices: counts of log(price) buckets
+
+    Argument:
+      prices : (array) - prices
+    Output:
+      sketch : (dictionary) - bucket mapped to count
+    """
+    prices = np.asarray(prices, dtype=float)
+    buckets = np.floor(np.log(prices[prices > 0])*SKETCH_RESOLUTION).astype(int)
+    (values, counts) = np.unique(buckets, return_counts=True)
+    return {int(value): int(count) for (value, count) in zip(values, counts)}
+
+def merge_sketches(sketches):
+    """
+    Merge price sketches, e.g. of several months or areas
+
+    Argument:
+      sketches : (iterable(dictionary)) - sketches to merge
+    Output:
+      sketch : (dictionary) - bucket mapped to count
+    """
+    merged = {}
+    for sketch in sketches:
+        for (bucket, count) in sketch.items():
+            merged[int(bucket)] = merged.get(int(bucket), 0) + count
+    return merged
+
+def sketch_quantile(sketch, q):
+    """
+    Approximate quantile of the prices summarised by a sketch
+
+    Argument:
+      sketch : (dictionary) - bucket mapped to count
+      q : (double) - quantile between 0 and 1
+    Output:
+      price : (double) - approximate quantile, nan for an empty sketch
+    """
+    if not sketch:
+        return float('nan')
+    buckets = sorted((int(bucket), count) for (bucket, count) in sketch.items())
+    target = q*sum(count for (_, count) in buckets)
+    seen = 0
+    for (bucket, count) in buckets:
+        seen += count
+        if seen >= target:
+            break
+    return math.exp((bucket + 0.5)/SKETCH_RESOLUTION)
+
+def rollup_level(level = 'district', cell_size = 0.1):
+    """
+    Name under which a rollup is stored
+
+    Argument:
+      level : (string) - 'district' for postcode districts, 'cell' for grid cells
+      cell_size : (double) - width/height of grid cells in degrees
+    Output:
+      level : (string) - e.g. 'district' or 'cell0.1'
+    """
+    return level if level == 'district' else f"cell{cell_size:g}"
+
+def rollup_cell(latitude, longitude, cell_size = 0.1):
+    """
+    Area name of the grid cell a point falls in, as used by cell rollups
+
+    Argument:
+      latitude : (double) - latitude of the point
+      longitude : (double) - longitude of the point
+      cell_size : (double) - width/height of grid cells in degrees
+    Output:
+      area : (string) - '<row>:<column>' of the cell
+    """
+    return f"{math.floor(latitude/cell_size)}:{math.floor(longitude/cell_size)}"
+
+@instrument.traced()
+def materialize_rollups(conn, level = 'district', cell_size = 0.1, from_month = None):
+    """
+    Build or update the price_rollups table: count, sum, min, max and a quantile sketch of prices per
+    postcode district (or grid cell), property type and month. Run it after loading new transactions;
+    by default only the months touched since the last run are recomputed, so updates are incremental and
+    re-runs idempotent: the latest month already rolled up and every month from the earliest one of the
+    transactions loaded since (found by db_id, so backfills of past years are picked up) or changed in place
+    by apply_transaction_delta and reload_year. Rows changed in pp_data by other means need from_month.
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection to database
+      level : (string) - 'district' for postcode districts, 'cell' for grid cells
+      cell_size : (double) - width/height of grid cells in degrees
+      from_month : (string) - recompute from this month e.g. '2021-01', incremental if None
+    Output:
+      rows : (int) - number of rollup rows written
+    """
+    name = rollup_level(level, cell_size)
+    if level == 'district':
+        keys = ["pc.postcode_district"]
+        params = []
+    else:
+        keys = ["FLOOR(pc.lattitude / %s)", "FLOOR(pc.longitude / %s)"]
+        params = [cell_size, cell_size]
+    with checkout(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(ROLLUP_TABLE)
+        cur.execute(ROLLUP_STATE_TABLE)
+        # Rows loaded after this are picked up by the next run
+        cur.execute("SELECT MAX(db_id) FROM pp_data")
+        loaded = cur.fetchone()[0] or 0
+        if from_month is None:
+            cur.execute(bind(conn, "SELECT MAX(month) FROM price_rollups WHERE level = %s"), (name,))
+            from_month = cur.fetchone()[0]
+            cur.execute(bind(conn, "SELECT loaded_id, stale_month FROM price_rollup_state WHERE level = %s"), (name,))
+            state = cur.fetchone()
+            if from_month is not None and state is not None:
+                cur.execute(bind(conn, "SELECT MIN(date_of_transfer) FROM pp_data WHERE db_id > %s"), (state[0],))
+                earliest = cur.fetchone()[0]
+                months = [from_month, state[1], str(earliest)[:7] if earliest is not None else None]
+                from_month = min(month for month in months if month is not None)
+        if from_month is not None:
+            cur.execute(bind(conn, "DELETE FROM price_rollups WHERE level = %s AND month >= %s"), (name, from_month))
+
+        # Aggregated per log-price bucket in the database, so only bucket counts cross the network
+        query = (f"SELECT {', '.join(keys)}, pp.property_type, {backend_of(conn).month_sql('pp.date_of_transfer')}, FLOOR(LN(pp.price) * %s), \n" +
+                 f"COUNT(*), SUM(pp.price), MIN(pp.price), MAX(pp.price) \n" +
+                 f"FROM pp_data pp \n" +
+                 f"INNER JOIN postcode_data pc ON pp.postcode = pc.postcode \n" +
+                 f"WHERE pp.price > 0" + (" AND pp.date_of_transfer >= %s \n" if from_month is not None else " \n") +
+                 f"GROUP BY {', '.join(str(i+1) for i in range(len(keys) + 3))}")
+        params = params + [SKETCH_RESOLUTION] + ([from_month + '-01'] if from_month is not None else [])
+        groups = {}
+        stream = _streaming_cursor(conn)
+        try:
+            stream.execute(bind(conn, query), tuple(params))
+            # fetchmany rather than iterating the cursor, which not every driver supports
+            for row in _fetch_rows(stream):
+                (key, bucket, count, total, low, high) = (tuple(row[:len(keys) + 2]), row[-5], row[-4], row[-3], row[-2], row[-1])
+                group = groups.setdefault(key, [0, 0.0, low, high, {}])
+                group[0] += count
+                group[1] += float(total)
+                group[2] = min(group[2], low)
+                group[3] = max(group[3], high)
+                group[4][int(bucket)] = group[4].get(int(bucket), 0) + count
+        finally:
+            stream.close()
+
+        rows = []
+        for (key, (n, total, low, high, sketch)) in groups.items():
+            area = str(key[0]) if level == 'district' else f"{int(key[0])}:{int(key[1])}"
+            rows.append((name, area, key[-2], str(key[-1]), n, total, low, high, json.dumps(sketch)))
+        for start in range(0, len(rows), 10000):
+            backend_of(conn).insert_rows(conn, 'price_rollups', ['level', 'area', 'property_type', 'month', 'n', 'total', 'min_price', 'max_price', 'sketch'], rows[start:start+10000])
+        cur.execute(bind(conn, "DELETE FROM price_rollup_state WHERE level = %s"), (name,))
+        cur.execute(bind(conn, "INSERT INTO price_rollup_state (level, loaded_id, stale_month) VALUES (%s, %s, NULL)"), (name, loaded))
+        conn.commit()
+    return len(rows)
+
+@instrument.traced()
+def query_rollups(conn, level = 'district', areas = None, property_type = None, from_month = None, to_month = None, by = ('area', 'property_type', 'month'), quantiles = (0.25, 0.5, 0.75)):
+    """
+    Answer aggregate price questions from the price_rollups table instead of raw transactions,
+    e.g. the median price by district, property type and month
+
+    Argument:
+      conn : (Connection object/ConnectionPool) - connection to database
+      level : (string) - rollup level, e.g. 'district' or rollup_level('cell', 0.1)
+      areas : (list(string)) - only these districts/cells (see rollup_cell), all if None
+      property_type : (string) - only this property type, all if None
+      from_month : (string) - from this month e.g. '2018-01', all if None
+      to_month : (string) - to this month (included) e.g. '2018-12', all if None
+      by : (tuple(string)) - subset of ('area', 'property_type', 'month') to group by, others are merged
+      quantiles : (tuple(double)) - price quantiles to report
+    Output:
+      stats : (DataFrame) - by columns, n, mean, min_price, max_price and one column q<quantile> per quantile
+    """
+    query = "SELECT area, property_type, month, n, total, min_price, max_price, sketch FROM price_rollups WHERE level = %s"
+    params = [level]
+    if areas is not None:
+        query += f" AND area IN ({', '.join(['%s'] * len(areas))})"
+        params += list(areas)
+    if property_type is not None:
+        query += " AND property_type = %s"
+        params.append(property_type)
+    if from_month is not None:
+        query += " AND month >= %s"
+        params.append(from_month)
+    if to_month is not None:
+        query += " AND month <= %s"
+        params.append(to_month)
+    with checkout(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(bind(conn, query), tuple(params))
+        rollups = pd.DataFrame(cur.fetchall(), columns = ['area', 'property_type', 'month', 'n', 'total', 'min_price', 'max_price', 'sketch'])
+
+    by = list(by)
+    # Merged row by row in plain python: one DataFrame slice per group costs more than the merge itself
+    groups = {}
+    for row in rollups.itertuples(index=False):
+        key = tuple(getattr(row, column) for column in by)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0, 0.0, row.min_price, row.max_price, {}]
+        group[0] += row.n
+        group[1] += float(row.total)
+        group[2] = min(group[2], row.min_price)
+        group[3] = max(group[3], row.max_price)
+        for (bucket, count) in json.loads(row.sketch).items():
+            group[4][int(bucket)] = group[4].get(int(bucket), 0) + count
+    stats = []
+    for key in sorted(groups):
+        (n, total, low, high, sketch) = groups[key]
+        record = dict(zip(by, key))
+        record.update({'n': int(n), 'mean': total/n, 'min_price': low, 'max_price': high})
+        for q in quantiles:
+            record[f"q{q:g}"] = sketch_quantile(sketch, q)
+        stats.append(record)
+    return pd.DataFrame(stats, columns = by + ['n', 'mean', 'min_price', 'max_price'] + [f"q{q:g}" for q in quantiles])
 
 def calculate_boundaries(latitude = 52.35, longitude = -2.25, size = 0.1):
     """
@@ -194,12 +1756,10 @@ def calculate_boundaries(latitude = 52.35, longitude = -2.25, size = 0.1):
 
     return (north, south, west, east)
 
-def download_pois(latitude = 52.35, longitude = -2.25, size = 0.1, tags = {"amenity": True, 
-                                                                           "buildings": True, 
-                                                                           "historic": True, 
-                                                                           "leisure": True, 
-                                                                           "shop": True, 
-                                                                           "tourism": True}):
+# OSM tags of the points of interest the features are computed from
+POI_TAGS = {"amenity": True, "buildings": True, "historic": True, "leisure": True, "shop": True, "tourism": True}
+
+def download_pois(latitude = 52.35, longitude = -2.25, size = 0.1, tags = POI_TAGS, tiles = None):
     """
     Function that returns boundaries of a box we are looking at
 
@@ -208,16 +1768,23 @@ def download_pois(latitude = 52.35, longitude = -2.25, size = 0.1, tags = {"amen
       longitude : double - prediction point longitude
       size : double - width/height of box of interest
       tags : dictionary - points of interest that we want to download
+      tiles : TileCache - assemble the points of interest from this local tile cache, always download if None
     Outputs:
       pois : DataFrame - points of interest from OSM
     """  
     (north, south, west, east) = calculate_boundaries(latitude, longitude, size)
 
-    pois = ox.geometries_from_bbox(north, south, east, west, tags)
+    with instrument.span('access.download_pois', tiles=tiles is not None) as span:
+        if tiles is not None:
+            pois = tiles.pois(north, south, west, east, tags)
+        else:
+            pois = ox.geometries_from_bbox(north, south, east, west, tags)
+        span.set(pois=len(pois))
 
     return pois
 
-def download_graph(latitude = 52.35, longitude = -2.25, size = 0.1):
+@instrument.traced()
+def download_graph(latitude = 52.35, longitude = -2.25, size = 0.1, tiles = None):
     """
     Function that returns boundaries of a box we are looking at
 
@@ -225,10 +1792,14 @@ def download_graph(latitude = 52.35, longitude = -2.25, size = 0.1):
       latitude : double - prediction point latitude
       longitude : double - prediction point longitude
       size : double - width/height of box of interest
+      tiles : TileCache - assemble the graph from this local tile cache, always download if None
     Outputs:
       (nodes, edges) - map features for plotting phase
     """  
     (north, south, west, east) = calculate_boundaries(latitude, longitude, size)
+
+    if tiles is not None:
+        return tiles.graph(north, south, west, east)
   
     graph = ox.graph_from_bbox(north, south, east, west)
 
@@ -1,80 +1,612 @@
 # This file contains code for suporting addressing questions in the data
-import numpy as np
-import statsmodels.api as sm
+import os
+import json
+import math
+import hashlib
+import threading
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+sm = lazy_module('statsmodels.api')
+stats = lazy_module('scipy.stats')
 
 from .access import *
 from .assess import *
+from .features import *
+from . import instrument
 
 """Address a particular question that arises from the data"""
 
-def predict_price(conn, latitude, longitude, date, property_type, size):
+# Columns of a prediction, as in statsmodels' summary_frame
+PREDICTION_COLUMNS = ['mean', 'mean_se', 'mean_ci_lower', 'mean_ci_upper', 'obs_ci_lower', 'obs_ci_upper']
+
+def date_window(date, years_back = 2, years_forward = 1):
+    """
+    Window of transactions used to predict the price at a date
+
+    Arguments:
+      date : string - date of prediction e.g. '2018-06-01'
+      years_back : int - years of transactions before the date
+      years_forward : int - years of transactions after the date
+    Output:
+      (from_date, to_date) : (string, string) - window boundaries
+    """
+    date_list = [int(i) for i in date.split('-')]
+    from_date = f'{str(date_list[0]-years_back).zfill(4)}-{str(date_list[1]).zfill(2)}-{str(date_list[2]).zfill(2)}'
+    to_date = f'{str(date_list[0]+years_forward).zfill(4)}-{str(date_list[1]).zfill(2)}-{str(date_list[2]).zfill(2)}'
+    return (from_date, to_date)
+
+def model_columns(pois):
+    """
+    Columns of the price model: a constant, inverse amenity proximity and closest leisure distance
+    (the last two only if the points of interest have amenities/leisure places)
+
+    Arguments:
+      pois : GeoDataFrame - points of interest the features are computed from
+    Output:
+      columns : list(string) - subset of ['const', 'amenity', 'leisure']
+    """
+    return ['const'] + [column for column in ['amenity', 'leisure'] if column in pois.columns]
+
+def design_matrix(features, pois, columns = None):
+    """
+    Design matrix of the price model, see model_columns
+
+    Arguments:
+      features : DataFrame - output of poi_features
+      pois : GeoDataFrame - points of interest the features were computed from
+      columns : list(string) - model columns to build, model_columns(pois) if None
+    Output:
+      design : array - design matrix, one row per feature row
+    """
+    design = []
+    for column in columns or model_columns(pois):
+        if column == 'const':
+            design.append(np.ones(len(features)))
+        elif column == 'amenity':
+            # No amenities at all counts as an amenity_proximity of 1
+            design.append(1/features['amenity_proximity'].to_numpy() if 'amenity_proximity' in features else np.ones(len(features)))
+        elif column == 'leisure':
+            design.append(features['closest_leisure'].to_numpy() if 'closest_leisure' in features else np.full(len(features), np.nan))
+    return np.column_stack(design)
+
+@instrument.traced()
+def fit_model(data, pois, property_type):
+    """
+    Fit the price model on transactions of a property type (all transactions if there are none of that type)
+
+    Arguments:
+      data : DataFrame - transactions with amenity_proximity/closest_leisure features
+      pois : GeoDataFrame - points of interest the features were computed from
+      property_type : string - type of prediction property
+    Output:
+      results : RegressionResults - fitted OLS model
+    """
+    if data[data.property_type == property_type].shape[0] != 0 :
+        data = data[data.property_type == property_type]
+    return sm.OLS(data['price'].to_numpy(dtype=float), design_matrix(data, pois)).fit()
+
+@instrument.traced()
+def add_poi_features(data, pois, store = None):
+    """
+    Add amenity_proximity and closest_leisure features to transactions
+
+    Arguments:
+      data : DataFrame - transactions with lattitude/longitude columns
+      pois : GeoDataFrame - points of interest from OSM
+      store : FeatureStore - read the features of known transactions (by db_id) from this store and
+                             append those of the others, always compute them if None
+    Output:
+      data : DataFrame - the transactions with the feature columns added
+    """
+    if store is not None and 'db_id' in data:
+        features = store.add(data, pois)
+    else:
+        features = poi_features(data.longitude, data.lattitude, pois)
+    for column in features.columns:
+        data[column] = features[column].to_numpy()
+    return data
+
+class ModelRegistry:
+    """
+    Cache of fitted price models, keyed by training region (a tile of the grid), date window and property type.
+
+    Only what a prediction needs is kept: parameters, their covariance, residual scale and degrees of
+    freedom, so a cached model answers with a design matrix dot product instead of a database query and
+    a fit. Models are evicted least recently used beyond `max_models`, can be persisted to a directory,
+    and are dropped when the load manifest changes or when invalidate is called for their region
+    (e.g. after new transactions were materialized there).
+
+    Arguments:
+      directory : string - directory to persist models to, memory only if None
+      max_models : int - models kept in memory, config model_cache_size if None
+      tile_size : double - width/height of the region tiles in degrees, config tile_size if None
+      manifest_file : string - load manifest used for invalidation, config manifest_file if None
+    """
+    def __init__(self, directory = None, max_models = None, tile_size = None, manifest_file = None):
+        self.directory = directory
+        self.max_models = int(max_models if max_models is not None else config.get('model_cache_size', 256))
+        self.tile_size = float(tile_size if tile_size is not None else config.get('tile_size', 0.05))
+        self.manifest_file = manifest_file
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def region_center(self, latitude, longitude):
+        """
+        Centre of the region tile a point falls in.
+
+        Arguments:
+          latitude : double - latitude of the point
+          longitude : double - longitude of the point
+        Output:
+          (latitude, longitude) : (double, double) - centre of the tile
+        """
+        return ((math.floor(latitude/self.tile_size) + 0.5)*self.tile_size, (math.floor(longitude/self.tile_size) + 0.5)*self.tile_size)
+
+    def get(self, key):
+        """
+        Cached model of a key, None if there is none or it is stale.
+
+        Arguments:
+          key : tuple - ((north, south, west, east), from_date, to_date, property_type)
+        Output:
+          model : dictionary/None - see put
+        """
+        name = self._name(key)
+        version = manifest_version(self.manifest_file)
+        with self._lock:
+            model = self._models.get(name)
+            if model is None and self.directory is not None and os.path.exists(self._path(name)):
+                with open(self._path(name)) as handle:
+                    model = json.load(handle)
+            if model is None:
+                return None
+            if model['version'] != version:
+                self._drop(name)
+                return None
+            self._models[name] = model
+            self._models.move_to_end(name)
+            self._evict()
+            return model
+
+    def put(self, key, results, columns):
+        """
+        Store a fitted model.
+
+        Arguments:
+          key : tuple - ((north, south, west, east), from_date, to_date, property_type)
+          results : RegressionResults - fitted OLS model
+          columns : list(string) - model columns, see model_columns
+        Output:
+          model : dictionary - params, cov, scale, df_resid, nobs, columns, region and data version
+        """
+        model = {'params': np.asarray(results.params).tolist(),
+                 'cov': np.asarray(results.cov_params()).tolist(),
+                 'scale': float(results.scale),
+                 'df_resid': float(results.df_resid),
+                 'nobs': int(results.nobs),
+                 'columns': list(columns),
+                 'region': list(key[0]),
+                 'version': manifest_version(self.manifest_file)}
+        name = self._name(key)
+        with self._lock:
+            self._models[name] = model
+            self._models.move_to_end(name)
+            if self.directory is not None:
+                with open(self._path(name), 'w') as handle:
+                    json.dump(model, handle)
+            self._evict()
+        return model
+
+    def invalidate(self, north = None, south = None, west = None, east = None):
+        """
+        Drop models whose region intersects a bounding box, or all models if no box is given.
+
+        Arguments:
+          north, south, west, east : double - boundaries of the box with new transactions
+        Output:
+          N/A
+        """
+        with self._lock:
+            names = set(self._models)
+            if self.directory is not None:
+                names |= {name[:-5] for name in os.listdir(self.directory) if name.endswith('.json')}
+            for name in names:
+                if north is not None:
+                    model = self._models.get(name)
+                    if model is None:
+                        with open(self._path(name)) as handle:
+                            model = json.load(handle)
+                    (n, s, w, e) = model['region']
+                    if n < south or s > north or e < west or w > east:
+                        continue
+                self._drop(name)
+
+    @staticmethod
+    def predict(model, design, alpha = 0.05):
+        """
+        Predict with a cached model, matching statsmodels' summary_frame.
+
+        Arguments:
+          model : dictionary - model from get or put
+          design : array - design matrix built with the model's columns
+          alpha : double - significance level of the intervals
+        Output:
+          prediction : DataFrame - PREDICTION_COLUMNS
+        """
+        design = np.atleast_2d(design)
+        mean = design @ np.asarray(model['params'])
+        mean_se = np.sqrt(np.einsum('ij,jk,ik->i', design, np.asarray(model['cov']), design))
+        obs_se = np.sqrt(mean_se**2 + model['scale'])
+        q = stats.t.ppf(1 - alpha/2, model['df_resid'])
+        return pd.DataFrame({'mean': mean,
+                             'mean_se': mean_se,
+                             'mean_ci_lower': mean - q*mean_se,
+                             'mean_ci_upper': mean + q*mean_se,
+                             'obs_ci_lower': mean - q*obs_se,
+                             'obs_ci_upper': mean + q*obs_se})
+
+    def _name(self, key):
+        return hashlib.md5(json.dumps([[round(value, 9) for value in key[0]], *key[1:]]).encode()).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.json')
+
+    def _drop(self, name):
+        self._models.pop(name, None)
+        if self.directory is not None and os.path.exists(self._path(name)):
+            os.remove(self._path(name))
+
+    def _evict(self):
+        while len(self._models) > self.max_models:
+            self._models.popitem(last=False)
+
+@instrument.traced()
+def predict_price(conn, latitude, longitude, date, property_type, size, cache = None, tiles = None, verbose = False, models = None, store = None):
     """
     Price prediction for UK housing.
     
     Arguments:
-      conn : Connection Object - connection to MariaDB database
+      conn : Connection Object/ConnectionPool - connection to MariaDB database
       latitude : double - latitude of prediction point
       longitude: double - longitude of prediction point
       date : string - date of prediciton
       property_type : string - type of prediction property
       size : double - size of bouding box
+      cache : ExtractCache - local cache for the transaction data, always query the database if None
+      tiles : TileCache - local tile cache for the points of interest, always download if None
+      verbose : bool - print the training data, design and model summary
+      models : ModelRegistry - reuse models fitted for the same region tile, month and property type;
+               the model is then trained around the tile centre from the start of the month
+      store : FeatureStore - features of the training transactions, computed once and shared between calls and processes
     Output:
-      N/A
+      prediction : DataFrame - predicted price with 95% confidence intervals (PREDICTION_COLUMNS)
     """
     
     # Turning warnings off
     warnings.filterwarnings("ignore", category=UserWarning)
+
+    if models is not None:
+        return _predict_price_registry(conn, latitude, longitude, date, property_type, size, cache, tiles, models, store)
     
     # Fetch Data from Database
-    date_list = date.split('-')
-    date_list = [int(i) for i in date_list]
-    date_list[0]-=2
-    from_date = f'{str(date_list[0]).zfill(4)}-{str(date_list[1]).zfill(2)}-{str(date_list[2]).zfill(2)}'
-    date_list[0]+=3
-    to_date = f'{str(date_list[0]).zfill(4)}-{str(date_list[1]).zfill(2)}-{str(date_list[2]).zfill(2)}'
-    data_gdf = download_data_to_gdf(conn, latitude, longitude, size, from_date, to_date)
+    (from_date, to_date) = date_window(date)
+    data_gdf = download_data_to_gdf(conn, latitude, longitude, size, from_date, to_date, cache, geometry = False)
 
     # Download POIS
-    pois = download_pois(latitude, longitude, 0.1)
+    pois = download_pois(latitude, longitude, 0.1, tiles = tiles)
 
     # Add amenity_proximity and closest_leisure Features to Data
-    if 'amenity' in pois.columns:
-        pois_amenity = pois[pois.amenity.notnull()]
-        data_gdf['amenity_proximity'] = [pois_amenity[pois_amenity.geometry.distance(data_gdf.iloc[i].geometry)<=0.01].count().amenity for i in range(data_gdf.shape[0])]
-        data_gdf['amenity_proximity'] += 1
-    if 'leisure' in pois.columns:
-        pois_leisure = pois[pois.leisure.notnull()]
-        data_gdf['closest_leisure'] = [pois_leisure.geometry.distance(data_gdf.iloc[i].geometry).min() for i in range(data_gdf.shape[0])]
+    data_gdf = add_poi_features(data_gdf, pois, store)
 
     # Train Model with Features
-    if data_gdf[data_gdf.property_type == property_type].shape[0] != 0 :
-        data_gdf = data_gdf[data_gdf.property_type == property_type]
-    print(data_gdf)
-    y = data_gdf['price']
-    design = np.ones(data_gdf.shape[0]).reshape(-1,1)
-    if 'amenity' in pois.columns:
-        design = np.concatenate((design, 1/(data_gdf['amenity_proximity']).to_numpy().reshape(-1,1)),axis=1)
-    if 'leisure' in pois.columns:
-        design = np.concatenate((design, (data_gdf['closest_leisure']).to_numpy().reshape(-1,1)),axis=1)
-    m_linear_basis = sm.OLS(y,design)
-    results_basis = m_linear_basis.fit()
+    results_basis = fit_model(data_gdf, pois, property_type)
 
     # Get Required Features for Prediction
-    df_pred = pd.DataFrame(
-    {'Latitude': [latitude],
-     'Longitude': [longitude]})
-    gdf_pred = gpd.GeoDataFrame(df_pred, geometry=gpd.points_from_xy(df_pred.Longitude, df_pred.Latitude))
-    design_pred = [[1]]
+    design_pred = design_matrix(poi_features([longitude], [latitude], pois), pois)
+    y_pred_linear_basis = results_basis.get_prediction(design_pred).summary_frame(alpha=0.05)
+    if verbose:
+        print(data_gdf)
+        print(design_pred)
+        print(results_basis.summary())
+        print(y_pred_linear_basis)
+    return y_pred_linear_basis
+
+def _predict_price_registry(conn, latitude, longitude, date, property_type, size, cache, tiles, models, store = None):
+    """
+    predict_price through a model registry: fit only on a registry miss.
+    """
+    (center_latitude, center_longitude) = models.region_center(latitude, longitude)
+    (from_date, to_date) = date_window(date[:8] + '01')
+    key = (calculate_boundaries(center_latitude, center_longitude, size), from_date, to_date, property_type)
+    model = models.get(key)
+    instrument.count('address.registry.hit' if model is not None else 'address.registry.miss')
+    if model is None:
+        data_gdf = download_data_to_gdf(conn, center_latitude, center_longitude, size, from_date, to_date, cache, geometry = False)
+        pois = download_pois(center_latitude, center_longitude, max(size, 0.1), tiles = tiles)
+        data_gdf = add_poi_features(data_gdf, pois, store)
+        model = models.put(key, fit_model(data_gdf, pois, property_type), model_columns(pois))
+    pois = download_pois(latitude, longitude, 0.1, tiles = tiles)
+    design_pred = design_matrix(poi_features([longitude], [latitude], pois), pois, model['columns'])
+    return models.predict(model, design_pred)
+
+@instrument.traced()
+def predict_prices(conn, queries, size = 0.1, processes = None, cache = None, tiles = None, store = None):
+    """
+    Batch price prediction for many points.
+
+    Queries are grouped by grid cell of width `size` and year. Every group shares one data fetch and one
+    set of points of interest covering its cell plus a margin of size/2 (the context predict_price would
+    use for each point), and one model is fitted per property type in the group on the union of the
+    groups' date windows. Groups run in parallel over a process pool, except on backends whose database
+    only one process can open (DuckDB), where they run in this process.
+
+    Arguments:
+      conn : Connection Object/ConnectionPool - connection to MariaDB database, only used without processes;
+             a connection with the config settings is opened if None and the groups run in this process
+      queries : DataFrame - columns latitude, longitude, date (e.g. '2018-06-01') and property_type
+      size : double - size of bouding box (and of the grouping grid)
+      processes : int - number of worker processes, each opening one connection with the config settings; run in this process if None
+      cache : ExtractCache - local cache for the transaction data
+      tiles : TileCache - local tile cache for the points of interest
+      store : FeatureStore - features of the training transactions, mapped by every worker process
+    Output:
+      predictions : DataFrame - PREDICTION_COLUMNS and the number of training transactions (n_train), indexed like queries
+    """
+    keys = pd.DataFrame({'row': np.floor(queries.latitude.to_numpy(dtype=float)/size).astype(int),
+                         'column': np.floor(queries.longitude.to_numpy(dtype=float)/size).astype(int),
+                         'year': queries.date.str[:4].to_numpy()}, index=queries.index)
+    groups = [(size, group, cache, tiles, store) for (_, group) in queries.groupby([keys.row, keys.column, keys.year])]
+    if processes is not None and not get_backend().multiprocess:
+        processes = None
+    if processes is None:
+        connection = conn if conn is not None else create_connection()
+        if connection is None:
+            raise ConnectionError("Could not connect to the database")
+        try:
+            results = [_predict_group(connection, *group) for group in groups]
+        finally:
+            if conn is None:
+                connection.close()
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_predict_worker_init) as executor:
+            results = list(executor.map(_predict_group_worker, groups))
+    if not results:
+        return pd.DataFrame(columns=PREDICTION_COLUMNS + ['n_train'])
+    return pd.concat(results).reindex(queries.index)
+
+# Connection of a predict_prices worker process, opened once by _predict_worker_init and closed when the process exits
+_worker_conn = None
+
+def _predict_worker_init():
+    global _worker_conn
+    _worker_conn = create_connection()
+
+def _predict_group_worker(group):
+    if _worker_conn is None:
+        raise ConnectionError("Could not connect to the database")
+    return _predict_group(_worker_conn, *group)
+
+@instrument.traced('address.predict_group')
+def _predict_group(conn, size, queries, cache, tiles, store = None):
+    """
+    Predict all queries of one grid cell with one data fetch, one POI download and one fit per property type.
+    """
+    warnings.filterwarnings("ignore", category=UserWarning)
+    latitude = (np.floor(queries.latitude.iloc[0]/size) + 0.5)*size
+    longitude = (np.floor(queries.longitude.iloc[0]/size) + 0.5)*size
+    windows = [date_window(date) for date in queries.date]
+    from_date = min(window[0] for window in windows)
+    to_date = max(window[1] for window in windows)
+
+    data = joinPriceAndLocationData(conn, longitude-size, longitude+size, latitude-size, latitude+size, from_date, to_date) if cache is None else \
+           cache.get(conn, longitude-size, longitude+size, latitude-size, latitude+size, from_date, to_date)
+    predictions = pd.DataFrame(np.nan, index=queries.index, columns=PREDICTION_COLUMNS + ['n_train'])
+    if len(data) == 0:
+        predictions['n_train'] = 0
+        return predictions
+    pois = download_pois(latitude, longitude, 2*size, tiles = tiles)
+    data = add_poi_features(data, pois, store)
+    design = design_matrix(poi_features(queries.longitude, queries.latitude, pois), pois)
+
+    for property_type in queries.property_type.unique():
+        rows = (queries.property_type == property_type).to_numpy()
+        results = fit_model(data, pois, property_type)
+        frame = results.get_prediction(design[rows]).summary_frame(alpha=0.05)
+        predictions.loc[rows, PREDICTION_COLUMNS] = frame[PREDICTION_COLUMNS].to_numpy()
+        predictions.loc[rows, 'n_train'] = results.nobs
+    return predictions
+
+
+# Metres per degree of latitude (and of longitude at the equator), to widen boxes by a radius
+METRES_PER_DEGREE = 111320.0
+# Columns of the sweep report
+SWEEP_COLUMNS = ['radius', 'years_back', 'years_forward', 'n_test', 'rmse', 'mae', 'mape', 'coverage']
+# Property types of the price paid data
+PROPERTY_TYPES = ['D', 'S', 'T', 'F', 'O']
+
+def spatial_folds(latitude, longitude, block_size, folds, seed = 0):
+    """
+    Assign points to cross-validation folds by spatial block, so that neighbouring transactions (which
+    share their location features) are never split between training and test data
+
+    Arguments:
+      latitude, longitude : array - coordinates of the points
+      block_size : double - width/height of a block in degrees
+      folds : int - number of folds
+      seed : int - seed of the random assignment of blocks to folds
+    Output:
+      fold : array(int) - fold of every point
+    """
+    blocks = np.floor(np.asarray(latitude, dtype=float)/block_size).astype(np.int64)*1000003 + np.floor(np.asarray(longitude, dtype=float)/block_size).astype(np.int64)
+    (unique, inverse) = np.unique(blocks, return_inverse=True)
+    order = np.random.default_rng(seed).permutation(len(unique))
+    return (order % folds)[inverse]
+
+def sweep_features(data, pois, radii):
+    """
+    Feature grid of a sweep: everything the configurations need, as plain arrays, computed once
+
+    Arguments:
+      data : DataFrame - transactions of the region
+      pois : GeoDataFrame - points of interest covering the region and a margin of the largest radius
+      radii : list(double) - amenity radii in metres
+    Output:
+      arrays : dictionary(array) - price, days (date of transfer, days since 1970), property_type (codes),
+                                   amenity ((transactions, radii) inverse amenity proximity) and leisure (closest leisure distance)
+    """
+    points = to_metric(data.longitude, data.lattitude)
+    arrays = {'price': data['price'].to_numpy(dtype=float),
+              'days': pd.to_datetime(data['date_of_transfer']).to_numpy().astype('datetime64[D]').astype(np.int64),
+              'property_type': pd.Categorical(data['property_type'], categories=PROPERTY_TYPES).codes.astype(np.int64)}
     if 'amenity' in pois.columns:
-        amenity_proximity_pred = pois_amenity[pois_amenity.geometry.distance(gdf_pred.geometry[0])<=0.01].count().amenity
-        design_pred = design_pred = np.concatenate((design_pred, [[1/(amenity_proximity_pred+1)]]),axis=1)
+        amenities = geometries_to_metric(pois[pois.amenity.notnull()])
+        arrays['amenity'] = 1/(count_within_radii(points, amenities, radii) + 1.0)
     if 'leisure' in pois.columns:
-        closest_leisure_pred = pois_leisure.geometry.distance(gdf_pred.geometry[0]).min()
-        design_pred = np.concatenate((design_pred, [[closest_leisure_pred]]),axis=1)
-    y_pred_linear_basis = results_basis.get_prediction(design_pred).summary_frame(alpha=0.05)
-    print(design_pred)
-    print(results_basis.summary())
-    print(y_pred_linear_basis)
-    pass
+        arrays['leisure'] = nearest_distance(points, geometries_to_metric(pois[pois.leisure.notnull()]))
+    return arrays
+
+def _ols(design, price):
+    """
+    Least squares fit, with what prediction intervals need: parameters, (X'X)^-1, residual variance and degrees of freedom.
+    """
+    (params, _, rank, _) = np.linalg.lstsq(design, price, rcond=None)
+    df_resid = len(price) - rank
+    scale = float(np.sum((price - design @ params)**2)/df_resid) if df_resid > 0 else np.nan
+    return (params, np.linalg.pinv(design.T @ design), scale, df_resid)
+
+def _evaluate(arrays, radius_index, window, folds, test_days):
+    """
+    Spatially blocked cross-validation of the price model with one radius and window: for every fold, fit
+    fit_model's OLS per property type on the other folds' transactions within the window, and predict the
+    fold's transactions within the test period.
+    """
+    (from_day, to_day) = window
+    in_window = (arrays['days'] >= from_day) & (arrays['days'] <= to_day)
+    in_test = (arrays['days'] >= test_days[0]) & (arrays['days'] <= test_days[1])
+    columns = [np.ones(len(arrays['price']))]
+    if 'amenity' in arrays:
+        columns.append(arrays['amenity'][:, radius_index])
+    if 'leisure' in arrays:
+        columns.append(arrays['leisure'])
+    design = np.column_stack(columns)
+    valid = np.isfinite(design).all(axis=1)
+    (errors, prices, covered) = ([], [], [])
+    for fold in np.unique(arrays['fold']):
+        train = in_window & valid & (arrays['fold'] != fold)
+        test = in_test & valid & (arrays['fold'] == fold)
+        for property_type in np.unique(arrays['property_type'][test]):
+            rows = test & (arrays['property_type'] == property_type)
+            typed = train & (arrays['property_type'] == property_type)
+            # As fit_model: all transactions when there are none of the property type
+            fit_rows = typed if typed.any() else train
+            if fit_rows.sum() <= design.shape[1]:
+                continue
+            (params, inverse, scale, df_resid) = _ols(design[fit_rows], arrays['price'][fit_rows])
+            prediction = design[rows] @ params
+            obs_se = np.sqrt(scale*(1 + np.einsum('ij,jk,ik->i', design[rows], inverse, design[rows])))
+            errors.append(prediction - arrays['price'][rows])
+            prices.append(arrays['price'][rows])
+            covered.append(np.abs(errors[-1]) <= stats.t.ppf(0.975, df_resid)*obs_se)
+    if not errors:
+        return {'n_test': 0, 'rmse': np.nan, 'mae': np.nan, 'mape': np.nan, 'coverage': np.nan}
+    (errors, prices, covered) = (np.concatenate(errors), np.concatenate(prices), np.concatenate(covered))
+    return {'n_test': len(errors), 'rmse': float(np.sqrt(np.mean(errors**2))), 'mae': float(np.mean(np.abs(errors))),
+            'mape': float(np.mean(np.abs(errors)/prices)), 'coverage': float(np.mean(covered))}
+
+# Feature grid of a sweep worker process, attached to the shared memory of the parent
+_shared = {}
+
+def _attach(descriptors):
+    """
+    Map the parent's shared memory feature arrays in a worker process, without copying them.
+    """
+    for (key, (name, shape, dtype)) in descriptors.items():
+        block = shared_memory.SharedMemory(name=name)
+        _shared[key] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+def _evaluate_shared(task):
+    arrays = {key: array for (key, (_, array)) in _shared.items()}
+    return _evaluate(arrays, *task)
+
+def _to_days(date):
+    return int(np.datetime64(date, 'D').astype(np.int64))
+
+@instrument.traced()
+def sweep(conn, latitude, longitude, date, size = 0.1, radii = (250, 500, 1000, 2000), windows = ((1, 0), (1, 1), (2, 1), (3, 1), (5, 1)),
+          folds = 5, block_size = 0.01, test_months = 6, processes = None, cache = None, tiles = None, seed = 0):
+    """
+    Evaluate the price model over a grid of amenity radii and training windows with spatially blocked cross-validation.
+
+    The transactions of the widest window and the points of interest are fetched once, and the features of every
+    radius are computed in one pass. Every configuration then runs the same folds: the transactions of a set of
+    spatial blocks within test_months of the date are predicted by models fitted on the other blocks' transactions
+    within the configuration's window. Configurations run in parallel over a process pool that maps the feature
+    arrays from shared memory.
+
+    Arguments:
+      conn : Connection Object/ConnectionPool - connection to the database
+      latitude, longitude : double - centre of the region
+      date : string - date the predictions are for, e.g. '2018-06-01'
+      size : double - size of the region
+      radii : iterable(double) - amenity radii in metres (predict_price uses 1000)
+      windows : iterable((int, int)) - (years_back, years_forward) training windows (predict_price uses (2, 1))
+      folds : int - number of cross-validation folds
+      block_size : double - width/height of the spatial blocks in degrees
+      test_months : int - months either side of the date whose transactions are predicted
+      processes : int - worker processes, run in this process if None
+      cache : ExtractCache - local cache for the transaction data
+      tiles : TileCache - local tile cache for the points of interest
+      seed : int - seed of the assignment of blocks to folds
+    Output:
+      report : DataFrame - SWEEP_COLUMNS for every configuration, best root mean squared error first
+    """
+    (radii, windows) = (list(radii), list(windows))
+    from_date = date_window(date, max(back for (back, _) in windows), 0)[0]
+    to_date = date_window(date, 0, max(forward for (_, forward) in windows))[1]
+    if cache is not None:
+        data = cache.get(conn, longitude-size/2, longitude+size/2, latitude-size/2, latitude+size/2, from_date, to_date)
+    else:
+        data = joinPriceAndLocationData(conn, longitude-size/2, longitude+size/2, latitude-size/2, latitude+size/2, from_date, to_date)
+    if len(data) == 0:
+        return pd.DataFrame(columns=SWEEP_COLUMNS)
+    # A degree of longitude is cos(latitude) times shorter than one of latitude, so the margin of the largest
+    # radius is widest in longitude, at the edge of the region furthest from the equator
+    margin = 2*max(radii)/(METRES_PER_DEGREE*np.cos(np.radians(min(abs(latitude) + size/2, 89.0))))
+    pois = download_pois(latitude, longitude, size + margin, tiles = tiles)
+
+    arrays = sweep_features(data, pois, radii)
+    arrays['fold'] = spatial_folds(data.lattitude, data.longitude, block_size, folds, seed)
+    day = _to_days(date)
+    test_days = (day - round(test_months*30.44), day + round(test_months*30.44))
+    configurations = [(radius, back, forward) for radius in radii for (back, forward) in windows]
+    tasks = [(radii.index(radius), tuple(_to_days(bound) for bound in date_window(date, back, forward)), folds, test_days)
+             for (radius, back, forward) in configurations]
 
+    if processes is None:
+        results = [_evaluate(arrays, *task) for task in tasks]
+    else:
+        blocks = []
+        try:
+            descriptors = {}
+            for (key, array) in arrays.items():
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                descriptors[key] = (block.name, array.shape, array.dtype.str)
+            with ProcessPoolExecutor(max_workers=processes, initializer=_attach, initargs=(descriptors,)) as executor:
+                results = list(executor.map(_evaluate_shared, tasks))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    report = pd.DataFrame([dict(zip(['radius', 'years_back', 'years_forward'], configuration), **result)
+                           for (configuration, result) in zip(configurations, results)], columns=SWEEP_COLUMNS)
+    return report.sort_values('rmse', ignore_index=True)
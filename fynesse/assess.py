@@ -1,54 +1,111 @@
 from .config import *
 
 from .access import *
+from . import instrument
 
-import mlai
-import mlai.plot as plot
-import geopandas as gpd
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
-# Setting font of our plots
-plt.rcParams.update({'font.size': 22})
+from .lazy import lazy_module
+
+mlai = lazy_module('mlai')
+plot = lazy_module('mlai.plot')
+gpd = lazy_module('geopandas')
+plt = lazy_module('matplotlib.pyplot')
+shapely = lazy_module('shapely')
+colors = lazy_module('matplotlib.colors')
+figure = lazy_module('matplotlib.figure')
+backend_agg = lazy_module('matplotlib.backends.backend_agg')
+
+_plotting = False
 
 """Place commands in this file to assess the data you have downloaded. How are missing values encoded, how are outliers encoded? What do columns represent, makes rure they are correctly labeled. How is the data indexed. Crete visualisation routines to assess the data (e.g. in bokeh). Ensure that date formats are correct and correctly timezoned."""
 
 
-def download_data_to_gdf(conn, latitude, longitude, size, from_date, to_date):
+@instrument.traced()
+def download_data_to_gdf(conn, latitude, longitude, size, from_date, to_date, cache = None, geometry = True):
     """
     Function that downloads data and adds geometry column.
   
     Argumnets:
-      conn : Connection Object - Connection to MariaDB database
+      conn : Connection Object/ConnectionPool - Connection to MariaDB database
       latitude : double - latitude of prediction point
       longitude : double - longitude of prediction point
       size : double - size of the box of interest
       from_date : string - download data from date
       to_date : string - download data to date
+      cache : ExtractCache - serve the data from this local cache when possible, always query the database if None
+      geometry : bool - add the geometry column; without it the plain typed DataFrame is returned, and
+                        to_gdf builds the points later if a spatial operation needs them
     Output:
       data_gdf : GeoPandasDataFrame - dataframe with data and added geometry column
     """
-    data = joinPriceAndLocationData(conn, longitude-size/2, longitude+size/2, latitude-size/2, latitude+size/2, from_date, to_date)
+    if cache is not None:
+        data = cache.get(conn, longitude-size/2, longitude+size/2, latitude-size/2, latitude+size/2, from_date, to_date)
+    else:
+        data = joinPriceAndLocationData(conn, longitude-size/2, longitude+size/2, latitude-size/2, latitude+size/2, from_date, to_date)
 
+    if not geometry:
+        return data
+    return to_gdf(data)
+
+def to_gdf(data):
+    """
+    Function that adds a point geometry column to transaction data.
+
+    Argumnets:
+      data : DataFrame - transactions with lattitude/longitude columns
+    Output:
+      data_gdf : GeoPandasDataFrame - dataframe with data and added geometry column
+    """
     geometry=gpd.points_from_xy(data.longitude, data.lattitude)
     data_gdf = gpd.GeoDataFrame(data, 
                             geometry=geometry)
     data_gdf.crs = "EPSG:4326"
     return data_gdf
 
-def plot_points_interest(pois, edges, data_gdf, latitude = 52.35, longitude = -2.25, size = 0.1, plot_title = 'All Data'):
+def setup_plotting():
     """
-    Function that downloads data and adds geometry column.
+    Function that sets the font of our plots, once, when the first plot is drawn.
+    """
+    global _plotting
+    if not _plotting:
+        plt.rcParams.update({'font.size': 22})
+        _plotting = True
+
+def plot_points_interest(pois, edges, data_gdf, latitude = 52.35, longitude = -2.25, size = 0.1, plot_title = 'All Data', raster = False, pixels = 1024, aggregate = 'grid'):
+    """
+    Function that plots the street map, transactions and points of interest of a region.
   
     Argumnets:
       pois : DataFrame - points of interest from OSM
       edges - data required to print the map look
-      data_gdf : GeoPandasDataFrame - transaction data with added geometry column
+      data_gdf : GeoPandasDataFrame - transaction data with added geometry column (or plain transaction data when raster)
       latitude : double - latitude of the prediction point
       longitude : double - longitude of the prediction point
       size : double - size of the box of interest
+      raster : bool - draw a PNG at the output resolution instead of an SVG with an artist per feature: edges are
+                      simplified to a pixel and drawn as one line, transactions are binned into a price raster
+      pixels : int - width/height of the raster map
+      aggregate : string - 'grid' or 'hexbin' binning of the transactions of a raster map
     Output:
       N/A
     """
+    setup_plotting()
+    (north, south, west, east) = calculate_boundaries(latitude = latitude, longitude = longitude, size = size)
+    if raster:
+        fig, ax = plt.subplots(figsize=plot.big_figsize)
+        ax.set_title(plot_title)
+        layers = map_layers(pois, edges, data_gdf, tolerance = size/pixels)
+        norm = colors.LogNorm(*price_range(layers['price']))
+        _draw_layers(ax, layers, (west, east, south, north), norm, bins = pixels//8, aggregate = aggregate, pixel = 72.0*plot.big_figsize[0]/pixels)
+        ax.set_xlim([west, east])
+        ax.set_ylim([south, north])
+        ax.set_xlabel("longitude")
+        ax.set_ylabel("latitude")
+        plt.tight_layout()
+        mlai.write_figure(directory="./maps", filename="health-care-pois.png", dpi = pixels/plot.big_figsize[0])
+        return
+
     fig, ax = plt.subplots(figsize=plot.big_figsize)
     
     ax.set_title(plot_title)
@@ -58,8 +115,6 @@ def plot_points_interest(pois, edges, data_gdf, latitude = 52.35, longitude = -2
     # Plot transaction data
     data_gdf.plot(ax=ax, c=data_gdf.price/data_gdf.price.max()*100, cmap = 'YlOrRd', markersize=10)
 
-    (north, south, west, east) = calculate_boundaries(latitude = latitude, longitude = longitude, size = size)
-    
     # Set bounds on the plot
     ax.set_xlim([west, east])
     ax.set_ylim([south, north])
@@ -71,6 +126,185 @@ def plot_points_interest(pois, edges, data_gdf, latitude = 52.35, longitude = -2
     plt.tight_layout()
     mlai.write_figure(directory="./maps", filename="health-care-pois.svg")
 
+# Pixels of a side of a map tile
+TILE_PIXELS = 256
+
+def map_layers(pois, edges, data, tolerance = 0.0):
+    """
+    Function that turns the map features into plain coordinate arrays, cheap to draw, clip and send to worker processes.
+
+    Arguments:
+      pois : GeoDataFrame - points of interest, drawn at their centroids
+      edges : GeoDataFrame - street edges
+      data : DataFrame - transactions with lattitude, longitude and price columns
+      tolerance : double - edges are simplified to this tolerance in degrees, about a pixel of the output
+    Output:
+      layers : dictionary - 'edges' (longitude/latitude rows of all edges, each followed by a NaN row, so they draw as one line),
+                            'edge_index' (edge of every row), 'edge_bounds' ((k, 4) west, south, east, north of every edge),
+                            'pois' ((m, 2) array), 'points' ((t, 2) array) and 'price' (t array)
+    """
+    geometries = np.asarray(edges.geometry) if edges is not None and len(edges) else np.empty(0, dtype=object)
+    if tolerance > 0 and len(geometries):
+        # Plain Douglas-Peucker, topology does not matter at a pixel
+        geometries = shapely.simplify(geometries, tolerance, preserve_topology=False)
+    (lines, index) = shapely.get_coordinates(geometries, return_index=True)
+    bounds = shapely.bounds(geometries) if len(geometries) else np.empty((0, 4))
+    if len(index):
+        # A NaN row after the last point of every edge
+        ends = np.append(np.flatnonzero(np.diff(index)) + 1, len(index))
+        lines = np.insert(lines, ends, np.nan, axis=0)
+        index = np.insert(index, ends, index[ends - 1])
+    centroids = shapely.get_coordinates(shapely.centroid(np.asarray(pois.geometry))) if pois is not None and len(pois) else np.empty((0, 2))
+    points = np.column_stack([np.asarray(data.longitude, dtype=float), np.asarray(data.lattitude, dtype=float)])
+    return {'edges': lines, 'edge_index': index, 'edge_bounds': bounds, 'pois': centroids, 'points': points, 'price': np.asarray(data.price, dtype=float)}
+
+def price_range(price):
+    """
+    Function that returns the price range of the colour scale, shared by all tiles of a map
+    """
+    if not len(price):
+        return (1.0, 2.0)
+    (low, high) = np.percentile(price, [2, 98])
+    return (max(float(low), 1.0), max(float(high), float(low) + 1.0))
+
+def _draw_layers(ax, layers, extent, norm, bins, aggregate = 'grid', project = None, pixel = 1.0):
+    """
+    Function that draws map layers onto axes: one line artist for the edges, a binned mean price raster
+    for the transactions and one marker artist for the points of interest.
+
+    Arguments:
+      ax : Axes - axes to draw on
+      layers : dictionary - map_layers of the area
+      extent : (double, double, double, double) - west, east, south, north of the area, in the drawing coordinates
+      norm : Normalize - colour scale of the prices
+      bins : int - bins per side of the price raster
+      aggregate : string - 'grid' for a square raster, 'hexbin' for hexagons
+      project : function - maps longitude and latitude arrays to drawing coordinates, identity if None
+      pixel : double - size of an output pixel in points, line widths and markers are a pixel or two
+    """
+    project = project or (lambda x, y: (x, y))
+    (west, east, south, north) = extent
+    edges = layers['edges']
+    if len(edges):
+        ax.plot(*project(edges[:, 0], edges[:, 1]), color="dimgray", linewidth=pixel)
+    (x, y) = project(layers['points'][:, 0], layers['points'][:, 1])
+    if len(x) and aggregate == 'hexbin':
+        ax.hexbin(x, y, C=layers['price'], reduce_C_function=np.mean, gridsize=bins, extent=(*sorted((west, east)), *sorted((south, north))), cmap='YlOrRd', norm=norm, mincnt=1)
+    elif len(x):
+        ranges = [sorted((west, east)), sorted((south, north))]
+        (counts, xs, ys) = np.histogram2d(x, y, bins=bins, range=ranges)
+        (sums, _, _) = np.histogram2d(x, y, bins=bins, range=ranges, weights=layers['price'])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.ma.masked_invalid(sums/counts)
+        ax.pcolormesh(xs, ys, mean.T, cmap='YlOrRd', norm=norm)
+    if len(layers['pois']):
+        ax.plot(*project(layers['pois'][:, 0], layers['pois'][:, 1]), linestyle='none', marker='o', markersize=2*pixel, markeredgewidth=0, color="blue", alpha=0.7)
+
+def _mercator(longitude, latitude):
+    """
+    Function that returns Web Mercator coordinates, as fractions of the world from west to east and north to south.
+    """
+    x = (np.asarray(longitude, dtype=float) + 180.0)/360.0
+    phi = np.radians(np.asarray(latitude, dtype=float))
+    y = (1.0 - np.log(np.tan(phi) + 1.0/np.cos(phi))/math.pi)/2.0
+    return (x, y)
+
+def tile_bounds(zoom, x, y):
+    """
+    Function that returns the boundaries of a XYZ (slippy map) tile
+
+    Arguments:
+      zoom, x, y : int - tile coordinates
+    Output:
+      (north, south, west, east) - boundaries of the tile
+    """
+    n = 2**zoom
+    latitude = lambda row: math.degrees(math.atan(math.sinh(math.pi*(1 - 2*row/n))))
+    return (latitude(y), latitude(y + 1), x/n*360.0 - 180.0, (x + 1)/n*360.0 - 180.0)
+
+def tiles_covering(north, south, west, east, zoom):
+    """
+    Function that returns the XYZ tiles covering a region at a zoom level
+
+    Output:
+      tiles : list((int, int, int)) - (zoom, x, y) of the tiles
+    """
+    n = 2**zoom
+    (left, right) = _mercator([west, east], [north, south])[0]*n
+    (top, bottom) = _mercator([west, east], [north, south])[1]*n
+    (x0, y0) = (max(int(math.floor(left)), 0), max(int(math.floor(top)), 0))
+    (x1, y1) = (min(max(int(math.ceil(right)), x0 + 1), n), min(max(int(math.ceil(bottom)), y0 + 1), n))
+    return [(zoom, x, y) for x in range(x0, x1) for y in range(y0, y1)]
+
+def _tile_layers(layers, bounds, margin):
+    """
+    Function that clips map layers to a tile, plus a margin so features on its border are drawn on both sides.
+    """
+    (north, south, west, east) = bounds
+    (west, east, south, north) = (west - margin, east + margin, south - margin, north + margin)
+    edge_bounds = layers['edge_bounds']
+    keep = np.flatnonzero((edge_bounds[:, 0] <= east) & (edge_bounds[:, 2] >= west) & (edge_bounds[:, 1] <= north) & (edge_bounds[:, 3] >= south))
+    inside = lambda points: (points[:, 0] >= west) & (points[:, 0] <= east) & (points[:, 1] >= south) & (points[:, 1] <= north)
+    points = inside(layers['points'])
+    rows = np.zeros(len(edge_bounds), dtype=bool)
+    rows[keep] = True
+    rows = rows[layers['edge_index']]
+    return {'edges': layers['edges'][rows], 'edge_index': np.searchsorted(keep, layers['edge_index'][rows]), 'edge_bounds': edge_bounds[keep], 'pois': layers['pois'][inside(layers['pois'])],
+            'points': layers['points'][points], 'price': layers['price'][points]}
+
+def _render_tile(tile, layers, price_limits, path, aggregate):
+    """
+    Function that renders one XYZ tile to a PNG, with the Agg backend directly so it runs in worker processes.
+    """
+    (zoom, x, y) = tile
+    n = 2**zoom
+    fig = figure.Figure(figsize=(1, 1), dpi=TILE_PIXELS)
+    backend_agg.FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    # Hexagons or grid cells of about 8 pixels
+    _draw_layers(ax, layers, (x/n, (x + 1)/n, (y + 1)/n, y/n), colors.LogNorm(*price_limits), bins=TILE_PIXELS//8,
+                 aggregate=aggregate, project=_mercator, pixel=72.0/TILE_PIXELS)
+    ax.set_xlim(x/n, (x + 1)/n)
+    ax.set_ylim((y + 1)/n, y/n)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fig.savefig(path, transparent=True)
+    return path
+
+@instrument.traced()
+def render_tiles(pois, edges, data, north, south, west, east, zooms = range(10, 16), directory = "./maps/tiles", workers = 1, aggregate = 'grid'):
+    """
+    Function that renders a pyramid of PNG map tiles of a region: street edges, binned mean transaction prices and points of interest,
+    in the XYZ layout of web maps ({directory}/{zoom}/{x}/{y}.png). Edges are simplified to a pixel of every zoom level once, and the
+    tiles are drawn in parallel processes.
+
+    Arguments:
+      pois : GeoDataFrame - points of interest from OSM
+      edges : GeoDataFrame - street edges, e.g. from download_graph
+      data : DataFrame - transactions with lattitude, longitude and price columns
+      north, south, west, east : double - boundaries of the region
+      zooms : iterable(int) - zoom levels of the pyramid
+      directory : string - directory of the tiles
+      workers : int - processes drawing the tiles
+      aggregate : string - 'grid' or 'hexbin' binning of the transactions
+    Output:
+      paths : list(string) - written tiles, tiles without any feature are skipped
+    """
+    price_limits = price_range(np.asarray(data.price, dtype=float))
+    tasks = []
+    for zoom in zooms:
+        pixel = 360.0/(2**zoom*TILE_PIXELS)
+        layers = map_layers(pois, edges, data, tolerance = pixel)
+        for tile in tiles_covering(north, south, west, east, zoom):
+            clipped = _tile_layers(layers, tile_bounds(*tile), 8*pixel)
+            if len(clipped['edges']) or len(clipped['points']) or len(clipped['pois']):
+                tasks.append((tile, clipped, price_limits, os.path.join(directory, *map(str, tile)) + ".png", aggregate))
+    instrument.count('assess.tiles', len(tasks))
+    if workers <= 1:
+        return [_render_tile(*task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_render_tile, *zip(*tasks))) if tasks else []
+
 def plot_data(data, property_type, feature, title):
     """
     Function that plots price against features plots.
@@ -83,8 +317,255 @@ def plot_data(data, property_type, feature, title):
     Output:
       N/A
     """
+    setup_plotting()
     plt.title(title)
     plt.scatter(data[data.property_type == property_type][feature], data[data.property_type == property_type]['price'])
     plt.show()
 
 
+
+# Plausible coordinates of UK postcodes (Great Britain and Northern Ireland, with the Channel Islands and Shetland)
+UK_LATTITUDE = (49.0, 61.0)
+UK_LONGITUDE = (-8.7, 2.0)
+# Numeric columns of the profiled tables; everything else is profiled as text
+NUMERIC_COLUMNS = ['price', 'lattitude', 'longitude', 'easting', 'northing', 'positional_quality_indicator', 'db_id']
+
+
+class HyperLogLog:
+    """
+    Mergeable distinct count sketch, with a relative error of about 1.04/sqrt(2^precision)
+    (1.6% for the default precision of 12) in 2^precision bytes.
+
+    Arguments:
+      precision : int - number of bits addressing the registers
+    """
+    def __init__(self, precision = 12):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def update(self, values):
+        """
+        Add values (a pandas Series or array), nulls are skipped.
+        """
+        values = pd.Series(values)
+        values = values[values.notnull()]
+        if not len(values):
+            return
+        hashes = pd.util.hash_pandas_object(values.astype(str) if values.dtype == object else values, index=False).to_numpy()
+        bits = 64 - self.precision
+        index = (hashes >> np.uint64(bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << bits) - 1)
+        # Rank of the leftmost 1 bit of the remaining bits, bits + 1 for all zeros
+        rank = np.where(rest > 0, bits - np.floor(np.log2(np.maximum(rest, 1).astype(float))), bits + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        """
+        Merge another sketch of the same precision into this one.
+        """
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        """
+        Estimated number of distinct values.
+        """
+        m = len(self.registers)
+        alpha = 0.7213/(1 + 1.079/m)
+        estimate = alpha*m*m/np.sum(np.power(2.0, -self.registers.astype(float)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5*m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m*math.log(m/zeros)
+        return int(round(estimate))
+
+class ColumnProfile:
+    """
+    Streaming, mergeable profile of one column: rows, nulls, empty strings, distinct values (HyperLogLog)
+    and, for numeric columns, unparseable values and the range. Prices also keep a price_sketch for quantiles.
+
+    Arguments:
+      name : string - column name
+      numeric : bool - profile the values as numbers
+      precision : int - HyperLogLog precision
+    """
+    def __init__(self, name, numeric = False, precision = 12):
+        self.name = name
+        self.numeric = numeric
+        self.rows = 0
+        self.nulls = 0
+        self.empty = 0
+        self.invalid = 0
+        self.minimum = None
+        self.maximum = None
+        self.distinct = HyperLogLog(precision)
+        self.sketch = {} if name == 'price' else None
+
+    def update(self, values):
+        values = pd.Series(values)
+        nulls = values.isnull()
+        self.rows += len(values)
+        self.nulls += int(nulls.sum())
+        # Text columns are object or, from pandas 3, string dtype
+        empty = (values == '').fillna(False).astype(bool) if pd.api.types.is_string_dtype(values.dtype) else pd.Series(False, index=values.index)
+        self.empty += int(empty.sum())
+        self.distinct.update(values)
+        if self.numeric:
+            numbers = pd.to_numeric(values, errors='coerce')
+            self.invalid += int((numbers.isnull() & ~nulls & ~empty).sum())
+            numbers = numbers.dropna()
+            if len(numbers):
+                self.minimum = float(numbers.min()) if self.minimum is None else min(self.minimum, float(numbers.min()))
+                self.maximum = float(numbers.max()) if self.maximum is None else max(self.maximum, float(numbers.max()))
+            if self.sketch is not None:
+                self.sketch = merge_sketches([self.sketch, price_sketch(numbers.to_numpy())])
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.nulls += other.nulls
+        self.empty += other.empty
+        self.invalid += other.invalid
+        for (attribute, pick) in [('minimum', min), ('maximum', max)]:
+            values = [value for value in (getattr(self, attribute), getattr(other, attribute)) if value is not None]
+            setattr(self, attribute, pick(values) if values else None)
+        self.distinct.merge(other.distinct)
+        if self.sketch is not None:
+            self.sketch = merge_sketches([self.sketch, other.sketch])
+        return self
+
+    def report(self):
+        report = {'rows': self.rows, 'null_rate': self.nulls/self.rows if self.rows else None,
+                  'empty_rate': self.empty/self.rows if self.rows else None, 'distinct': self.distinct.count()}
+        if self.numeric:
+            report.update({'invalid': self.invalid, 'min': self.minimum, 'max': self.maximum})
+        if self.sketch is not None:
+            report['quantiles'] = {f"q{q:g}": sketch_quantile(self.sketch, q) for q in (0.01, 0.25, 0.5, 0.75, 0.99)}
+        return report
+
+class TableProfile:
+    """
+    Streaming, mergeable profile of a table: a ColumnProfile per column, plus coordinate range checks
+    when the table has lattitude/longitude. Feed it chunks with update, combine partial profiles
+    (e.g. of parallel workers) with merge.
+
+    Arguments:
+      columns : list(string) - columns of the chunks
+      precision : int - HyperLogLog precision
+    """
+    def __init__(self, columns, precision = 12):
+        self.columns = {column: ColumnProfile(column, column in NUMERIC_COLUMNS, precision) for column in columns}
+        self.coordinates = {'checked': 0, 'missing': 0, 'zero': 0, 'outside_uk': 0} if {'lattitude', 'longitude'} <= set(columns) else None
+
+    def update(self, chunk):
+        for (column, profile) in self.columns.items():
+            profile.update(chunk[column])
+        if self.coordinates is not None:
+            lattitude = pd.to_numeric(chunk['lattitude'], errors='coerce')
+            longitude = pd.to_numeric(chunk['longitude'], errors='coerce')
+            missing = lattitude.isnull() | longitude.isnull()
+            zero = (lattitude == 0) & (longitude == 0)
+            inside = lattitude.between(*UK_LATTITUDE) & longitude.between(*UK_LONGITUDE)
+            self.coordinates['checked'] += len(chunk)
+            self.coordinates['missing'] += int(missing.sum())
+            self.coordinates['zero'] += int(zero.sum())
+            self.coordinates['outside_uk'] += int((~missing & ~zero & ~inside).sum())
+        return self
+
+    def merge(self, other):
+        for (column, profile) in self.columns.items():
+            profile.merge(other.columns[column])
+        if self.coordinates is not None:
+            for key in self.coordinates:
+                self.coordinates[key] += other.coordinates[key]
+        return self
+
+    def report(self):
+        report = {'rows': next(iter(self.columns.values())).rows if self.columns else 0,
+                  'columns': {column: profile.report() for (column, profile) in self.columns.items()}}
+        if self.coordinates is not None:
+            report['coordinates'] = dict(self.coordinates)
+        return report
+
+def profile_table(conn, table, columns, chunksize = 100000, workers = 1, precision = 12):
+    """
+    Profile a whole table in one streaming pass, without holding it in memory.
+
+    Arguments:
+      conn : Connection Object/ConnectionPool - connection to database, a pool is needed for several workers
+      table : string - table name, e.g. 'pp_data'
+      columns : list(string) - columns to profile
+      chunksize : int - rows per streamed chunk
+      workers : int - workers each profiling a db_id range of the table over their own connection
+      precision : int - HyperLogLog precision
+    Output:
+      profile : TableProfile - merged profile, see TableProfile.report
+    """
+    if workers <= 1:
+        profile = TableProfile(columns, precision)
+        for chunk in iter_fetch_data(conn, table, columns, chunksize, dtypes = {}):
+            profile.update(chunk)
+        return profile
+    if not isinstance(conn, ConnectionPool):
+        raise ValueError("Several workers need a ConnectionPool")
+
+    with checkout(conn) as connection:
+        cur = connection.cursor()
+        cur.execute(f"SELECT MIN(db_id), MAX(db_id) FROM {table}")
+        (low, high) = cur.fetchone()
+    if low is None:
+        return TableProfile(columns, precision)
+    step = (int(high) - int(low))//workers + 1
+    query = f"SELECT {', '.join(columns)} FROM {table} WHERE db_id >= %s AND db_id < %s"
+
+    def profile_range(start):
+        partial = TableProfile(columns, precision)
+        for chunk in iter_query(conn, query, columns, (start, start + step), chunksize, dtypes = {}):
+            partial.update(chunk)
+        return partial
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        partials = list(executor.map(profile_range, range(int(low), int(high) + 1, step)))
+    profile = partials[0]
+    for partial in partials[1:]:
+        profile.merge(partial)
+    return profile
+
+def join_miss_rate(conn):
+    """
+    Share of transactions whose postcode is missing from postcode_data (and so drop out of the price and
+    location join), computed in the database
+
+    Arguments:
+      conn : Connection Object/ConnectionPool - connection to database
+    Output:
+      report : dictionary - transactions, those without a postcode, those whose postcode is not in postcode_data, and the miss rate
+    """
+    with checkout(conn) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*), SUM(CASE WHEN pp.postcode IS NULL OR pp.postcode = '' THEN 1 ELSE 0 END), " +
+                    "SUM(CASE WHEN pp.postcode <> '' AND NOT EXISTS (SELECT 1 FROM postcode_data pc WHERE pc.postcode = pp.postcode) THEN 1 ELSE 0 END) " +
+                    "FROM pp_data pp")
+        (rows, blank, missing) = [int(value or 0) for value in cur.fetchone()]
+        conn.commit()
+    return {'transactions': rows, 'no_postcode': blank, 'unknown_postcode': missing,
+            'miss_rate': (blank + missing)/rows if rows else None}
+
+@instrument.traced()
+def profile_dataset(conn, chunksize = 100000, workers = 1, precision = 12):
+    """
+    Nightly data quality report over the whole dataset: per-column profiles of pp_data and postcode_data,
+    coordinate range checks, price quantiles and the postcode join miss rate
+
+    Arguments:
+      conn : Connection Object/ConnectionPool - connection to database, a pool is needed for several workers
+      chunksize : int - rows per streamed chunk
+      workers : int - parallel workers per table
+      precision : int - HyperLogLog precision
+    Output:
+      report : dictionary - JSON-serialisable report
+    """
+    transactions = [column for (column, _) in SCHEMA['pp_data']] + ['db_id']
+    postcodes = [column for (column, _) in SCHEMA['postcode_data']] + ['db_id']
+    return {'pp_data': profile_table(conn, 'pp_data', transactions, chunksize, workers, precision).report(),
+            'postcode_data': profile_table(conn, 'postcode_data', postcodes, chunksize, workers, precision).report(),
+            'join': join_miss_rate(conn)}
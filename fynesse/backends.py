@@ -0,0 +1,418 @@
+# This file holds the storage backends behind the access functions
+
+"""The access functions were written for a MariaDB server. A backend wraps what differs between
+databases (connecting, bulk loading csv files, streaming cursors, transactions and a few SQL
+dialect details), so the same loads and bounding box/date joins also run on an embedded database:
+DuckDB, a columnar engine that also reads and writes Parquet, or SQLite from the standard library.
+Embedded databases need no server, so analysts and CI can run the whole pipeline locally. """
+
+from .config import *
+
+import csv
+import os
+import sqlite3
+import threading
+from .lazy import lazy_module
+
+pymysql = lazy_module('pymysql')
+pd = lazy_module('pandas')
+
+# Columns and portable types of the tables the pipeline loads, in csv order. db_id is generated on load
+# for pp_data and postcode_data, and copied from pp_data in prices_coordinates_data.
+SCHEMA = {'pp_data': [('transaction_unique_identifier', 'VARCHAR(64)'), ('price', 'INTEGER'), ('date_of_transfer', 'DATE'),
+                      ('postcode', 'VARCHAR(8)'), ('property_type', 'VARCHAR(1)'), ('new_build_flag', 'VARCHAR(1)'),
+                      ('tenure_type', 'VARCHAR(1)'), ('primary_addressable_object_name', 'VARCHAR(128)'),
+                      ('secondary_addressable_object_name', 'VARCHAR(128)'), ('street', 'VARCHAR(128)'),
+                      ('locality', 'VARCHAR(128)'), ('town_city', 'VARCHAR(128)'), ('district', 'VARCHAR(128)'),
+                      ('county', 'VARCHAR(128)'), ('ppd_category_type', 'VARCHAR(2)'), ('record_status', 'VARCHAR(2)')],
+          'postcode_data': [('postcode', 'VARCHAR(8)'), ('status', 'VARCHAR(9)'), ('usertype', 'VARCHAR(6)'),
+                            ('easting', 'INTEGER'), ('northing', 'INTEGER'), ('positional_quality_indicator', 'INTEGER'),
+                            ('country', 'VARCHAR(25)'), ('lattitude', 'DOUBLE'), ('longitude', 'DOUBLE'),
+                            ('postcode_no_space', 'VARCHAR(7)'), ('postcode_fixed_width_seven', 'VARCHAR(7)'),
+                            ('postcode_fixed_width_eight', 'VARCHAR(8)'), ('postcode_area', 'VARCHAR(2)'),
+                            ('postcode_district', 'VARCHAR(4)'), ('postcode_sector', 'VARCHAR(6)'), ('outcode', 'VARCHAR(4)'),
+                            ('incode', 'VARCHAR(3)')],
+          'prices_coordinates_data': [('price', 'INTEGER'), ('date_of_transfer', 'DATE'), ('postcode', 'VARCHAR(8)'),
+                                      ('property_type', 'VARCHAR(1)'), ('new_build_flag', 'VARCHAR(1)'), ('tenure_type', 'VARCHAR(1)'),
+                                      ('locality', 'VARCHAR(128)'), ('town_city', 'VARCHAR(128)'), ('district', 'VARCHAR(128)'),
+                                      ('county', 'VARCHAR(128)'), ('country', 'VARCHAR(25)'), ('lattitude', 'DOUBLE'),
+                                      ('longitude', 'DOUBLE'), ('db_id', 'BIGINT')]}
+# Tables whose db_id is generated when rows are loaded
+GENERATED_IDS = ['pp_data', 'postcode_data']
+
+
+def csv_format(field_term = "\",\"", lines_start = "\""):
+    """
+    Translate LOAD DATA style field/line settings to a csv delimiter and quote character
+
+    Argument:
+      field_term : (string) - end of each field, e.g. '","' for quoted or ',' for plain csv
+      lines_start : (string) - start of each csv line, the quote character for quoted csv
+    Output:
+      (delimiter, quote) : (string, string) - delimiter and quote character (None if unquoted)
+    """
+    quote = lines_start or None
+    delimiter = field_term.replace(quote, '') if quote else field_term
+    return (delimiter or ',', quote)
+
+class Backend:
+    """
+    Interface of a storage backend. Subclasses implement connecting, table creation and bulk
+    loading; the defaults cover drivers following the python DB API.
+    """
+    name = None
+    paramstyle = 'format'
+    embedded = False
+    # Whether several processes can use the database at the same time
+    multiprocess = True
+
+    def connect(self, **settings):
+        """
+        Open a new connection.
+
+        Arguments:
+          settings - driver keyword arguments, `database` is the file of embedded databases
+        Output:
+          conn : Connection Object - new connection
+        """
+        raise NotImplementedError
+
+    def owns(self, conn):
+        """
+        Whether the connection belongs to this backend.
+        """
+        raise NotImplementedError
+
+    def column_sql(self, table, column, kind):
+        return f"{column} {kind}"
+
+    def id_sql(self, table):
+        return "db_id BIGINT NOT NULL"
+
+    def create_tables(self, conn, tables = None):
+        """
+        Create the tables of SCHEMA that do not exist yet.
+
+        Arguments:
+          conn : Connection Object - connection to database
+          tables : list(string) - tables to create, all of SCHEMA if None
+        """
+        cur = conn.cursor()
+        for table in tables or SCHEMA:
+            columns = [self.column_sql(table, column, kind) for (column, kind) in SCHEMA[table]]
+            if table in GENERATED_IDS:
+                columns.append(self.id_sql(table))
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})")
+        conn.commit()
+
+    def load_csv(self, conn, table, file, field_term = "\",\"", lines_start = "\"", lines_term = "\"\n"):
+        """
+        Bulk load a csv file into the leading columns of a table.
+
+        Arguments:
+          conn : Connection Object - connection to database
+          table : string - table name
+          file : string - csv file name
+          field_term, lines_start, lines_term : string - csv format as in LOAD DATA
+        Output:
+          rows : int - number of rows loaded
+        """
+        raise NotImplementedError
+
+    def insert_rows(self, conn, table, columns, rows):
+        """
+        Insert a batch of rows, given as lists of values.
+
+        Output:
+          rows : int - number of rows inserted
+        """
+        cur = conn.cursor()
+        cur.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join([self.placeholder] * len(columns))})", rows)
+        return len(rows)
+
+    @property
+    def placeholder(self):
+        return '?' if self.paramstyle == 'qmark' else '%s'
+
+    def streaming_cursor(self, conn):
+        """
+        Cursor whose fetchmany does not buffer the whole result in memory.
+        """
+        return conn.cursor()
+
+    def rowcount(self, cur):
+        """
+        Number of rows changed by the last statement run on the cursor.
+        """
+        return cur.rowcount
+
+    def begin(self, conn):
+        """
+        Start a transaction, for drivers that do not open one implicitly.
+        """
+        pass
+
+    def rollback(self, conn):
+        """
+        Roll back the open transaction, if there is one.
+        """
+        conn.rollback()
+
+    def month_sql(self, column):
+        """
+        SQL expression of the 'YYYY-MM' month of a date column.
+        """
+        return f"SUBSTRING({column}, 1, 7)"
+
+    def has_table(self, conn, table):
+        """
+        Whether a table exists.
+        """
+        cur = conn.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM information_schema.tables WHERE table_name = {self.placeholder}", (table,))
+        return cur.fetchone()[0] > 0
+
+class MariaDBBackend(Backend):
+    """
+    MariaDB/MySQL server through pymysql, loading csv files with LOAD DATA LOCAL INFILE.
+    """
+    name = 'mariadb'
+
+    def connect(self, **settings):
+        return pymysql.connect(**settings)
+
+    def owns(self, conn):
+        # By module name, so checking a connection of another backend does not import pymysql
+        return type(conn).__module__.startswith('pymysql') and isinstance(conn, pymysql.connections.Connection)
+
+    def id_sql(self, table):
+        return "db_id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY"
+
+    def load_csv(self, conn, table, file, field_term = "\",\"", lines_start = "\"", lines_term = "\"\n"):
+        cur = conn.cursor()
+        return cur.execute(f"LOAD DATA LOCAL INFILE '{file}' INTO TABLE {table} FIELDS TERMINATED BY '{field_term}' LINES STARTING BY '{lines_start}' TERMINATED BY '{lines_term}';")
+
+    def streaming_cursor(self, conn):
+        return conn.cursor(pymysql.cursors.SSCursor)
+
+    def has_table(self, conn, table):
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s", (table,))
+        return cur.fetchone()[0] > 0
+
+class DuckDBConnection:
+    """
+    DuckDB connection whose cursors run in the connection's own transaction. A DuckDB connection's
+    cursor() opens another connection, so statements run on it would escape begin, commit and rollback.
+
+    Arguments:
+      conn : DuckDBPyConnection - the DuckDB connection
+    """
+    def __init__(self, conn):
+        self.connection = conn
+
+    def cursor(self):
+        return DuckDBCursor(self.connection)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+class DuckDBCursor:
+    """
+    DB-API cursor on a shared DuckDB connection: closing it leaves the connection open.
+    """
+    def __init__(self, conn):
+        self.connection = conn
+
+    def execute(self, query, params = None):
+        self.connection.execute(query, params) if params is not None else self.connection.execute(query)
+        return self
+
+    def executemany(self, query, params):
+        self.connection.executemany(query, params)
+        return self
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+class DuckDBBackend(Backend):
+    """
+    Embedded DuckDB database (pip install duckdb). csv files are read by DuckDB's own parallel
+    reader, and tables can be exported to and opened from Parquet files.
+    """
+    name = 'duckdb'
+    paramstyle = 'qmark'
+    embedded = True
+    # A database file is locked by the one process that opened it
+    multiprocess = False
+
+    def __init__(self):
+        self._databases = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def connect(self, database = ':memory:', **settings):
+        import duckdb
+        # Connections of one process share a database instance (needed for ':memory:'), each thread gets its own cursor
+        with self._lock:
+            if self._pid != os.getpid():
+                # Instances inherited from the parent of a forked process are not usable in it
+                (self._databases, self._pid) = ({}, os.getpid())
+            if database not in self._databases:
+                self._databases[database] = duckdb.connect(database)
+            return DuckDBConnection(self._databases[database].cursor())
+
+    def owns(self, conn):
+        return isinstance(conn, (DuckDBConnection, DuckDBCursor)) or type(conn).__module__.lstrip('_').startswith('duckdb')
+
+    def id_sql(self, table):
+        return f"db_id BIGINT DEFAULT nextval('{table}_db_id') PRIMARY KEY"
+
+    def create_tables(self, conn, tables = None):
+        for table in tables or SCHEMA:
+            if table in GENERATED_IDS:
+                conn.execute(f"CREATE SEQUENCE IF NOT EXISTS {table}_db_id")
+        super().create_tables(conn, tables)
+
+    def load_csv(self, conn, table, file, field_term = "\",\"", lines_start = "\"", lines_term = "\"\n"):
+        (delimiter, quote) = csv_format(field_term, lines_start)
+        with open(file, newline='') as handle:
+            first = next(csv.reader(handle, delimiter=delimiter, quotechar=quote or '"', quoting=csv.QUOTE_MINIMAL if quote else csv.QUOTE_NONE), None)
+        if first is None:
+            return 0
+        columns = conn.execute("SELECT column_name, data_type FROM information_schema.columns WHERE table_name = ? ORDER BY ordinal_position", (table,)).fetchall()[:len(first)]
+        # Dates are read as timestamps, so Land Registry's '2018-01-05 00:00' is accepted
+        types = ', '.join(f"'{column}': '{'TIMESTAMP' if kind == 'DATE' else kind}'" for (column, kind) in columns)
+        quoting = f", quote='{quote}'" if quote else ", quote=''"
+        return conn.execute(f"INSERT INTO {table} ({', '.join(column for (column, _) in columns)}) " +
+                            f"SELECT * FROM read_csv('{file}', header=false, delim='{delimiter}'{quoting}, columns={{{types}}})").fetchone()[0]
+
+    def insert_rows(self, conn, table, columns, rows):
+        # Row by row executemany is slow in DuckDB, a registered DataFrame is inserted in one scan
+        batch = pd.DataFrame(rows, columns = columns)
+        conn.register('_fynesse_batch', batch)
+        try:
+            conn.execute(f"INSERT INTO {table} ({', '.join(columns)}) SELECT * FROM _fynesse_batch")
+        finally:
+            conn.unregister('_fynesse_batch')
+        return len(rows)
+
+    def streaming_cursor(self, conn):
+        # A connection of its own, so rows can be fetched while the connection runs other statements
+        return getattr(conn, 'connection', conn).cursor()
+
+    def rowcount(self, cur):
+        return cur.fetchone()[0]
+
+    def begin(self, conn):
+        conn.begin()
+
+    def rollback(self, conn):
+        import duckdb
+        try:
+            conn.rollback()
+        except duckdb.TransactionException:
+            # No transaction is open in autocommit mode
+            pass
+
+    def month_sql(self, column):
+        return f"strftime({column}, '%Y-%m')"
+
+    def export_parquet(self, conn, directory, tables = None):
+        """
+        Write tables to one Parquet file each, e.g. to share a loaded database.
+
+        Arguments:
+          conn : Connection Object - connection to database
+          directory : string - directory of the Parquet files
+          tables : list(string) - tables to export, all of SCHEMA if None
+        """
+        os.makedirs(directory, exist_ok=True)
+        for table in tables or SCHEMA:
+            conn.execute(f"COPY {table} TO '{os.path.join(directory, table + '.parquet')}' (FORMAT PARQUET)")
+
+    def open_parquet(self, conn, directory, tables = None):
+        """
+        Query Parquet files written by export_parquet in place, as views named after the tables.
+
+        Arguments:
+          conn : Connection Object - connection to database
+          directory : string - directory of the Parquet files
+          tables : list(string) - tables to open, all files of SCHEMA found if None
+        """
+        for table in tables or SCHEMA:
+            path = os.path.join(directory, table + '.parquet')
+            if os.path.exists(path):
+                conn.execute(f"CREATE OR REPLACE VIEW {table} AS SELECT * FROM read_parquet('{path}')")
+
+class SQLiteBackend(Backend):
+    """
+    Embedded SQLite database from the standard library, loading csv files with executemany.
+    """
+    name = 'sqlite'
+    paramstyle = 'qmark'
+    embedded = True
+
+    def connect(self, database = ':memory:', **settings):
+        return sqlite3.connect(database, check_same_thread=False)
+
+    def owns(self, conn):
+        return isinstance(conn, sqlite3.Connection)
+
+    def id_sql(self, table):
+        return "db_id INTEGER PRIMARY KEY AUTOINCREMENT"
+
+    def has_table(self, conn, table):
+        return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0] > 0
+
+    def load_csv(self, conn, table, file, field_term = "\",\"", lines_start = "\"", lines_term = "\"\n", batch_size = 50000):
+        (delimiter, quote) = csv_format(field_term, lines_start)
+        kinds = [kind.upper() for (_, _, kind, *_) in conn.execute(f"PRAGMA table_info({table})")]
+        columns = [column for (_, column, *_) in conn.execute(f"PRAGMA table_info({table})")]
+        rows = 0
+        with open(file, newline='') as handle:
+            reader = csv.reader(handle, delimiter=delimiter, quotechar=quote or '"', quoting=csv.QUOTE_MINIMAL if quote else csv.QUOTE_NONE)
+            batch = []
+            for fields in reader:
+                # Dates keep only their day, so they compare correctly with 'YYYY-MM-DD' bounds; empty numbers are NULL
+                batch.append([field[:10] if kind == 'DATE' else (field if field or kind.startswith('VARCHAR') else None)
+                              for (field, kind) in zip(fields, kinds)])
+                if len(batch) == batch_size:
+                    rows += self.insert_rows(conn, table, columns[:len(fields)], batch)
+                    batch = []
+            if batch:
+                rows += self.insert_rows(conn, table, columns[:len(batch[0])], batch)
+        return rows
+
+BACKENDS = {backend.name: backend for backend in [MariaDBBackend(), DuckDBBackend(), SQLiteBackend()]}
+
+def get_backend(name = None):
+    """
+    Look up a backend by name
+
+    Argument:
+      name : (string) - 'mariadb', 'duckdb' or 'sqlite', config database_backend if None
+    Output:
+      backend : (Backend) - the backend
+    """
+    name = name or config.get('database_backend', 'mariadb')
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown database backend {name}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[name]
+
+def backend_of(conn):
+    """
+    Backend a connection belongs to, MariaDB for any connection no other backend recognises
+
+    Argument:
+      conn : (Connection object) - connection to database
+    Output:
+      backend : (Backend) - its backend
+    """
+    for backend in BACKENDS.values():
+        if backend.owns(conn):
+            return backend
+    return BACKENDS['mariadb']
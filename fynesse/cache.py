@@ -0,0 +1,412 @@
+from .config import *
+
+from .access import *
+from . import instrument
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import math
+import threading
+import warnings
+from .lazy import lazy_module
+
+pd = lazy_module('pandas')
+gpd = lazy_module('geopandas')
+ox = lazy_module('osmnx')
+
+# This file keeps local copies of data that is expensive to access
+
+"""Caches in this file only ever return data exactly as the access functions would, they are a faster path to the same data, not a different view of it."""
+
+
+class ExtractCache:
+    """
+    Persistent on-disk cache of joined price and location extracts, stored as Parquet partitioned by year.
+
+    Extracts are keyed by (bounding box, date range, property type). A request that falls inside a
+    cached extract (sub-box and/or sub-range, and the same or no property filter) is served from it
+    without touching the database. Entries are evicted least recently used once the cache grows past
+    `max_bytes`, and dropped when the load manifest (or, optionally, the table row counts) change.
+    Extracts being read by a thread are deleted only once the read is done, so lookups can run
+    concurrently with puts and evictions (e.g. from a thread pool or the prediction service).
+
+    Arguments:
+      directory : string - cache directory, config cache_directory/extracts if None
+      max_bytes : int - size limit of the cache, config cache_max_bytes if None
+      manifest_file : string - load manifest used for invalidation, config manifest_file if None
+      check_row_counts : bool - also invalidate when the pp_data or postcode_data row counts change (costs a query per lookup)
+    """
+    def __init__(self, directory = None, max_bytes = None, manifest_file = None, check_row_counts = False):
+        self.directory = directory or os.path.join(config.get('cache_directory', '.fynesse_cache'), 'extracts')
+        self.max_bytes = int(max_bytes if max_bytes is not None else config.get('cache_max_bytes', 1 << 30))
+        self.manifest_file = manifest_file
+        self.check_row_counts = check_row_counts
+        self._lock = threading.Lock()
+        # Readers of every extract path, and removed extracts whose deletion waits for their readers
+        self._readers = {}
+        self._removed = set()
+        os.makedirs(self.directory, exist_ok=True)
+        self._index_file = os.path.join(self.directory, 'index.json')
+        self._index = {}
+        if os.path.exists(self._index_file):
+            with open(self._index_file) as handle:
+                self._index = json.load(handle)
+
+    def __getstate__(self):
+        # Locks cannot be pickled, e.g. into worker processes
+        state = self.__dict__.copy()
+        for name in ('_lock', '_readers', '_removed'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._readers = {}
+        self._removed = set()
+
+    def get(self, conn, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, property_type = None):
+        """
+        Cached version of joinPriceAndLocationData.
+
+        Arguments:
+          conn : Connection Object/ConnectionPool - connection used on a cache miss
+          longitudeMin, longitudeMax, lattitudeMin, lattitudeMax : double - box of interest
+          dateMin, dateMax : string - time of interest e.g. '2018-01-01', '2018-12-31'
+          property_type : string - only transactions of this property type, all if None
+        Output:
+          data : DataFrame - joined data
+        """
+        version = self.version(conn)
+        with self._lock:
+            self._invalidate(version)
+            key = self._lookup(longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, property_type)
+            if key is not None:
+                self._index[key]['last_used'] = time.time()
+                self._save_index()
+                entry = dict(self._index[key])
+                self._readers[entry['path']] = self._readers.get(entry['path'], 0) + 1
+        instrument.count('cache.extract.hit' if key is not None else 'cache.extract.miss')
+        if key is not None:
+            try:
+                data = self._read(entry, dateMin, dateMax)
+            finally:
+                self._release(entry['path'])
+            mask = ((data.longitude >= longitudeMin) & (data.longitude <= longitudeMax) &
+                    (data.lattitude >= lattitudeMin) & (data.lattitude <= lattitudeMax) &
+                    (data.date_of_transfer >= pd.Timestamp(dateMin)) & (data.date_of_transfer <= pd.Timestamp(dateMax)))
+            if property_type is not None:
+                mask &= data.property_type == property_type
+            return data[mask].reset_index(drop=True)
+
+        data = joinPriceAndLocationData(conn, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, property_type=property_type)
+        self.put(data, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, property_type, version)
+        return data
+
+    def put(self, data, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, property_type = None, version = None):
+        """
+        Store an extract and evict least recently used extracts beyond the size limit.
+
+        Arguments:
+          data : DataFrame - joined data of the box and time of interest
+          longitudeMin, longitudeMax, lattitudeMin, lattitudeMax : double - box of interest
+          dateMin, dateMax : string - time of interest
+          property_type : string - property type filter of the extract, None for all
+          version : string - data version the extract was read at, see version
+        Output:
+          N/A
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        bbox = [longitudeMin, longitudeMax, lattitudeMin, lattitudeMax]
+        key = hashlib.md5(json.dumps([bbox, dateMin, dateMax, property_type]).encode()).hexdigest()
+        table = pa.Table.from_pandas(data.assign(year=data.date_of_transfer.dt.year), preserve_index=False)
+        # Every stored extract gets a directory of its own, only indexed once it is fully written, so
+        # replacing an extract never touches the files a reader of the previous one still uses
+        path = tempfile.mkdtemp(dir=self.directory, prefix=key + '-')
+        if len(data):
+            pq.write_to_dataset(table, path, partition_cols=['year'])
+        else:
+            pq.write_table(table, os.path.join(path, 'empty.parquet'))
+        size = sum(os.path.getsize(os.path.join(root, name)) for (root, _, names) in os.walk(path) for name in names)
+        with self._lock:
+            if key in self._index:
+                self._remove(key)
+            self._index[key] = {'bbox': bbox,
+                                'dates': [dateMin, dateMax],
+                                'property_type': property_type,
+                                'path': path,
+                                'bytes': size,
+                                'last_used': time.time(),
+                                'version': version if version is not None else ''}
+            self._evict(keep=key)
+            self._save_index()
+
+    def version(self, conn = None):
+        """
+        Version of the underlying data: the load manifest fingerprint, plus table row counts if check_row_counts.
+
+        Arguments:
+          conn : Connection Object/ConnectionPool - connection for the row counts
+        Output:
+          version : string - changes whenever the cached extracts may be stale
+        """
+        version = manifest_version(self.manifest_file)
+        if self.check_row_counts and conn is not None:
+            with checkout(conn) as conn:
+                cur = conn.cursor()
+                counts = []
+                for table in ['pp_data', 'postcode_data']:
+                    cur.execute(f"SELECT COUNT(*) FROM {table}")
+                    counts.append(str(cur.fetchone()[0]))
+            version += ':' + ':'.join(counts)
+        return version
+
+    def clear(self):
+        """
+        Remove all cached extracts.
+        """
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+            self._save_index()
+
+    def _lookup(self, longitudeMin, longitudeMax, lattitudeMin, lattitudeMax, dateMin, dateMax, property_type):
+        # Smallest cached extract that covers the request
+        best = None
+        for (key, entry) in self._index.items():
+            (west, east, south, north) = entry['bbox']
+            (start, end) = entry['dates']
+            if (west <= longitudeMin and longitudeMax <= east and south <= lattitudeMin and lattitudeMax <= north and
+                    start <= dateMin and dateMax <= end and entry['property_type'] in (None, property_type)):
+                if best is None or entry['bytes'] < self._index[best]['bytes']:
+                    best = key
+        return best
+
+    def _read(self, entry, dateMin, dateMax):
+        import pyarrow.parquet as pq
+
+        years = [('year', '>=', int(dateMin[:4])), ('year', '<=', int(dateMax[:4]))]
+        data = pq.read_table(entry['path'], filters=years).to_pandas()
+        return apply_schema(data.drop(columns=['year']))
+
+    def _invalidate(self, version):
+        stale = [key for (key, entry) in self._index.items() if entry['version'] != version]
+        for key in stale:
+            self._remove(key)
+        if stale:
+            self._save_index()
+
+    def _evict(self, keep):
+        total = sum(entry['bytes'] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda key: self._index[key]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                total -= self._index[key]['bytes']
+                self._remove(key)
+
+    def _remove(self, key):
+        # Called with the lock held
+        entry = self._index.pop(key)
+        if self._readers.get(entry['path']):
+            self._removed.add(entry['path'])
+        else:
+            self._delete(entry['path'])
+
+    def _release(self, path):
+        with self._lock:
+            self._readers[path] -= 1
+            if not self._readers[path]:
+                del self._readers[path]
+                if path in self._removed:
+                    self._removed.discard(path)
+                    self._delete(path)
+
+    @staticmethod
+    def _delete(path):
+        for (root, dirs, names) in os.walk(path, topdown=False):
+            for name in names:
+                os.remove(os.path.join(root, name))
+            os.rmdir(root)
+
+    def _save_index(self):
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as handle:
+            json.dump(self._index, handle)
+        os.replace(path, self._index_file)
+
+
+class TileCache:
+    """
+    Local cache of OSM points of interest and street graphs, stored per tile of a fixed grid as GeoParquet.
+
+    Any bounding box (e.g. from calculate_boundaries) is snapped onto the grid, missing or expired
+    tiles are downloaded once, and the box is assembled from the cached tiles. In offline mode the
+    network is never used: missing tiles are skipped with a warning and expired tiles are still served,
+    so a fixture tile store is enough to run without network access.
+
+    Arguments:
+      directory : string - tile directory, config cache_directory/tiles if None
+      tile_size : double - width/height of a tile in degrees, config tile_size if None
+      ttl : double - seconds before a tile is downloaded again, config tile_ttl if None
+      offline : bool - never use the network, config offline if None
+    """
+    def __init__(self, directory = None, tile_size = None, ttl = None, offline = None):
+        self.directory = directory or os.path.join(config.get('cache_directory', '.fynesse_cache'), 'tiles')
+        self.tile_size = float(tile_size if tile_size is not None else config.get('tile_size', 0.05))
+        self.ttl = float(ttl if ttl is not None else config.get('tile_ttl', 30*24*3600))
+        self.offline = bool(offline if offline is not None else config.get('offline', False))
+
+    def tiles(self, north, south, west, east):
+        """
+        Tiles of the grid that cover a bounding box.
+
+        Arguments:
+          north, south, west, east : double - boundaries of the box
+        Output:
+          tiles : list((int, int)) - (column, row) of every covering tile
+        """
+        # Rounded first, so boundaries on the grid do not pull in neighbouring tiles through float error
+        columns = range(math.floor(round(west/self.tile_size, 9)), math.ceil(round(east/self.tile_size, 9)))
+        rows = range(math.floor(round(south/self.tile_size, 9)), math.ceil(round(north/self.tile_size, 9)))
+        return [(i, j) for i in columns for j in rows]
+
+    def bounds(self, tile):
+        """
+        Bounding box of a tile.
+
+        Arguments:
+          tile : (int, int) - (column, row) of the tile
+        Output:
+          (north, south, west, east) : (double, double, double, double) - boundaries of the tile
+        """
+        (i, j) = tile
+        return ((j+1)*self.tile_size, j*self.tile_size, i*self.tile_size, (i+1)*self.tile_size)
+
+    def pois(self, north, south, west, east, tags):
+        """
+        Points of interest of a bounding box, assembled from cached tiles.
+
+        Arguments:
+          north, south, west, east : double - boundaries of the box
+          tags : dictionary - points of interest that we want to download
+        Output:
+          pois : GeoDataFrame - points of interest from OSM
+        """
+        key = hashlib.md5(json.dumps(tags, sort_keys=True).encode()).hexdigest()[:12]
+        frames = []
+        for tile in self.tiles(north, south, west, east):
+            path = self._path('pois', key, tile)
+            fresh = self._fresh(path)
+            instrument.count('cache.tile.hit' if fresh or (self.offline and os.path.exists(path)) else 'cache.tile.miss')
+            if fresh:
+                frames.append(gpd.read_parquet(path))
+            elif not self.offline:
+                (n, s, w, e) = self.bounds(tile)
+                try:
+                    pois = ox.geometries_from_bbox(n, s, e, w, tags)
+                except Exception as error:
+                    # Overpass reports an empty tile as an error
+                    if type(error).__name__ not in ('EmptyOverpassResponse', 'InsufficientResponseError'):
+                        raise
+                    pois = gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+                frames.append(self.put_pois(tile, tags, pois))
+            elif os.path.exists(path):
+                frames.append(gpd.read_parquet(path))
+            else:
+                warnings.warn(f"Tile {tile} is not cached, skipping it in offline mode")
+        return self._assemble(frames, north, south, west, east)
+
+    def graph(self, north, south, west, east):
+        """
+        Street graph of a bounding box, assembled from cached tiles. Tiles keep every edge with at least
+        one end inside them, so edges crossing tile borders are not lost.
+
+        Arguments:
+          north, south, west, east : double - boundaries of the box
+        Output:
+          (nodes, edges) : (GeoDataFrame, GeoDataFrame) - map features for plotting phase
+        """
+        (nodes, edges) = ([], [])
+        for tile in self.tiles(north, south, west, east):
+            paths = (self._path('graph', 'nodes', tile), self._path('graph', 'edges', tile))
+            if all(self._fresh(path) for path in paths):
+                (tile_nodes, tile_edges) = [gpd.read_parquet(path) for path in paths]
+            elif not self.offline:
+                (n, s, w, e) = self.bounds(tile)
+                try:
+                    (tile_nodes, tile_edges) = ox.graph_to_gdfs(ox.graph_from_bbox(n, s, e, w, truncate_by_edge=True))
+                except Exception as error:
+                    if type(error).__name__ not in ('EmptyOverpassResponse', 'InsufficientResponseError') and 'no graph nodes' not in str(error):
+                        raise
+                    (tile_nodes, tile_edges) = (gpd.GeoDataFrame(geometry=[], crs="EPSG:4326"), gpd.GeoDataFrame(geometry=[], crs="EPSG:4326"))
+                (tile_nodes, tile_edges) = self.put_graph(tile, tile_nodes, tile_edges)
+            elif all(os.path.exists(path) for path in paths):
+                (tile_nodes, tile_edges) = [gpd.read_parquet(path) for path in paths]
+            else:
+                warnings.warn(f"Tile {tile} is not cached, skipping it in offline mode")
+                continue
+            nodes.append(tile_nodes)
+            edges.append(tile_edges)
+        return (self._assemble(nodes, north, south, west, east), self._assemble(edges, north, south, west, east))
+
+    def put_pois(self, tile, tags, pois):
+        """
+        Store the points of interest of a tile, e.g. to build a fixture tile store.
+
+        Arguments:
+          tile : (int, int) - (column, row) of the tile
+          tags : dictionary - tags the points of interest were downloaded with
+          pois : GeoDataFrame - points of interest of the tile
+        Output:
+          pois : GeoDataFrame - points of interest as stored
+        """
+        key = hashlib.md5(json.dumps(tags, sort_keys=True).encode()).hexdigest()[:12]
+        return self._write(self._path('pois', key, tile), pois)
+
+    def put_graph(self, tile, nodes, edges):
+        """
+        Store the street graph of a tile, e.g. to build a fixture tile store.
+
+        Arguments:
+          tile : (int, int) - (column, row) of the tile
+          nodes : GeoDataFrame - graph nodes of the tile
+          edges : GeoDataFrame - graph edges of the tile
+        Output:
+          (nodes, edges) : (GeoDataFrame, GeoDataFrame) - graph as stored
+        """
+        return (self._write(self._path('graph', 'nodes', tile), nodes), self._write(self._path('graph', 'edges', tile), edges))
+
+    def _path(self, kind, key, tile):
+        return os.path.join(self.directory, kind, key, f"{tile[0]}_{tile[1]}.parquet")
+
+    def _fresh(self, path):
+        return os.path.exists(path) and time.time() - os.path.getmtime(path) < self.ttl
+
+    @staticmethod
+    def _write(path, frame):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # OSM attributes can hold lists, which Parquet columns cannot mix with scalars
+        frame = frame.copy()
+        for column in frame.columns:
+            if column != frame.geometry.name and frame[column].dtype == object:
+                frame[column] = frame[column].map(lambda value: str(value) if isinstance(value, (list, set, dict)) else value)
+        fd, staging = tempfile.mkstemp(dir=os.path.dirname(path))
+        os.close(fd)
+        frame.to_parquet(staging)
+        os.replace(staging, path)
+        return frame
+
+    @staticmethod
+    def _assemble(frames, north, south, west, east):
+        frames = [frame for frame in frames if len(frame)]
+        if not frames:
+            return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+        data = pd.concat(frames)
+        data = data[~data.index.duplicated()]
+        return data.cx[west:east, south:north]
@@ -1,35 +1,83 @@
 import os
-import yaml
+from collections.abc import MutableMapping
 
 default_file = os.path.join(os.path.dirname(__file__), "defaults.yml")
 local_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "machine.yml"))
 user_file = '_config.yml'
 
-config = {}
-
-if os.path.exists(default_file):
-    with open(default_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if os.path.exists(local_file):
-    with open(local_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if os.path.exists(user_file):
-    with open(user_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if config=={}:
-    raise ValueError(
-        "No configuration file found at either "
-        + user_file
-        + " or "
-        + local_file
-        + " or "
-        + default_file
-        + "."
-    )
-
-for key, item in config.items():
-    if item is str:
-        config[key] = os.path.expandvars(item)
+
+def load_config():
+    """
+    Read the configuration files; later files override earlier ones (defaults, machine, user)
+    """
+    import yaml
+
+    config = {}
+
+    if os.path.exists(default_file):
+        with open(default_file) as file:
+            config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if os.path.exists(local_file):
+        with open(local_file) as file:
+            config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if os.path.exists(user_file):
+        with open(user_file) as file:
+            config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if config=={}:
+        raise ValueError(
+            "No configuration file found at either "
+            + user_file
+            + " or "
+            + local_file
+            + " or "
+            + default_file
+            + "."
+        )
+
+    for key, item in config.items():
+        if item is str:
+            config[key] = os.path.expandvars(item)
+    return config
+
+class LazyConfig(MutableMapping):
+    """
+    The configuration, read from the files on first access rather than at import, so importing
+    fynesse neither parses YAML nor fails when no configuration file exists.
+    """
+    def __init__(self):
+        self._data = None
+
+    def _settings(self):
+        if self._data is None:
+            self._data = load_config()
+        return self._data
+
+    def reload(self):
+        """
+        Read the configuration files again, e.g. after writing _config.yml
+        """
+        self._data = None
+        return self._settings()
+
+    def __getitem__(self, key):
+        return self._settings()[key]
+
+    def __setitem__(self, key, value):
+        self._settings()[key] = value
+
+    def __delitem__(self, key):
+        del self._settings()[key]
+
+    def __iter__(self):
+        return iter(self._settings())
+
+    def __len__(self):
+        return len(self._settings())
+
+    def __repr__(self):
+        return repr(self._settings()) if self._data is not None else "<config not loaded yet>"
+
+config = LazyConfig()
@@ -0,0 +1,357 @@
+from .config import *
+
+from . import instrument
+
+import os
+import json
+import threading
+
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+gpd = lazy_module('geopandas')
+
+# This file contains the feature engineering shared by the assess and address parts
+
+"""Features are computed for all points in one batch against a spatial index of the points of interest, in a metric projection so that radii and distances are in metres rather than degrees."""
+
+# British National Grid, coordinates in metres
+METRIC_CRS = "EPSG:27700"
+
+
+def to_metric(longitude, latitude):
+    """
+    Project coordinates onto the metric grid
+
+    Arguments:
+      longitude : array - longitudes (EPSG:4326)
+      latitude : array - latitudes (EPSG:4326)
+    Output:
+      points : GeoSeries - points in METRIC_CRS
+    """
+    points = gpd.GeoSeries(gpd.points_from_xy(np.asarray(longitude, dtype=float), np.asarray(latitude, dtype=float)), crs="EPSG:4326")
+    return points.to_crs(METRIC_CRS)
+
+def geometries_to_metric(geometries):
+    """
+    Project geometries (e.g. points of interest) onto the metric grid
+
+    Arguments:
+      geometries : GeoSeries/GeoDataFrame - geometries, assumed EPSG:4326 if they have no crs
+    Output:
+      geometries : GeoSeries - geometries in METRIC_CRS
+    """
+    geometries = geometries.geometry if isinstance(geometries, gpd.GeoDataFrame) else geometries
+    if geometries.crs is None:
+        geometries = geometries.set_crs("EPSG:4326")
+    return geometries.to_crs(METRIC_CRS)
+
+def count_within(points, geometries, radius):
+    """
+    Number of geometries within a radius of every point, using one spatial index query for all points
+
+    Arguments:
+      points : GeoSeries - points in METRIC_CRS
+      geometries : GeoSeries - geometries in METRIC_CRS
+      radius : double - radius in metres
+    Output:
+      counts : array(int) - count for every point
+    """
+    if len(geometries) == 0 or len(points) == 0:
+        return np.zeros(len(points), dtype=int)
+    (point_index, _) = geometries.sindex.query(points.values, predicate='dwithin', distance=radius)
+    return np.bincount(point_index, minlength=len(points))
+
+def count_within_radii(points, geometries, radii):
+    """
+    Number of geometries within each of several radii of every point, using one spatial index query
+    at the largest radius for all of them
+
+    Arguments:
+      points : GeoSeries - points in METRIC_CRS
+      geometries : GeoSeries - geometries in METRIC_CRS
+      radii : list(double) - radii in metres
+    Output:
+      counts : array(int) - (points, radii) counts
+    """
+    counts = np.zeros((len(points), len(radii)), dtype=int)
+    if len(geometries) == 0 or len(points) == 0:
+        return counts
+    (point_index, geometry_index) = geometries.sindex.query(points.values, predicate='dwithin', distance=max(radii))
+    distances = points.values[point_index].distance(geometries.values[geometry_index])
+    for (column, radius) in enumerate(radii):
+        counts[:, column] = np.bincount(point_index[distances <= radius], minlength=len(points))
+    return counts
+
+def nearest_distance(points, geometries):
+    """
+    Distance from every point to its nearest geometry, using one spatial index query for all points
+
+    Arguments:
+      points : GeoSeries - points in METRIC_CRS
+      geometries : GeoSeries - geometries in METRIC_CRS
+    Output:
+      distances : array(double) - distance in metres for every point, nan if there are no geometries
+    """
+    distances = np.full(len(points), np.nan)
+    if len(geometries) == 0 or len(points) == 0:
+        return distances
+    (index, nearest) = geometries.sindex.nearest(points.values, return_all=False, return_distance=True)
+    distances[index[0]] = nearest
+    return distances
+
+@instrument.traced()
+def poi_features(longitude, latitude, pois, radius = 1000):
+    """
+    Features of price prediction points: amenities within a radius and distance to the closest leisure place
+
+    Arguments:
+      longitude : array - longitudes of the points
+      latitude : array - latitudes of the points
+      pois : GeoDataFrame - points of interest from OSM
+      radius : double - amenity radius in metres
+    Output:
+      features : DataFrame - amenity_proximity (amenities within radius + 1) if pois has amenities,
+                             closest_leisure (metres) if pois has leisure places
+    """
+    points = to_metric(longitude, latitude)
+    features = pd.DataFrame(index=range(len(points)))
+    if 'amenity' in pois.columns:
+        amenities = geometries_to_metric(pois[pois.amenity.notnull()])
+        features['amenity_proximity'] = count_within(points, amenities, radius) + 1
+    if 'leisure' in pois.columns:
+        leisure = geometries_to_metric(pois[pois.leisure.notnull()])
+        features['closest_leisure'] = nearest_distance(points, leisure)
+    return features
+
+
+# Columns of a FeatureStore, the features poi_features computes
+FEATURE_COLUMNS = ['amenity_proximity', 'closest_leisure']
+
+
+class FeatureStore:
+    """
+    Append-only, memory-mapped store of per-transaction features, keyed by db_id.
+
+    Every column is a flat binary file of one dtype (db_id int64, lattitude/longitude float32, features
+    float64) and meta.json holds the number of committed rows. Appends write past the committed rows and
+    then replace meta.json, so readers, including other processes mapping the same directory, always see
+    a consistent prefix. Reads map the files read-only: slicing the rows of a region copies only those
+    rows. Features are computed once, when transactions are first seen, so the store should be filled
+    from one POI source (e.g. a TileCache) for the features to be comparable; a feature stored as nan
+    because the POIs lacked its tag is filled in place by the first add whose POIs have it. One writer
+    at a time.
+
+        store = FeatureStore('./features')
+        data = add_poi_features(data, pois, store = store)   # looks features up, computes and appends the missing ones
+        rows = store.region(52.4, 52.3, -2.3, -2.2)
+        design = store.frame(rows)
+
+    Arguments:
+      directory : string - directory of the column files
+      columns : list(string) - feature columns of a new store, FEATURE_COLUMNS if None
+    """
+    KEYS = {'db_id': 'int64', 'lattitude': 'float32', 'longitude': 'float32'}
+
+    def __init__(self, directory, columns = None):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._order = None
+        if os.path.exists(self._meta_path()):
+            self.refresh()
+        else:
+            self.rows = 0
+            self.columns = list(columns or FEATURE_COLUMNS)
+            self._write_meta()
+
+    def __len__(self):
+        return self.rows
+
+    def __getstate__(self):
+        # Worker processes map the files themselves
+        return {'directory': self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'])
+
+    def refresh(self):
+        """
+        Pick up rows appended since the store was opened, e.g. by a loading process.
+        """
+        with open(self._meta_path()) as handle:
+            meta = json.load(handle)
+        if meta['rows'] != getattr(self, 'rows', None):
+            self._maps = {}
+            self._order = None
+        (self.rows, self.columns) = (meta['rows'], meta['columns'])
+
+    def dtypes(self):
+        return dict(self.KEYS, **{column: 'float64' for column in self.columns})
+
+    def column(self, name):
+        """
+        Column as a read-only memory map of the committed rows.
+
+        Arguments:
+          name : string - db_id, lattitude, longitude or a feature column
+        Output:
+          values : array - memory-mapped values, one per row
+        """
+        values = self._maps.get(name)
+        if values is None:
+            dtype = self.dtypes()[name]
+            values = np.memmap(self._path(name), dtype=dtype, mode='r', shape=(self.rows,)) if self.rows else np.empty(0, dtype=dtype)
+            self._maps[name] = values
+        return values
+
+    def lookup(self, db_id):
+        """
+        Rows of transactions.
+
+        Arguments:
+          db_id : array - db_id of the transactions
+        Output:
+          rows : array(int) - row of every transaction, -1 if it is not stored
+        """
+        db_id = np.asarray(db_id, dtype=np.int64)
+        if not self.rows:
+            return np.full(len(db_id), -1, dtype=np.int64)
+        if self._order is None:
+            # Rows are in load order, a sorted index of the keys finds them
+            self._order = np.argsort(self.column('db_id'), kind='stable')
+        keys = self.column('db_id')[self._order]
+        position = np.minimum(np.searchsorted(keys, db_id), self.rows - 1)
+        return np.where(keys[position] == db_id, self._order[position], -1)
+
+    def region(self, north, south, west, east):
+        """
+        Rows of the transactions in a bounding box.
+
+        Output:
+          rows : array(int) - rows, in store order
+        """
+        lattitude = self.column('lattitude')
+        longitude = self.column('longitude')
+        return np.flatnonzero((lattitude >= south) & (lattitude <= north) & (longitude >= west) & (longitude <= east))
+
+    def frame(self, rows = None, columns = None):
+        """
+        Features of rows, copied out of the maps.
+
+        Arguments:
+          rows : array(int) - rows to read, all if None
+          columns : list(string) - columns to read, db_id and the feature columns if None
+        Output:
+          features : DataFrame - one row per requested row
+        """
+        columns = columns or ['db_id'] + self.columns
+        return pd.DataFrame({column: np.asarray(self.column(column)[rows] if rows is not None else self.column(column)) for column in columns})
+
+    def append(self, db_id, lattitude, longitude, features):
+        """
+        Append features of transactions that are not stored yet; stored transactions are left as they are.
+
+        Arguments:
+          db_id : array - db_id of the transactions
+          lattitude, longitude : array - coordinates of the transactions
+          features : DataFrame - the feature columns, one row per transaction
+        Output:
+          appended : int - number of rows appended
+        """
+        with self._lock:
+            self.refresh()
+            db_id = np.asarray(db_id, dtype=np.int64)
+            (_, first) = np.unique(db_id, return_index=True)
+            new = np.zeros(len(db_id), dtype=bool)
+            new[first] = True
+            new &= self.lookup(db_id) < 0
+            if not new.any():
+                return 0
+            values = {'db_id': db_id, 'lattitude': lattitude, 'longitude': longitude}
+            for column in self.columns:
+                values[column] = features[column].to_numpy() if column in features else np.full(len(db_id), np.nan)
+            for (column, dtype) in self.dtypes().items():
+                with open(self._path(column), 'ab') as handle:
+                    # Drop whatever an interrupted append left after the committed rows
+                    handle.truncate(self.rows*np.dtype(dtype).itemsize)
+                    handle.write(np.asarray(values[column], dtype=dtype)[new].tobytes())
+            self.rows += int(new.sum())
+            self._write_meta()
+            self._maps = {}
+            self._order = None
+            instrument.count('features.store.appended', int(new.sum()))
+            return int(new.sum())
+
+    def fill(self, rows, features):
+        """
+        Fill in nan features of stored rows; features that are set are left as they are.
+
+        Arguments:
+          rows : array(int) - rows to fill
+          features : DataFrame - the feature columns, one row per row to fill
+        Output:
+          filled : int - number of values filled
+        """
+        with self._lock:
+            self.refresh()
+            rows = np.asarray(rows, dtype=np.int64)
+            filled = 0
+            for column in self.columns:
+                if column not in features or not len(rows):
+                    continue
+                values = np.memmap(self._path(column), dtype='float64', mode='r+', shape=(self.rows,))
+                unset = np.isnan(values[rows])
+                values[rows[unset]] = features[column].to_numpy(dtype=float)[unset]
+                values.flush()
+                filled += int(unset.sum())
+                del values
+            self._maps = {}
+            instrument.count('features.store.filled', filled)
+            return filled
+
+    def add(self, data, pois, radius = 1000):
+        """
+        Features of transactions, computed with poi_features only for those that are not stored yet
+        and for stored ones whose features for the tags of these POIs are nan.
+
+        Arguments:
+          data : DataFrame - transactions with db_id, lattitude and longitude columns
+          pois : GeoDataFrame - points of interest to compute missing features from
+          radius : double - amenity radius in metres
+        Output:
+          features : DataFrame - the feature columns, aligned with data
+        """
+        # Feature columns poi_features would give for these POIs
+        columns = [column for (column, tag) in zip(FEATURE_COLUMNS, ['amenity', 'leisure']) if tag in pois.columns and column in self.columns]
+        (db_id, lattitude, longitude) = (data['db_id'].to_numpy(), data['lattitude'].to_numpy(), data['longitude'].to_numpy())
+        rows = self.lookup(db_id)
+        missing = rows < 0
+        # Rows stored from POIs without one of these tags
+        unset = np.zeros(len(rows), dtype=bool)
+        if columns and not missing.all():
+            unset[~missing] = np.isnan(self.frame(rows[~missing], columns).to_numpy(dtype=float)).any(axis=1)
+        compute = missing | unset
+        instrument.count('features.store.hit', int((~compute).sum()))
+        if compute.any():
+            computed = poi_features(longitude[compute], lattitude[compute], pois, radius)
+            if missing.any():
+                self.append(db_id[missing], lattitude[missing], longitude[missing], computed[missing[compute]])
+            if unset.any():
+                self.fill(rows[unset], computed[unset[compute]])
+            rows = self.lookup(db_id)
+        return self.frame(rows, columns)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.bin')
+
+    def _meta_path(self):
+        return os.path.join(self.directory, 'meta.json')
+
+    def _write_meta(self):
+        temporary = self._meta_path() + '.tmp'
+        with open(temporary, 'w') as handle:
+            json.dump({'rows': self.rows, 'columns': self.columns}, handle)
+        os.replace(temporary, self._meta_path())
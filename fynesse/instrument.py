@@ -0,0 +1,303 @@
+# This file holds the timing and counting hooks of the fynesse stages
+
+"""Lightweight instrumentation: timing spans, counters and optional memory samples around the
+access, assess and address stages, sent to pluggable sinks (structured log lines, an in-process
+metrics registry, Chrome trace JSON). Instrumentation is off until enable is called; while off, a
+span is one flag check returning a shared no-op object, so the hooks can stay in hot paths.
+
+    registry = instrument.MetricsRegistry()
+    trace = instrument.ChromeTrace()
+    instrument.enable(registry, trace, memory = True)
+    address.predict_price(conn, 52.35, -2.25, '2018-06-01', 'D', 0.1)
+    print(registry.summary())
+    trace.write('predict.json')  # open in chrome://tracing or ui.perfetto.dev
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import functools
+import threading
+
+_enabled = False
+_memory = False
+_sinks = []
+_local = threading.local()
+
+
+def enable(*sinks, memory = False):
+    """
+    Turn instrumentation on
+
+    Arguments:
+      sinks : sinks receiving span and counter events, e.g. MetricsRegistry(), LogSink(), ChromeTrace()
+      memory : bool - sample the resident memory of the process at the start and end of every span
+    Output:
+      N/A
+    """
+    global _enabled, _memory, _sinks
+    _sinks = list(sinks)
+    _memory = memory
+    _enabled = bool(_sinks)
+
+def disable():
+    """
+    Turn instrumentation off, dropping the sinks
+    """
+    global _enabled, _sinks
+    _enabled = False
+    _sinks = []
+
+def enabled():
+    return _enabled
+
+class _NullSpan:
+    """
+    Span handed out while instrumentation is off: every call is a no-op.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Span:
+    """
+    Timed section of work, reported to the sinks when it ends.
+
+    Arguments:
+      name : string - stage name, e.g. 'access.join'
+      attributes : attributes of the span, more can be added with set (e.g. rows=len(data))
+    """
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+        self.duration = None
+        self.memory = None
+        self.parent = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        if _memory:
+            self.memory = [resident_memory(), None]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.duration = time.perf_counter() - self.start
+        if self.memory is not None:
+            self.memory[1] = resident_memory()
+        if kind is not None:
+            self.attributes['error'] = kind.__name__
+        _stack().pop()
+        for sink in _sinks:
+            sink.span(self)
+        return False
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+def span(name, **attributes):
+    """
+    Time a with block as a named span
+
+    Arguments:
+      name : string - stage name, e.g. 'access.join'
+      attributes : attributes of the span
+    Output:
+      span : Span - context manager, whose set adds attributes (a no-op object while disabled)
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, attributes)
+
+def count(name, value = 1, **attributes):
+    """
+    Add to a counter, e.g. count('access.rows_fetched', len(rows)) or count('cache.extract.hit')
+
+    Arguments:
+      name : string - counter name
+      value : number - amount to add
+      attributes : attributes of the event
+    Output:
+      N/A
+    """
+    if not _enabled:
+        return
+    for sink in _sinks:
+        sink.count(name, value, attributes)
+
+def traced(name = None):
+    """
+    Decorator running every call of a function in a span named after it
+    """
+    def decorate(function):
+        label = name or f"{function.__module__.split('.')[-1]}.{function.__name__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Span(label, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def resident_memory():
+    """
+    Resident memory of this process in bytes, the peak resident memory where the current one is unavailable
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+class Sink:
+    """
+    Receiver of instrumentation events, subclasses override span and/or count.
+    """
+    def span(self, span):
+        pass
+
+    def count(self, name, value, attributes):
+        pass
+
+class LogSink(Sink):
+    """
+    Write every event as one JSON log line.
+
+    Arguments:
+      logger : logging.Logger - logger to write to, the 'fynesse' logger if None
+      level : int - log level of the lines
+    """
+    def __init__(self, logger = None, level = logging.INFO):
+        self.logger = logger or logging.getLogger('fynesse')
+        self.level = level
+
+    def span(self, span):
+        record = {'event': 'span', 'name': span.name, 'seconds': round(span.duration, 6), 'parent': span.parent}
+        if span.memory is not None:
+            record['memory_delta'] = span.memory[1] - span.memory[0]
+        record.update(span.attributes)
+        self.logger.log(self.level, json.dumps(record, default=str))
+
+    def count(self, name, value, attributes):
+        self.logger.log(self.level, json.dumps(dict({'event': 'count', 'name': name, 'value': value}, **attributes), default=str))
+
+class MetricsRegistry(Sink):
+    """
+    In-process aggregation of spans (calls, total/min/max seconds, latest durations for percentiles)
+    and counters, e.g. to expose from a service or print after a batch job.
+
+    Arguments:
+      keep : int - latest durations kept per span name for percentiles
+    """
+    def __init__(self, keep = 1024):
+        self.keep = keep
+        self.spans = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def span(self, span):
+        with self._lock:
+            stats = self.spans.get(span.name)
+            if stats is None:
+                stats = self.spans[span.name] = {'calls': 0, 'seconds': 0.0, 'min': span.duration, 'max': span.duration, 'recent': [], 'memory_delta': 0}
+            stats['calls'] += 1
+            stats['seconds'] += span.duration
+            stats['min'] = min(stats['min'], span.duration)
+            stats['max'] = max(stats['max'], span.duration)
+            stats['recent'].append(span.duration)
+            if len(stats['recent']) > self.keep:
+                del stats['recent'][0]
+            if span.memory is not None:
+                stats['memory_delta'] = max(stats['memory_delta'], span.memory[1] - span.memory[0])
+
+    def count(self, name, value, attributes):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """
+        Span statistics as a DataFrame: calls, total, mean, min, p50, p95, max seconds and largest memory growth
+        """
+        import numpy as np
+        import pandas as pd
+
+        with self._lock:
+            rows = [{'span': name, 'calls': stats['calls'], 'total': stats['seconds'], 'mean': stats['seconds']/stats['calls'],
+                     'min': stats['min'], 'p50': float(np.percentile(stats['recent'], 50)), 'p95': float(np.percentile(stats['recent'], 95)),
+                     'max': stats['max'], 'memory_delta': stats['memory_delta']} for (name, stats) in self.spans.items()]
+        return pd.DataFrame(rows, columns = ['span', 'calls', 'total', 'mean', 'min', 'p50', 'p95', 'max', 'memory_delta']).sort_values('total', ascending=False, ignore_index=True)
+
+    def snapshot(self):
+        """
+        Counters and span statistics as plain JSON-serialisable dictionaries
+        """
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'spans': {name: {key: value for (key, value) in stats.items() if key != 'recent'} for (name, stats) in self.spans.items()}}
+
+    def reset(self):
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+
+class ChromeTrace(Sink):
+    """
+    Collect spans and counters as Chrome trace events, viewable in chrome://tracing or Perfetto.
+
+    Arguments:
+      max_events : int - events kept, the oldest are dropped beyond it
+    """
+    def __init__(self, max_events = 1000000):
+        self.max_events = max_events
+        self.events = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _add(self, event):
+        with self._lock:
+            self.events.append(event)
+            if len(self.events) > self.max_events:
+                del self.events[:len(self.events) - self.max_events]
+
+    def span(self, span):
+        event = {'name': span.name, 'ph': 'X', 'ts': (span.start - self._origin)*1e6, 'dur': span.duration*1e6,
+                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': {key: str(value) for (key, value) in span.attributes.items()}}
+        self._add(event)
+        if span.memory is not None:
+            self._add({'name': 'resident_memory', 'ph': 'C', 'ts': (span.start + span.duration - self._origin)*1e6,
+                       'pid': os.getpid(), 'args': {'bytes': span.memory[1]}})
+
+    def count(self, name, value, attributes):
+        self._add({'name': name, 'ph': 'i', 's': 't', 'ts': (time.perf_counter() - self._origin)*1e6,
+                   'pid': os.getpid(), 'tid': threading.get_ident(), 'args': dict({'value': value}, **{key: str(item) for (key, item) in attributes.items()})})
+
+    def write(self, path):
+        """
+        Write the collected events as a Chrome trace JSON file
+        """
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
@@ -0,0 +1,52 @@
+# This file defers the import of heavy dependencies until they are used
+
+"""`import fynesse` should not pay for osmnx, geopandas, statsmodels, matplotlib and friends when a
+job only needs calculate_boundaries or the loader. Modules bind their heavy dependencies to
+placeholders from lazy_module instead, and the real import happens on first attribute access. """
+
+import sys
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder of a module that is imported when one of its attributes is first used.
+
+    Arguments:
+      name : string - full module name, e.g. 'matplotlib.pyplot'
+    """
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_loaded'] = False
+
+    def _load(self):
+        module = importlib.import_module(self.__name__)
+        if not self.__dict__['_lazy_loaded']:
+            # Later lookups then find the attributes directly, without going through __getattr__
+            self.__dict__.update(module.__dict__)
+            self.__dict__['_lazy_loaded'] = True
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_lazy_loaded'] else 'not loaded'
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+def lazy_module(name):
+    """
+    Module, imported on first use
+
+    Argument:
+      name : (string) - full module name, e.g. 'statsmodels.api'
+    Output:
+      module : (module) - the module itself if it is already imported, a LazyModule placeholder otherwise
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -0,0 +1,190 @@
+# This file serves price predictions to many concurrent requests
+
+"""An asyncio front end to the address stage. Database and POI fetches and model fits run on a thread
+pool, so the event loop never blocks on MariaDB or Overpass. Identical in-flight work (the fetch of
+a region, its points of interest, the fit of its model) is shared by every request that needs it, and
+a semaphore bounds the number of requests in flight. Results are JSON-serialisable dictionaries.
+
+    service = PredictionService(ConnectionPool(), tiles = TileCache())
+    result = await service.predict(52.35, -2.25, '2018-06-01', 'D')
+"""
+
+from .config import *
+
+from .access import *
+from .address import *
+from . import instrument
+
+import time
+import asyncio
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PredictionService:
+    """
+    Concurrent price prediction with request coalescing.
+
+    Predictions go through a ModelRegistry, as predict_price(..., models = ...): every request in the
+    same region tile, month and property type shares one fitted model, and while that model is being
+    fitted the other requests wait for the same fit instead of starting their own.
+
+    Arguments:
+      conn : ConnectionPool - pool the database fetches check connections out of, a pool from the config if None
+      size : double - size of the training box
+      cache : ExtractCache - local cache for the transaction data
+      tiles : TileCache - local tile cache for the points of interest
+      models : ModelRegistry - fitted models, a new in-memory registry if None
+      max_requests : int - requests served at once, the others wait
+      max_workers : int - threads running blocking fetches and fits, config pool_size if None
+      max_regions : int - tile blocks of points of interest kept in memory for queries nearby
+    """
+    def __init__(self, conn = None, size = 0.1, cache = None, tiles = None, models = None, max_requests = 64, max_workers = None, max_regions = 64):
+        self.conn = conn if conn is not None else ConnectionPool()
+        max_workers = max_workers or int(config.get('pool_size', 4))
+        if not isinstance(self.conn, ConnectionPool) and max_workers > 1:
+            raise ValueError("Concurrent fetches need a ConnectionPool")
+        self.size = size
+        self.cache = cache
+        self.tiles = tiles
+        self.models = models if models is not None else ModelRegistry()
+        self.max_requests = max_requests
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.max_regions = max_regions
+        self._regions = OrderedDict()
+        self._inflight = {}
+        self._semaphore = None
+
+    async def predict(self, latitude, longitude, date, property_type):
+        """
+        Predict the price of a property.
+
+        Arguments:
+          latitude, longitude : double - location of the property
+          date : string - date of the prediction e.g. '2018-06-01'
+          property_type : string - property type (e.g. 'D','S','T')
+        Output:
+          result : dictionary - the query, the prediction (PREDICTION_COLUMNS), whether the model was
+                                already fitted and the seconds taken; 'error' instead of 'prediction' on failure
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_requests)
+        result = {'latitude': latitude, 'longitude': longitude, 'date': date, 'property_type': property_type}
+        start = time.perf_counter()
+        async with self._semaphore:
+            try:
+                (prediction, cached) = await self._predict(latitude, longitude, date, property_type)
+                result['prediction'] = {column: float(prediction[column].iloc[0]) for column in PREDICTION_COLUMNS}
+                result['cached_model'] = cached
+            except Exception as error:
+                result['error'] = f"{type(error).__name__}: {error}"
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    async def predict_many(self, queries):
+        """
+        Predict a batch of queries concurrently.
+
+        Arguments:
+          queries : iterable(dictionary) - latitude, longitude, date and property_type of every query
+        Output:
+          results : list(dictionary) - results of predict, in query order
+        """
+        return await asyncio.gather(*(self.predict(query['latitude'], query['longitude'], query['date'], query['property_type']) for query in queries))
+
+    def close(self):
+        """
+        Stop the worker threads.
+        """
+        self.executor.shutdown(wait=True)
+
+    async def _predict(self, latitude, longitude, date, property_type):
+        (center_latitude, center_longitude) = self.models.region_center(latitude, longitude)
+        (from_date, to_date) = date_window(date[:8] + '01')
+        region = calculate_boundaries(center_latitude, center_longitude, self.size)
+        key = (region, from_date, to_date, property_type)
+        # A registry lookup can read the manifest and a persisted model from disk
+        model = await self._run(self.models.get, key)
+        cached = model is not None
+        instrument.count('service.model.hit' if cached else 'service.model.miss')
+        if model is None:
+            model = await self._coalesce(('fit',) + key, self._fit, key, center_latitude, center_longitude, from_date, to_date, property_type)
+        pois = await self._point_pois(latitude, longitude)
+        design = design_matrix(poi_features([longitude], [latitude], pois), pois, model['columns'])
+        return (self.models.predict(model, design), cached)
+
+    async def _point_pois(self, latitude, longitude):
+        """
+        Points of interest around a query, as download_pois(latitude, longitude, 0.1). With a tile cache the
+        whole block of tiles is fetched once and kept, and every query inside it is clipped out of it.
+        """
+        (north, south, west, east) = calculate_boundaries(latitude, longitude, 0.1)
+        if self.tiles is None:
+            return await self._coalesce(('pois', latitude, longitude), download_pois, latitude, longitude, 0.1)
+        block = tuple(self.tiles.tiles(north, south, west, east))
+        pois = self._regions.get(block)
+        if pois is None:
+            bounds = [self.tiles.bounds(tile) for tile in block]
+            pois = await self._coalesce(('tiles', block), self.tiles.pois, max(b[0] for b in bounds), min(b[1] for b in bounds),
+                                        min(b[2] for b in bounds), max(b[3] for b in bounds), POI_TAGS)
+            self._regions[block] = pois
+            while len(self._regions) > self.max_regions:
+                self._regions.popitem(last=False)
+        else:
+            self._regions.move_to_end(block)
+            instrument.count('service.region.hit')
+        return pois.cx[west:east, south:north] if len(pois) else pois
+
+    async def _fit(self, key, latitude, longitude, from_date, to_date, property_type):
+        """
+        Fetch the region's transactions and points of interest concurrently, then fit its model.
+        """
+        (region, _, _, _) = key
+        (data, pois) = await asyncio.gather(
+            self._coalesce(('data', region, from_date, to_date), download_data_to_gdf, self.conn, latitude, longitude, self.size, from_date, to_date, self.cache, geometry = False),
+            self._coalesce(('pois', region), download_pois, latitude, longitude, max(self.size, 0.1), tiles = self.tiles))
+        return await self._run(self._fit_model, key, data, pois, property_type)
+
+    def _fit_model(self, key, data, pois, property_type):
+        warnings.filterwarnings("ignore", category=UserWarning)
+        data = add_poi_features(data.copy(), pois)
+        return self.models.put(key, fit_model(data, pois, property_type), model_columns(pois))
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: function(*args, **kwargs))
+
+    async def _coalesce(self, key, function, *args, **kwargs):
+        """
+        Run function (blocking, or a coroutine function) once for all concurrent callers with the same key.
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            instrument.count('service.coalesced')
+            # Shielded, so one cancelled request does not cancel the work others wait for
+            return await asyncio.shield(future)
+        if asyncio.iscoroutinefunction(function):
+            future = asyncio.ensure_future(function(*args, **kwargs))
+        else:
+            future = asyncio.ensure_future(self._run(function, *args, **kwargs))
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+def serve(queries, conn = None, **settings):
+    """
+    Run a PredictionService over a batch of queries from synchronous code.
+
+    Arguments:
+      queries : iterable(dictionary) - latitude, longitude, date and property_type of every query
+      conn : ConnectionPool - pool to fetch the data with, a pool from the config if None
+      settings : further PredictionService arguments
+    Output:
+      results : list(dictionary) - JSON-serialisable results, in query order
+    """
+    service = PredictionService(conn, **settings)
+    try:
+        return asyncio.run(service.predict_many(list(queries)))
+    finally:
+        service.close()
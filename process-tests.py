@@ -0,0 +1,342 @@
+# Tests of the feature engineering and address part, run by .github/workflows/process-tests.yml
+
+"""Points of interest are generated around Worcester (52.35, -2.25) and the price models are trained on
+transactions in embedded SQLite databases, so the tests need neither the OSM API nor a database server."""
+
+import os
+import shutil
+import asyncio
+import threading
+import tempfile
+import unittest
+import importlib.util
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import Point
+
+from fynesse import access, address, cache, features, service
+from fynesse.config import config
+from fynesse.backends import SCHEMA
+
+
+def random_pois(count, seed = 0, north = 52.45, south = 52.25, west = -2.35, east = -2.15):
+    """
+    Points of interest scattered over a box, half amenities and half leisure places
+    """
+    rng = np.random.default_rng(seed)
+    half = count // 2
+    return gpd.GeoDataFrame({'amenity': ['cafe']*half + [None]*(count - half),
+                             'leisure': [None]*half + ['park']*(count - half)},
+                            geometry=[Point(west + rng.random()*(east - west), south + rng.random()*(north - south)) for _ in range(count)],
+                            crs='EPSG:4326')
+
+def random_points(count, seed = 1, north = 52.45, south = 52.25, west = -2.35, east = -2.15):
+    rng = np.random.default_rng(seed)
+    return (west + rng.random(count)*(east - west), south + rng.random(count)*(north - south))
+
+
+class FeatureTests(unittest.TestCase):
+    """
+    The spatial index queries against a loop over every point and every geometry
+    """
+    def setUp(self):
+        self.pois = random_pois(400)
+        (self.longitude, self.latitude) = random_points(300)
+        self.points = features.to_metric(self.longitude, self.latitude)
+
+    def distances(self, geometries):
+        # Brute force: every point against every geometry, in metres
+        return np.array([[point.distance(geometry) for geometry in geometries] for point in self.points])
+
+    def test_poi_features(self):
+        computed = features.poi_features(self.longitude, self.latitude, self.pois, radius=1000)
+        amenities = self.distances(features.geometries_to_metric(self.pois[self.pois.amenity.notnull()]))
+        leisure = self.distances(features.geometries_to_metric(self.pois[self.pois.leisure.notnull()]))
+        np.testing.assert_array_equal(computed.amenity_proximity.to_numpy(), (amenities <= 1000).sum(axis=1) + 1)
+        np.testing.assert_allclose(computed.closest_leisure.to_numpy(), leisure.min(axis=1))
+
+    def test_count_within_radii(self):
+        geometries = features.geometries_to_metric(self.pois)
+        distances = self.distances(geometries)
+        radii = [250, 500, 1000, 2000]
+        counts = features.count_within_radii(self.points, geometries, radii)
+        for (column, radius) in enumerate(radii):
+            np.testing.assert_array_equal(counts[:, column], (distances <= radius).sum(axis=1))
+            np.testing.assert_array_equal(features.count_within(self.points, geometries, radius), (distances <= radius).sum(axis=1))
+
+    def test_missing_tags(self):
+        # No leisure column: no closest_leisure feature; no geometries at all: zero counts and nan distances
+        computed = features.poi_features(self.longitude, self.latitude, self.pois[['amenity', 'geometry']])
+        self.assertEqual(list(computed.columns), ['amenity_proximity'])
+        empty = features.geometries_to_metric(self.pois.iloc[:0])
+        self.assertEqual(features.count_within(self.points, empty, 1000).sum(), 0)
+        self.assertTrue(np.isnan(features.nearest_distance(self.points, empty)).all())
+        self.assertEqual(len(features.poi_features([], [], self.pois)), 0)
+
+
+def fixture(directory, backend = 'sqlite'):
+    """
+    A database of transactions between 2016 and 2019 at postcodes spread over two 0.1 degree grid cells,
+    and an offline tile cache of points of interest covering them with a margin. Returns (path, tiles).
+    """
+    rng = np.random.default_rng(2)
+    path = os.path.join(directory, 'test.' + backend)
+    conn = access.create_connection(backend=backend, path=path)
+    access.create_tables(conn, ['pp_data', 'postcode_data'])
+    points = [(52.25 + rng.random()*0.2, -2.35 + rng.random()*0.1) for _ in range(60)]
+    postcodes = []
+    for (i, (lattitude, longitude)) in enumerate(points):
+        fields = dict.fromkeys(access.POSTCODE_COLUMNS)
+        fields.update(postcode=f"AB1 {i}XY", status='live', country='England', lattitude=lattitude, longitude=longitude)
+        postcodes.append([fields[column] for column in access.POSTCODE_COLUMNS])
+    transactions = [[f"{{T{i}}}", int(100000 + 200000*rng.random()), f"{2016 + i % 4}-{1 + i % 12:02d}-{1 + i % 28:02d}", f"AB1 {i % len(points)}XY",
+                     'DST'[i % 3], 'N', 'F', str(i), '', 'HIGH ST', 'LOC', 'TOWN', 'DIST', 'COUNTY', 'A', 'A'] for i in range(1500)]
+    backend_of = access.backend_of(conn)
+    backend_of.insert_rows(conn, 'postcode_data', access.POSTCODE_COLUMNS, postcodes)
+    backend_of.insert_rows(conn, 'pp_data', [column for (column, _) in SCHEMA['pp_data']], transactions)
+    conn.commit()
+    conn.close()
+
+    tiles = cache.TileCache(os.path.join(directory, 'tiles'), offline=True)
+    for (seed, tile) in enumerate(tiles.tiles(52.6, 52.1, -2.5, -2.0)):
+        (north, south, west, east) = tiles.bounds(tile)
+        pois = random_pois(10, seed, north, south, west, east)
+        pois.index = pd.MultiIndex.from_tuples([('node', 100*seed + i) for i in range(10)], names=['element_type', 'osmid'])
+        tiles.put_pois(tile, access.POI_TAGS, pois)
+    return (path, tiles)
+
+
+class PredictionTests(unittest.TestCase):
+    """
+    Predictions on a SQLite fixture. Worker processes connect with the config settings, so the tests
+    run in a directory whose _config.yml points at the fixture database.
+    """
+    backend = 'sqlite'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        (cls.path, cls.tiles) = fixture(cls.directory, cls.backend)
+        cls.cwd = os.getcwd()
+        os.chdir(cls.directory)
+        with open('_config.yml', 'w') as handle:
+            handle.write(f"database_backend: {cls.backend}\ndatabase_path: {cls.path}\noffline: true\n")
+        config.reload()
+        rng = np.random.default_rng(3)
+        cls.queries = pd.DataFrame({'latitude': 52.26 + rng.random(24)*0.18,
+                                    'longitude': -2.34 + rng.random(24)*0.08,
+                                    'date': [f"2018-{1 + i % 12:02d}-15" for i in range(24)],
+                                    'property_type': ['DST'[i % 3] for i in range(24)]}, index=range(100, 124))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        config.reload()
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def setUp(self):
+        self.conn = access.create_connection(backend=self.backend, path=self.path)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_predict_prices_processes(self):
+        serial = address.predict_prices(self.conn, self.queries, tiles=self.tiles)
+        self.assertEqual(list(serial.index), list(self.queries.index))
+        self.assertEqual(list(serial.columns), address.PREDICTION_COLUMNS + ['n_train'])
+        self.assertFalse(serial.isna().any().any())
+        pooled = address.predict_prices(None, self.queries, processes=2, tiles=self.tiles)
+        pd.testing.assert_frame_equal(serial, pooled)
+
+    def fresh_prediction(self, latitude, longitude, date, property_type, size):
+        """
+        What _predict_price_registry computes, with a statsmodels fit and prediction of its own
+        """
+        (center_latitude, center_longitude) = address.ModelRegistry(tile_size=0.05).region_center(latitude, longitude)
+        (from_date, to_date) = address.date_window(date[:8] + '01')
+        data = address.download_data_to_gdf(self.conn, center_latitude, center_longitude, size, from_date, to_date, geometry=False)
+        pois = access.download_pois(center_latitude, center_longitude, max(size, 0.1), tiles=self.tiles)
+        data = address.add_poi_features(data, pois)
+        data = data[data.property_type == property_type]
+        results = address.sm.OLS(data['price'].to_numpy(dtype=float), address.design_matrix(data, pois)).fit()
+        pois = access.download_pois(latitude, longitude, 0.1, tiles=self.tiles)
+        design = address.design_matrix(features.poi_features([longitude], [latitude], pois), pois, address.model_columns(pois))
+        return results.get_prediction(design).summary_frame(alpha=0.05)[address.PREDICTION_COLUMNS]
+
+    def test_registry_predictions(self):
+        manifest = os.path.join(self.directory, 'manifest.json')
+        models = address.ModelRegistry(os.path.join(self.directory, 'models'), tile_size=0.05, manifest_file=manifest)
+        for (latitude, longitude, date, property_type) in [(52.36, -2.27, '2018-06-10', 'D'), (52.37, -2.26, '2018-06-20', 'D'),
+                                                           (52.31, -2.32, '2018-03-01', 'S')]:
+            prediction = address.predict_price(self.conn, latitude, longitude, date, property_type, 0.1, tiles=self.tiles, models=models)
+            expected = self.fresh_prediction(latitude, longitude, date, property_type, 0.1)
+            np.testing.assert_allclose(prediction.to_numpy(), expected.to_numpy(), rtol=1e-9)
+        # The first two points share a tile and month, so they share a model
+        self.assertEqual(len(models._models), 2)
+
+        # Persisted models are read back by a new registry, with the same predictions
+        design = np.array([[1.0, 0.25, 300.0], [1.0, 0.5, 50.0]])
+        key = (address.calculate_boundaries(*models.region_center(52.36, -2.27), 0.1), *address.date_window('2018-06-01'), 'D')
+        reopened = address.ModelRegistry(os.path.join(self.directory, 'models'), tile_size=0.05, manifest_file=manifest)
+        pd.testing.assert_frame_equal(reopened.predict(reopened.get(key), design), models.predict(models.get(key), design))
+
+        # New transactions in the region drop its model only
+        models.invalidate(52.42, 52.4, -2.24, -2.23)
+        self.assertIsNone(models.get(key))
+        self.assertEqual(len(models._models), 1)
+
+        # A changed load manifest drops every model, on disk as well
+        with open(manifest, 'w') as handle:
+            handle.write('{"pp-2019.csv": {}}')
+        other = (address.calculate_boundaries(*models.region_center(52.31, -2.32), 0.1), *address.date_window('2018-03-01'), 'S')
+        self.assertIsNone(address.ModelRegistry(os.path.join(self.directory, 'models'), manifest_file=manifest).get(other))
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'models')), [])
+
+    def test_sweep_border(self):
+        # Transactions on the border of the region count every amenity within the largest radius, also the
+        # ones beyond the region, whose longitude margin is wider than its latitude one
+        tiles = cache.TileCache(os.path.join(self.directory, 'dense'), offline=True)
+        for (seed, tile) in enumerate(tiles.tiles(52.5, 52.2, -2.45, -2.1)):
+            pois = random_pois(100, seed, *tiles.bounds(tile))
+            pois.index = pd.MultiIndex.from_tuples([('node', 1000*seed + i) for i in range(100)], names=['element_type', 'osmid'])
+            tiles.put_pois(tile, access.POI_TAGS, pois)
+        with mock.patch.object(address, 'sweep_features', wraps=address.sweep_features) as computed:
+            address.sweep(self.conn, 52.35, -2.3, '2018-06-01', radii=(500, 2000), windows=((2, 1),), folds=2, tiles=tiles)
+        (data, pois, radii) = computed.call_args.args
+        border = data[data.longitude > -2.26]
+        self.assertGreater(len(border), 0)
+        amenities = tiles.pois(52.5, 52.2, -2.45, -2.1, access.POI_TAGS)
+        amenities = features.geometries_to_metric(amenities[amenities.amenity.notnull()])
+        points = features.to_metric(border.longitude, border.lattitude)
+        distances = np.hypot(points.x.to_numpy()[:, None] - amenities.x.to_numpy(), points.y.to_numpy()[:, None] - amenities.y.to_numpy())
+        counts = features.count_within_radii(points, features.geometries_to_metric(pois[pois.amenity.notnull()]), radii)
+        for (column, radius) in enumerate(radii):
+            np.testing.assert_array_equal(counts[:, column], (distances <= radius).sum(axis=1))
+
+    def test_store_missing_tag(self):
+        # Transactions first stored from POIs without leisure places get their closest_leisure once POIs have them
+        store = features.FeatureStore(os.path.join(self.directory, 'store'))
+        (from_date, to_date) = address.date_window('2018-06-10')
+        data = address.download_data_to_gdf(self.conn, 52.35, -2.3, 0.1, from_date, to_date, geometry=False)
+        pois = access.download_pois(52.35, -2.3, 0.1, tiles=self.tiles)
+        address.add_poi_features(data.copy(), pois[['amenity', 'geometry']], store)
+        self.assertTrue(np.isnan(store.column('closest_leisure')).all())
+        amenity = np.array(store.column('amenity_proximity'))
+
+        prediction = address.predict_price(self.conn, 52.35, -2.3, '2018-06-10', 'D', 0.1, tiles=self.tiles, store=store)
+        expected = address.predict_price(self.conn, 52.35, -2.3, '2018-06-10', 'D', 0.1, tiles=self.tiles)
+        np.testing.assert_allclose(prediction.to_numpy(), expected.to_numpy(), rtol=1e-9)
+        self.assertEqual(len(store), len(data))
+        self.assertFalse(np.isnan(store.column('closest_leisure')).any())
+        np.testing.assert_array_equal(store.column('amenity_proximity'), amenity)
+
+    def test_registry_predict(self):
+        # ModelRegistry.predict against statsmodels' own prediction of the fitted model
+        rng = np.random.default_rng(4)
+        design = np.column_stack([np.ones(200), rng.random(200), rng.random(200)*1000])
+        results = address.sm.OLS(design @ [150000, 40000, -20] + rng.normal(0, 10000, 200), design).fit()
+        models = address.ModelRegistry(tile_size=0.05, manifest_file=os.path.join(self.directory, 'none.json'))
+        model = models.put(((52.4, 52.3, -2.3, -2.2), '2016-06-01', '2019-06-01', 'D'), results, ['const', 'amenity', 'leisure'])
+        np.testing.assert_allclose(models.predict(model, design[:20]).to_numpy(),
+                                   results.get_prediction(design[:20]).summary_frame(alpha=0.05)[address.PREDICTION_COLUMNS].to_numpy(), rtol=1e-9)
+
+
+@unittest.skipUnless(importlib.util.find_spec('duckdb'), "duckdb is not installed")
+class DuckDBPredictionTests(PredictionTests):
+    """
+    The same predictions on DuckDB, whose database file the test keeps open
+    """
+    backend = 'duckdb'
+
+    def test_predict_prices_processes(self):
+        # Spawned workers could not open the locked file and forked ones would share this process's database
+        # instance, so predict_prices runs the groups here
+        with mock.patch.object(address, 'ProcessPoolExecutor', side_effect=AssertionError("worker processes on DuckDB")):
+            super().test_predict_prices_processes()
+
+
+class ServiceTests(unittest.TestCase):
+    """
+    The asyncio prediction service on a SQLite fixture
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        (cls.path, cls.tiles) = fixture(cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def setUp(self):
+        self.pool = access.ConnectionPool(4, backend='sqlite', path=self.path)
+        self.models = address.ModelRegistry(tile_size=0.05, manifest_file=os.path.join(self.directory, 'none.json'))
+        self.service = service.PredictionService(self.pool, tiles=self.tiles, models=self.models, max_workers=4)
+
+    def tearDown(self):
+        self.service.close()
+        self.pool.close()
+
+    def test_coalescing(self):
+        # Points of one region tile, month and property type share one fetch and one fit
+        queries = [{'latitude': 52.355 + 0.001*i, 'longitude': -2.27 + 0.001*i, 'date': f"2018-06-{1 + i:02d}", 'property_type': 'D'} for i in range(12)]
+        with mock.patch.object(service, 'fit_model', wraps=address.fit_model) as fit, \
+             mock.patch.object(service, 'download_data_to_gdf', wraps=address.download_data_to_gdf) as fetch:
+            results = asyncio.run(self.service.predict_many(queries))
+            self.assertEqual((fit.call_count, fetch.call_count), (1, 1))
+            self.assertEqual([result.get('error') for result in results], [None]*12)
+            self.assertFalse(any(result['cached_model'] for result in results))
+            # Later requests find the fitted model
+            again = asyncio.run(self.service.predict_many(queries[:3]))
+            self.assertEqual(fit.call_count, 1)
+            self.assertTrue(all(result['cached_model'] for result in again))
+
+        # The same predictions as predict_price through a registry
+        conn = access.create_connection(backend='sqlite', path=self.path)
+        try:
+            for (query, result) in zip(queries, results):
+                expected = address.predict_price(conn, query['latitude'], query['longitude'], query['date'], query['property_type'], 0.1,
+                                                 tiles=self.tiles, models=address.ModelRegistry(tile_size=0.05, manifest_file=self.models.manifest_file))
+                np.testing.assert_allclose([result['prediction'][column] for column in address.PREDICTION_COLUMNS], expected.iloc[0].to_numpy(), rtol=1e-9)
+        finally:
+            conn.close()
+
+    def test_errors(self):
+        # A failing request reports its error without failing the others
+        results = asyncio.run(self.service.predict_many([{'latitude': 52.36, 'longitude': -2.27, 'date': '2018-06-01', 'property_type': 'S'},
+                                                         {'latitude': 52.36, 'longitude': -2.27, 'date': 'June 2018', 'property_type': 'S'}]))
+        self.assertIn('prediction', results[0])
+        self.assertIn('error', results[1])
+
+    def test_registry_off_event_loop(self):
+        # Registry lookups read the manifest (and persisted models), so they run on the worker threads
+        threads = []
+        get = self.models.get
+
+        def recorded(key):
+            threads.append(threading.current_thread())
+            return get(key)
+
+        with mock.patch.object(self.models, 'get', side_effect=recorded):
+            asyncio.run(self.service.predict(52.36, -2.27, '2018-06-01', 'T'))
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_max_workers(self):
+        # A plain connection serves one worker at a time, config pool_size sets the default number of workers
+        conn = access.create_connection(backend='sqlite', path=self.path)
+        try:
+            with mock.patch.dict(config, {'pool_size': 1}):
+                service.PredictionService(conn, tiles=self.tiles).close()
+            with mock.patch.dict(config, {'pool_size': 4}):
+                self.assertRaises(ValueError, service.PredictionService, conn, tiles=self.tiles)
+            self.assertRaises(ValueError, service.PredictionService, conn, max_workers=2)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,6 +33,8 @@ REQUIRED = [
 # What packages are optional?
 EXTRAS = {
     "interactive html plots": ["bokeh",],
+    "arrow and parquet": ["pyarrow",],
+    "embedded database": ["duckdb",],
 }
 
 PACKAGE_DATA = {"fynesse": ["defaults.yml"]}